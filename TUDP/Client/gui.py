@@ -130,7 +130,10 @@ class GUI:
         self.chat_context = "all"  # changed to ("dm", recipient_port) or ("group", recipient_port)
         self.dm_histories = {}  # {recipient_port} : [ (sender, msg, time), ... ]
         self.group_chat_histories = {}
+        self.dm_message_ids = set()  # Server ids of messages already in dm_histories
+        self.group_message_ids = set()  # Server ids of messages already in group_chat_histories
         self.selected_port = None
+        self.selected_username = None
         self.dm_refresh_interval = 5000
         self.dm_refresh_thread = None
         self.selected_group_name = None
@@ -412,6 +415,8 @@ class GUI:
             font = ('Helvitica', 9), relief = "flat", highlightthickness = 0
         )
         self.off_users_list.pack(side = "top", fill = "both", expand = True)
+        # Offline registered users can be sent DMs too, they get them when they log in
+        self.off_users_list.bind("<<ListboxSelect>>", self.on_off_user_select)
 
         # == My User label Frame
         my_user_label_frame = ttk.Frame(client_frame, style = "Sidebar.TFrame", height = self.w_size[1] * 0.08)
@@ -429,6 +434,10 @@ class GUI:
         self.chat_display.tag_config('message', foreground=self.text_fg, font=('Helvetica', 10))
         self.chat_display.tag_config('server', foreground=self.server_color, font=('Helvetica', 10, 'italic'))
         self.chat_display.tag_config('typing', foreground='#f5df3d', font=('Helvetica', 9, 'italic'))
+        self.chat_display.tag_config('older', foreground=self.accent_color, font=('Helvetica', 9, 'underline'))
+        self.chat_display.tag_bind('older', '<Button-1>', self.load_older_history)
+        self.chat_display.tag_bind('older', '<Enter>', lambda event: self.chat_display.config(cursor='hand2'))
+        self.chat_display.tag_bind('older', '<Leave>', lambda event: self.chat_display.config(cursor=''))
 
         self.gen_user_groups()
 
@@ -467,8 +476,12 @@ class GUI:
             self.selected_port, self.selected_username, self.selected_group_name = None, None, selected_group_name
             self.active_chat_label.config(text=f"Group: {self.selected_group_name}")
             if self.network_handler and self.selected_group_name:
-                # Request history from server, which will trigger a display update upon receipt
-                self.network_handler.request_group_history(self.selected_group_name)
+                # Request history from server, which will trigger a display update upon receipt.
+                # With messages already cached only the ones we have not seen are asked for.
+                since_id = None
+                if self.group_chat_histories.get(self.selected_group_name):
+                    since_id = self.network_handler.history_cursors.get(("group", self.selected_group_name))
+                self.network_handler.request_group_history(self.selected_group_name, since_id=since_id)
             self.display_group_chat()  # Immediately display any cached messages
 
         self.update_client_list()
@@ -484,10 +497,11 @@ class GUI:
         pass
 
     # ==== typing functions ==== #
-    def show_typing_text(self, sender, text, context="all"):
+    def show_typing_text(self, sender, text, context="all", group_name=""):
         # Only show if we're in the matching context
         if (context == 'all' and self.chat_context != 'all') or \
-                (context == 'dm' and self.chat_context != 'dm'):
+                (context == 'dm' and (self.chat_context != 'dm' or self.selected_username != sender)) or \
+                (context == 'group' and (self.chat_context != 'group' or self.selected_group_name != group_name)):
             return
 
         # A unique, predictable tag for each user's indicator
@@ -513,8 +527,13 @@ class GUI:
     def on_typing(self, event=None):
         text = self.message_entry.get()
         if self.network_handler:
-            context = 'dm' if self.chat_context == 'dm' else 'all'
-            self.network_handler.send_typing(text, context)
+            if self.chat_context == 'dm':
+                if self.selected_port:  # Nobody to show it to while the peer is offline
+                    self.network_handler.send_typing(text, 'dm', self.selected_port)
+            elif self.chat_context == 'group':
+                self.network_handler.send_typing(text, 'group', self.selected_group_name)
+            else:
+                self.network_handler.send_typing(text, 'all')
 
     def clear_typing_text(self, sender, context="all"):
         tag_name = f"typing_indicator_{sender}_{context}"
@@ -628,6 +647,28 @@ class GUI:
             else:
                 print(f"Could not determine user/port for DM: {display_text}")
 
+    def on_off_user_select(self, event):
+        selection = self.off_users_list.curselection()
+        if not selection:
+            return
+        username = self.off_users_list.get(selection[0]).strip()
+
+        if self.chat_context == 'dm':
+            # Offline registered users have no port, their DMs go by username
+            self.switch_chat_mode('dm', selected_user_name=username)
+        elif username.startswith("Guest_"):
+            port = username.split("_")[1]
+            if port.isdigit() and port != str(self.network_handler.get_port()):
+                self.switch_chat_mode('dm', selected_user_port=port, selected_user_name=username)
+
+    def dm_key(self, username):
+        """The dm_histories key of a conversation: the user's port while they
+        are online, their username while they are offline"""
+        for port, name in self.network_handler.username_map.items():
+            if name == username:
+                return port
+        return username
+
     def on_group_select(self, event):
         selection = self.groups_list.curselection()
         if not selection:
@@ -637,15 +678,13 @@ class GUI:
         group_name = self.groups_list.get(index)
 
         if group_name and group_name != self.selected_group_name:
-            # Clear existing history for a clean load
-            if group_name in self.group_chat_histories:
-                self.group_chat_histories[group_name] = []
+            # Cached history is kept, switch_chat_mode only fetches what is new
             self.switch_chat_mode('group', selected_group_name=group_name)
 
 
-    def display_dm_message(self, port, sender, message, timestamp):
+    def display_dm_message(self, port, sender, message, timestamp, username=None):
         # Get the username associated with this port
-        username = self.network_handler.username_map.get(port, f"User {port}")
+        username = username or self.network_handler.username_map.get(port, f"User {port}")
 
         self.clear_typing_text(username, context="dm")
 
@@ -661,10 +700,10 @@ class GUI:
         self.dm_histories[port].append((display_sender, message, timestamp))
 
         # Update display if this is the active chat
-        if self.chat_context == "dm" and self.selected_port == port:
+        if self.chat_context == "dm" and self.dm_key(self.selected_username) == port:
             self.display_dm_history(username)
 
-    def dm_notify(self, from_port, to_port):
+    def dm_notify(self, from_port, to_port, msg_id=None):
         self_port = str(self.network_handler.get_port())
         other_port = from_port if to_port == self_port else to_port
         other_username = self.network_handler.username_map.get(other_port, f"User {other_port}")
@@ -680,20 +719,19 @@ class GUI:
             self.selected_username = other_username
             self.display_dm_history(other_username)
 
+            # Pull the new message now instead of waiting for the next refresh
+            cursor = self.network_handler.history_cursors.get(("dm", other_username), 0)
+            if msg_id and msg_id > cursor and self.selected_port == other_port:
+                self.refresh_dm_history(reschedule=False)
+
     # ==== DM history handling ==== #
 
     def display_dm_history(self, username):
         self.chat_display.config(state='normal')
         self.chat_display.delete("1.0", tk.END)
 
-        # Find the port associated with this username
-        port = None
-        for p, uname in self.network_handler.username_map.items():
-            if uname == username:
-                port = p
-                break
-
-        if port is None or port not in self.dm_histories:
+        port = self.dm_key(username)
+        if port not in self.dm_histories:
             self.chat_display.config(state='disabled')
             return
 
@@ -701,6 +739,7 @@ class GUI:
         self.chat_display.insert(tk.END,
                                  f"Conversation with {username}\n{'=' * 30}\n",
                                  'server')
+        self.insert_older_link(("dm", username))
 
         # Add messages in chronological order
         for sender, message, time in sorted(self.dm_histories.get(port, []), key=lambda x: x[2]):
@@ -715,7 +754,17 @@ class GUI:
         self.chat_display.config(state='disabled')
         self.chat_display.see('end')
 
-    def process_dm_history(self, sender, recipient, message, timestamp):
+    def process_dm_history_batch(self, rows):
+        """Add a whole batch of history rows, then redraw the open conversation once"""
+        shown_user = None
+        for row in rows:
+            shown_user = self.process_dm_history(*row, redraw=False) or shown_user
+        if shown_user:
+            self.display_dm_history(shown_user)
+
+    def process_dm_history(self, sender, recipient, message, timestamp, msg_id=None, redraw=True):
+        """Add one history row. Returns the other user's name when the row landed in
+        the open conversation and `redraw` was False, so the caller can redraw."""
         my_port = str(self.network_handler.get_port())
         my_username = self.network_handler.username_map.get(my_port)
 
@@ -725,15 +774,7 @@ class GUI:
         else:
             other_user = sender
 
-        # Find the port associated with this user
-        other_port = None
-        for port, username in self.network_handler.username_map.items():
-            if username == other_user:
-                other_port = port
-                break
-
-        if other_port is None:
-            return
+        other_port = self.dm_key(other_user)
 
         # Initialize history if needed
         if other_port not in self.dm_histories:
@@ -744,11 +785,15 @@ class GUI:
             )
 
         # Check if this message already exists in history to avoid duplicates
-        message_exists = any(
-            existing_msg[1] == message and existing_msg[2] == timestamp
-            for existing_msg in self.dm_histories[other_port]
-            if existing_msg[0] != "System"  # Skip checking system messages
-        )
+        if msg_id is not None:
+            message_exists = msg_id in self.dm_message_ids
+            self.dm_message_ids.add(msg_id)
+        else:
+            message_exists = any(
+                existing_msg[1] == message and existing_msg[2] == timestamp
+                for existing_msg in self.dm_histories[other_port]
+                if existing_msg[0] != "System"  # Skip checking system messages
+            )
 
         if not message_exists:
             # Add to history with proper direction indicator
@@ -756,29 +801,44 @@ class GUI:
             self.dm_histories[other_port].append((direction, message, timestamp))
 
             # Update display if viewing this conversation
-            if (self.chat_context == "dm" and
-                    hasattr(self, 'selected_port') and
-                    self.selected_port == other_port):
+            if self.chat_context == "dm" and self.selected_username == other_user:
+                if not redraw:
+                    return other_user
                 self.display_dm_history(other_user)
+        return None
 
     def request_dm_history(self, other_username):
         my_port = str(self.network_handler.get_port())
         my_username = self.network_handler.username_map.get(my_port)
         if my_username and other_username:
-            # Find the port for this user
-            other_port = None
-            for port, username in self.network_handler.username_map.items():
-                if username == other_username:
-                    other_port = port
-                    break
-
-            if other_port:
-                # Clear existing history before requesting new
-                if other_port in self.dm_histories:
-                    self.dm_histories[other_port] = []
+            # With the conversation cached, only ask for messages after the newest one we have
+            since_id = None
+            if self.dm_histories.get(self.dm_key(other_username)):
+                since_id = self.network_handler.history_cursors.get(("dm", other_username))
+            else:
+                self.network_handler.reset_cursor(("dm", other_username))
 
             # Request history between both users!
-            self.network_handler.send_message(f"REQUEST_DM_HISTORY:{my_username}:{other_username}")
+            self.network_handler.request_dm_history(my_username, other_username, since_id=since_id)
+
+    # ==== older history pages ==== #
+    def insert_older_link(self, conversation):
+        """A clickable line asking for the previous page, while the server may have one"""
+        if self.network_handler.has_older_history(conversation):
+            self.chat_display.insert(tk.END, "Load older messages\n\n", 'older')
+
+    def load_older_history(self, event=None):
+        if self.chat_context == "dm" and self.selected_username:
+            self.network_handler.request_older_history(("dm", self.selected_username))
+        elif self.chat_context == "group" and self.selected_group_name:
+            self.network_handler.request_older_history(("group", self.selected_group_name))
+
+    def refresh_open_chat(self):
+        """Redraw the open DM or group conversation"""
+        if self.chat_context == "dm" and self.selected_username:
+            self.display_dm_history(self.selected_username)
+        elif self.chat_context == "group":
+            self.display_group_chat()
 
     def add_dm_history(self, sender, recipient, content, timestamp):
         """Properly organize historical DMs by conversation"""
@@ -836,20 +896,22 @@ class GUI:
         if not hasattr(self, 'dm_refresh_thread') or not self.dm_refresh_thread:
             self.root.after(self.dm_refresh_interval, self.refresh_dm_history)
 
-    def refresh_dm_history(self):
-        """Periodically refresh DM history for active conversations"""
-        if self.chat_context == "dm" and self.selected_port:
+    def refresh_dm_history(self, reschedule=True):
+        """Periodically fetch new DMs for the active conversation"""
+        if self.chat_context == "dm" and self.selected_username:
             # Get both usernames
             my_port = str(self.network_handler.get_port())
             my_username = self.network_handler.username_map.get(my_port)
-            other_username = self.network_handler.username_map.get(self.selected_port)
+            other_username = self.selected_username
 
             if my_username and other_username:
-                # Request fresh history from server using username format
-                self.network_handler.send_message(f"REQUEST_DM_HISTORY:{my_username}:{other_username}")
+                # Only messages newer than the last one received are sent back
+                since_id = self.network_handler.history_cursors.get(("dm", other_username))
+                self.network_handler.request_dm_history(my_username, other_username, since_id=since_id)
 
         # Schedule the next refresh
-        self.root.after(self.dm_refresh_interval, self.refresh_dm_history)
+        if reschedule:
+            self.root.after(self.dm_refresh_interval, self.refresh_dm_history)
 
     # ==== Chatting ==== #
     def display_message(self, sender, message, timestamp):
@@ -887,12 +949,17 @@ class GUI:
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
 
         if self.chat_context == "dm" and self.selected_port:
-            self.network_handler.send_typing("", 'dm')
-            self.display_dm_message(self.selected_port, self.user_name, message, timestamp)
+            self.network_handler.send_typing("", 'dm', self.selected_port)
+            self.display_dm_message(self.selected_port, str(self.network_handler.get_port()), message, timestamp)
             self.network_handler.send_message(message, dm_recipient_port=self.selected_port)
+        elif self.chat_context == "dm" and self.selected_username:
+            # Offline, delivered from the server's mailbox when they log in
+            self.display_dm_message(self.selected_username, str(self.network_handler.get_port()), message,
+                                    timestamp, username=self.selected_username)
+            self.network_handler.send_message(message, dm_recipient_name=self.selected_username)
 
         elif self.chat_context == 'group' and self.selected_group_name:
-            self.network_handler.send_typing("", 'group')
+            self.network_handler.send_typing("", 'group', self.selected_group_name)
             # Display message locally immediately
             self.display_group_message(self.selected_group_name, "You", message, timestamp)
             # Send to server for distribution
@@ -1213,6 +1280,7 @@ class GUI:
 
         history = self.group_chat_histories.get(self.selected_group_name, [])
         history.sort(key=lambda x: x[2])  # Sort by timestamp
+        self.insert_older_link(("group", self.selected_group_name))
 
         for sender, message, ts in history:
             self.chat_display.insert(tk.END, f"{sender}\n", 'username')
@@ -1227,24 +1295,41 @@ class GUI:
         self.chat_display.config(state='disabled')
         self.chat_display.see('end')
 
-    def process_group_history(self, group_name, sender, message, timestamp):
+    def process_group_history_batch(self, rows):
+        """Add a whole batch of history rows, then redraw the open group once"""
+        for row in rows:
+            self.process_group_history(*row, redraw=False)
+        if self.chat_context == 'group' and any(row[0] == self.selected_group_name for row in rows):
+            self.display_group_chat()
+
+    def process_group_history(self, group_name, sender, message, timestamp, msg_id=None, redraw=True):
         """Adds a historical message from the server to the local cache."""
         if group_name not in self.group_chat_histories:
             self.group_chat_histories[group_name] = []
 
-        # Avoid duplicates from multiple requests
-        if not any(m[1] == message and m[2] == timestamp for m in self.group_chat_histories[group_name]):
+        # Avoid duplicates from multiple requests and from messages we already got live
+        if msg_id is not None:
+            message_exists = msg_id in self.group_message_ids
+            self.group_message_ids.add(msg_id)
+        else:
+            message_exists = any(m[1] == message and m[2] == timestamp for m in self.group_chat_histories[group_name])
+        if not message_exists:
             display_sender = "You" if sender == self.user_name else sender
             self.group_chat_histories[group_name].append((display_sender, message, timestamp))
 
-        if self.chat_context == 'group' and self.selected_group_name == group_name:
+        if redraw and self.chat_context == 'group' and self.selected_group_name == group_name:
             self.display_group_chat()
 
-    def display_group_message(self, group_name, sender, message, timestamp):
+    def display_group_message(self, group_name, sender, message, timestamp, msg_id=None):
         """Handles a new live group message and updates the display if active."""
         if group_name not in self.group_chat_histories:
             self.group_chat_histories[group_name] = []
 
+        if msg_id is not None:
+            if msg_id in self.group_message_ids:
+                return
+            self.group_message_ids.add(msg_id)
+
         display_sender = "You" if sender == self.user_name else sender
         self.group_chat_histories[group_name].append((display_sender, message, timestamp))
 
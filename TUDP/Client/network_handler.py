@@ -1,19 +1,43 @@
+import os
 import socket
+import sys
 import threading
+import time
 import hashlib
 from datetime import datetime
 from file_transfer_handler import FileTransferHandler
 
+# Modules shared with the server live in TUDP/Common
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common import wire
+from Common.dispatch import Dispatcher
+from Common.fragmentation import Fragmenter, Reassembler, is_fragment
+from Common.reliability import HEADER_SIZE, ReliableEndpoint, is_frame
+
+RETRANSMIT_INTERVAL = 0.02  # Seconds between retransmission checks
+HEARTBEAT_INTERVAL = 10  # Seconds of silence after which a heartbeat is sent, the server evicts us after 35
+
 class NetworkHandler:
-    def __init__(self):
+    def __init__(self, reliable=True, time_handlers=False):
         self.server_address = ("127.0.0.1", 12345)
         self.buffer_size = 1024
         self.client_socket = None
         self.running = True
         self.receive_thread = None
+        # Everything but typing indicators is resent until the server acknowledges it
+        self.reliable = ReliableEndpoint(self.transmit, on_give_up=self.on_give_up) if reliable else None
+        self.retransmit_thread = None
+        self.heartbeat_thread = None
+        self.last_sent = 0.0  # time.monotonic() of the last datagram sent
+        self.resume_token = None  # (username, token) issued at login, to get the session back after an outage
+        self.reconnect_due = False  # Set when the server stopped answering
+        # Long messages are split to stay within one datagram of the server's buffer_size
+        self.fragmenter = Fragmenter(self.buffer_size - HEADER_SIZE)
+        self.reassembler = Reassembler()
         self.gui = None
         self.username_map = {}
-        self.registered_users = {}
+        # Updated in place, the GUI keeps references to both
+        self.registered_users = []
         self.groups_map = {}
 
         self.file_transfer_handler = None
@@ -21,250 +45,372 @@ class NetworkHandler:
 
         self.known_user_map = {}
 
+        # Newest message id received through history, per conversation:
+        # {("dm", other_username): id, ("group", group_name): id}
+        self.history_cursors = {}
+        self.history_oldest = {}  # Oldest message id received through history, per conversation
+        self.history_older = {}  # {conversation: False once the server said nothing older remains}
+        # Pages asked for that reach back in time (the latest page, or the one
+        # before an id), by the (scope, key) their HISTORY_END names
+        self.backward_pages = {}
+
+        # Version of the last presence change applied to username_map,
+        # None until the first snapshot arrives
+        self.presence_version = None
+
+        # With time_handlers, measures how long each message handler takes, see handler_report
+        self.dispatcher = Dispatcher(default=self.on_server_notice, timed=time_handlers)
+        self.register_handlers()
+
     def setup_network(self):
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         self.client_socket.bind(('0.0.0.0', 0))
         port = self.client_socket.getsockname()[1]
-        self.client_socket.sendto(f"connected @{port}".encode(), self.server_address)
+        # Connecting in the binary codec tells the server to answer in it too
+        self.send_wire("CONNECT", port)
         return port
 
     def start_receiving(self):
         self.receive_thread = threading.Thread(target=self.receive_messages)
         self.receive_thread.daemon = True
         self.receive_thread.start()
+        if self.reliable:
+            self.retransmit_thread = threading.Thread(target=self.retransmit_loop, daemon=True)
+            self.retransmit_thread.start()
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat_loop, daemon=True)
+        self.heartbeat_thread.start()
+
+    def send_raw(self, msg, reliable=True):
+        """Send one text message to the server, reliably unless told otherwise"""
+        self.send_bytes(msg.encode(), reliable)
+
+    def send_wire(self, name, *fields, reliable=True):
+        """Send one message in the binary wire codec, see Common/wire.py"""
+        self.send_bytes(wire.encode(name, *fields), reliable)
+
+    def send_bytes(self, payload, reliable=True):
+        self.last_sent = time.monotonic()
+        for datagram in self.fragmenter.split(payload):
+            if reliable and self.reliable:
+                self.reliable.send(self.server_address, datagram)
+            else:
+                self.client_socket.sendto(datagram, self.server_address)
 
-    def receive_messages(self):
+    def transmit(self, addr, datagram):
+        self.last_sent = time.monotonic()
+        try:
+            self.client_socket.sendto(datagram, addr)
+        except OSError:
+            pass  # Retransmitted later, or the socket is closing
+
+    def retransmit_loop(self):
         while self.running:
-            try:
-                data, _ = self.client_socket.recvfrom(self.buffer_size)
-                message = data.decode()
-                # ==== Skip ==== #
-                if (
-                        message.startswith("REQUEST_DM_HISTORY:") or
-                        message.startswith("REQUEST_MY_DM_HISTORY:") or
-                        message.startswith("DM:")
-                ):
-                    continue  # Ignore these messages in the UI
-                if message.startswith("GROUP_MSG_IN:"):
-                    try:
-                        _, group_name, sender, content = message.split(":", 3)
-                        if self.gui and hasattr(self.gui, "display_group_message"):
-                            # Use a full timestamp for sorting
-                            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-                            self.gui.root.after(0, self.gui.display_group_message, group_name, sender, content,
-                                                timestamp)
-                    except ValueError:
-                        continue
+            time.sleep(RETRANSMIT_INTERVAL)
+            self.reliable.poll()
+
+    def on_give_up(self, addr, payload):
+        # The server did not answer for several seconds, reconnect from the heartbeat thread
+        self.reconnect_due = True
+
+    def reconnect(self):
+        """Get our session back after losing the server: resumed with our
+        token if we were logged in, asking only for the DMs we missed, or a
+        fresh connection otherwise"""
+        if self.resume_token:
+            username, token = self.resume_token
+            dm_cursors = [msg_id for (scope, _), msg_id in self.history_cursors.items() if scope == "dm"]
+            self.send_wire("RESUME", username, token, max(dm_cursors, default=None))
+        else:
+            self.send_wire("CONNECT", self.get_port())
 
-                elif message.startswith("GROUP_HISTORY_MSG:"):
-                    try:
-                        _, group_name, sender, content, timestamp = message.split(":", 4)
-                        if self.gui and hasattr(self.gui, "process_group_history"):
-                            self.gui.root.after(0, self.gui.process_group_history, group_name, sender, content,
-                                                timestamp)
-                    except ValueError:
-                        continue
-                # ==== DM history ==== #
-                elif message.startswith("DM_HISTORY:"):  # Keep processing history responses
-                    try:
-                        _, sender, recipient, content, timestamp = message.split(":", 4)
-                        if self.gui and hasattr(self.gui, "process_dm_history"):
-                            self.gui.root.after(0, self.gui.process_dm_history,
-                                                sender, recipient, content, timestamp)
-                    except ValueError:
-                        continue
+    def heartbeat_loop(self):
+        """Keep the session alive while the user is only reading, and
+        reconnect once the server answers again after an outage"""
+        while self.running:
+            time.sleep(1)
+            if self.running and self.reconnect_due:
+                self.reconnect_due = False
+                try:
+                    self.reconnect()
+                except OSError:
+                    self.reconnect_due = True
+            elif self.running and time.monotonic() - self.last_sent >= HEARTBEAT_INTERVAL:
+                try:
+                    self.send_wire("HEARTBEAT", reliable=False)
+                except OSError:
+                    pass
+
+    def register_handlers(self):
+        """Fill the dispatch table, keyed on the message type.
+
+        Wire messages are keyed by name and their handlers get the decoded
+        fields. Text lines are keyed by everything before their first colon
+        and their handlers get the whole line. Lines of a [Server] message are
+        dispatched one by one, those without a handler are shown as notices.
+        """
+        handlers = {
+            # Binary wire codec
+            "CHAT_IN": self.on_chat,
+            "DM_IN": lambda fields: None,  # Not shown as it arrives, DM_NOTIFY pulls it through the history
+            "TYPING_IN": self.on_typing,
+            "GROUP_MSG_IN": self.on_group_message,
+            "DM_NOTIFY": self.on_dm_notify,
+            "HISTORY_BATCH": lambda fields: self.process_history_batch(fields[0]),
+            "DM_HISTORY": self.on_dm_history,
+            "GROUP_HISTORY_MSG": self.on_group_history,
+            "HISTORY_END": self.on_history_end,
+            "MAILBOX_END": self.on_mailbox_end,
+            "PRESENCE_JOIN": lambda fields: self.apply_presence_delta(fields[0], "JOIN", str(fields[1]), *fields[2:]),
+            "PRESENCE_RENAME": lambda fields: self.apply_presence_delta(fields[0], "RENAME", str(fields[1]),
+                                                                        fields[2]),
+            "PRESENCE_LEAVE": lambda fields: self.apply_presence_delta(fields[0], "LEAVE", str(fields[1])),
+
+            # Text protocol
+            "AUTH_RESULT": self.on_auth_result,
+            "RESUME_RESULT": self.on_resume_result,
+            "GROUPS_RESULT": self.on_groups_result,
+            "FILE_REQ": self.on_file_request,
+            "FILE_RES": self.on_file_response,
+            "[Server] USERNAME": self.on_username,
+            "[Server] RESUME_TOKEN": self.on_resume_token,
+            "[Server] SESSION_EXPIRED": lambda line: self.reconnect(),  # Evicted while we were cut off
+            "[Server] PRESENCE_SNAPSHOT": self.on_presence_snapshot,
+            "[Server] PRESENCE_VERSION": self.on_presence_version,
+            "[Server] REGISTERED_USERS": self.on_registered_users,
+            "[Server] REGISTERED_USERS_ADD": self.on_registered_user_added,
+            "[Server] GROUPS_ADD": self.on_group_added,
+            "[Server] GROUPS_LISTS": self.on_groups_list,  # Only the groups we are in, may be none
+        }
+        for message_type, handler in handlers.items():
+            self.dispatcher.register(message_type, handler)
 
-                    # ==== Skip REQUEST_DM_HISTORY from appearing in all chat ==== #
-                elif message.startswith("REQUEST_DM_HISTORY:"):
-                    continue  # Ignore these messages in the UI
-                # ==== DM Notify ==== #
-                elif message.startswith("DM_NOTIFY:"):
-                    _, from_port, to_port = message.split(":", 2)
-                    if self.gui and hasattr(self.gui, "dm_notify"):
-                        self.gui.dm_notify(from_port, to_port)
+    def receive_messages(self):
+        while self.running:
+            try:
+                data, addr = self.client_socket.recvfrom(self.buffer_size)
+                if self.reliable and is_frame(data):
+                    data = self.reliable.receive(addr, data)
+                    if data is None:  # An ack or a duplicate
                         continue
-                # ==== DM messages ==== #
-                elif message.startswith("DM:"):
-                    try:
-                        _, sender_port, dm_content = message.split(":", 2)
-                        sender = self.username_map.get(sender_port, f"User {sender_port}")
-                        # Route to DM handler in GUI
-                        if self.gui and hasattr(self.gui, "display_dm_message"):
-                            self.gui.display_dm_message(sender_port, sender, dm_content, datetime.now().strftime("%H:%M"))
-                        if not self.gui.chat_context == 'dm':
-                            self.gui.dms_btn.configure(text="DMs •")  # Add notification dot
-                        else:
-                            self.gui.dms_btn.configure(text="DMs")
-                    except ValueError:
+                if is_fragment(data):
+                    data = self.reassembler.add(addr, data)
+                    if data is None:  # More fragments to come
                         continue
-
-                # ==== AUTH messages ==== #
-                elif message.startswith("AUTH_RESULT:"):
-                    _, status, msg = message.split(":", 2)
-                    success = status == "OK"
-                    if success:
-                        if "logged in as " in msg:
-                            username = msg.split("logged in as ")[-1]
-                        elif "registered successfully" in msg:
-                            username = msg.split("registered successfully")[-1]
-                    if self.gui and hasattr(self.gui, "show_result"):
-                        self.gui.show_result(success, msg)
-
-                # === GROUPS messages ===
-                elif message.startswith("GROUPS_RESULT:"):
-                    _, status, msg = message.split(":", 2)
-                    success = status == "OK"
-
-                    if self.gui and hasattr(self.gui, "show_groups_result"):
-                        self.gui.show_groups_result(success, msg)
-
-                # ==== Server messages ==== #
-                elif message.startswith("[Server]"):
-                    for msg_part in message.split("\n"):
-                        if not msg_part.strip():
-                            continue
-
-                        # Handle USERNAME assignment
-                        if msg_part.startswith("[Server] USERNAME:"):
-                            try:
-                                _, port, username = msg_part[9:].split(":")
-                                self.username_map[port] = username
-                                self.known_user_map.update(self.username_map)
-                                if hasattr(self.gui, "update_client_list"):
-                                    self.gui.root.after(0, self.gui.update_client_list)
-                            except ValueError:
-                                pass
-                            continue  # ADDED: Stop processing this line
-
-                        # Handle CLIENTS list
-                        elif "CLIENTS:" in msg_part:  # FIXED: Check msg_part, not message
-                            try:
-                                client_info = msg_part.split("CLIENTS:")[1].split(",")
-                                new_map, new_ip_map = {}, {}
-                                for entry in client_info:
-                                    if not entry: continue
-                                    parts = entry.split(":")
-                                    if len(parts) < 2: continue
-                                    port, username = parts[0], parts[1]
-                                    if not username: username = f"Guest_{port}"
-                                    new_map[port] = username
-                                    if len(parts) > 2: new_ip_map[port] = parts[2]
-
-                                self.username_map = new_map
-                                self.port_ip_map = new_ip_map
-                                self.known_user_map.update(new_map)
-                                self.gen_all_lists(self.username_map)
-                            except (ValueError, IndexError):
-                                pass
-                            continue  # ADDED: Stop processing this line
-
-                        # Handle REGISTERED_USERS list
-                        elif "REGISTERED_USERS:" in msg_part:  # FIXED: Check msg_part, not message
-                            try:
-                                self.registered_users = msg_part.split("REGISTERED_USERS:")[1].split(",")
-                            except (ValueError, IndexError):
-                                pass
-                            continue  # ADDED: Stop processing this line
-
-                        # Handle GROUPS_LISTS
-                        elif "GROUPS_LISTS:" in msg_part:  # FIXED: Check msg_part, not message
-                            try:
-                                # ... (your existing group list parsing logic) ...
-                                # This part is complex, but the key is the 'continue' at the end
-                                new_map = {}
-                                groups_info_str = msg_part.split("GROUPS_LISTS", 1)[1]
-                                if groups_info_str.startswith(':'):
-                                    groups_info_str = groups_info_str[1:]
-                                if groups_info_str:
-                                    for group_data in groups_info_str.split(":"):
-                                        if not group_data: continue
-                                        parts = group_data.split(",", 2)
-                                        if len(parts) == 3:
-                                            group_name, group_owner, group_members = parts
-                                            new_map[group_name] = {"group_owner": group_owner,
-                                                                   "group_members": group_members}
-                                self.groups_map = new_map
-                                if hasattr(self.gui, "gen_user_groups"):
-                                    self.gui.root.after(0, self.gui.gen_user_groups)
-                            except (ValueError, IndexError):
-                                pass
-                            continue  # ADDED: Stop processing this line
-
-
-                        elif hasattr(self.gui, "display_message"):
-                            self.gui.display_message("Server", msg_part[9:], datetime.now().strftime("%H:%M"))
-
-                # ==== File transfer notifications ==== #
-                elif message.startswith("FILE_REQ:"):
-                    _, from_port, filename, filesize = message.split(":", 3)
-                    if self.gui and hasattr(self.gui, "on_file_request"):
-                        self.gui.root.after(0, self.gui.on_file_request, from_port, filename, int(filesize))
+                if wire.is_message(data):
+                    self.dispatcher.dispatch(*wire.decode(data))
                     continue
-                elif message.startswith("FILE_RES:"):
-                    _, to_port, status = message.split(":", 2)
-                    if self.gui and hasattr(self.gui, "on_file_response"):
-                        self.gui.root.after(0, self.gui.on_file_response, to_port, status)
-                    continue
-
-                # ==== Typing messages ==== #
-                elif message.startswith("typing:"):
-                    try:
-                        _, context, sender, partial = message.split(":", 3)
-                        if self.gui and hasattr(self.gui, "show_typing_text"):
-                            self.gui.root.after(0, self.gui.show_typing_text, sender, partial, context)
-                        continue  # Skip regular message processing
-                    except ValueError:
-                        continue
-
-                # ==== Regular messages ==== #
-                else:
-                    try:
-                        if ">" in message:
-                            sender, content = message.split(">", 1)
-                            if sender.strip().isdigit():
-                                sender = self.username_map.get(sender.strip(), sender.strip())
-                        else:
-                            parts = message.split(":", 1)
-                            if len(parts) == 2:
-                                port, content = parts
-                                sender = self.username_map.get(port.strip(), port.strip())
-
-                        # Display the message
-                        if hasattr(self.gui, "display_message") and sender and content:
-                            self.gui.display_message(sender.strip(), content.strip(), datetime.now().strftime("%H:%M"))
-
-                            if not self.gui.chat_context == 'all':
-                                self.gui.all_chat_btn.configure(text="All Chat •")  # Add notification dot
-                            else:
-                                self.gui.all_chat_btn.configure(text="All Chat")
-
-                            # Clear typing indicator if we have port info
-                            if hasattr(self.gui, 'clear_typing_text'):
-                                if sender.strip().isdigit():  # If sender is a port number
-                                    self.gui.clear_typing_text(int(sender.strip()))
-                    except (ValueError, IndexError):
-                        continue
+                message = data.decode()
+                for line in message.split("\n") if message.startswith("[Server]") else [message]:
+                    if line.strip():
+                        self.dispatcher.dispatch(line.partition(":")[0], line)
 
             except socket.error:
                 if self.running and hasattr(self.gui, "display_message"):
                     self.gui.display_message("System", "Connection error", datetime.now().strftime("%H:%M"))
                 else:
                     continue
-
-    def send_message(self, message, dm_recipient_port=None): # Handling messages, be it DM's or not
+            except (ValueError, IndexError):
+                continue  # A malformed message
+
+    def handler_report(self, top=10):
+        """The message handlers that took the most time, with time_handlers on"""
+        return self.dispatcher.report(top)
+
+    # ==== wire message handlers ==== #
+    def on_chat(self, fields):
+        sender, content = fields
+        if sender.isdigit():
+            sender = self.username_map.get(sender, sender)
+        if hasattr(self.gui, "display_message") and sender and content:
+            self.gui.display_message(sender.strip(), content.strip(), datetime.now().strftime("%H:%M"))
+
+            if not self.gui.chat_context == 'all':
+                self.gui.all_chat_btn.configure(text="All Chat •")  # Add notification dot
+            else:
+                self.gui.all_chat_btn.configure(text="All Chat")
+
+            # Clear typing indicator if we have port info
+            if hasattr(self.gui, 'clear_typing_text') and sender.isdigit():
+                self.gui.clear_typing_text(int(sender))
+
+    def on_typing(self, fields):
+        context, group_name, sender, partial = fields
+        if self.gui and hasattr(self.gui, "show_typing_text"):
+            self.gui.root.after(0, self.gui.show_typing_text, sender, partial, context, group_name)
+
+    def on_group_message(self, fields):
+        group_name, msg_id, sender, content = fields
+        if self.gui and hasattr(self.gui, "display_group_message"):
+            # Use a full timestamp for sorting
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+            self.gui.root.after(0, self.gui.display_group_message, group_name, sender, content,
+                                timestamp, msg_id)
+
+    def on_dm_notify(self, fields):
+        from_port, to_port, msg_id = fields
+        if self.gui and hasattr(self.gui, "dm_notify"):
+            self.gui.dm_notify(str(from_port), str(to_port), msg_id)
+
+    def on_dm_history(self, fields):
+        row = self.dm_history_row(*fields)
+        if self.gui and hasattr(self.gui, "process_dm_history"):
+            self.gui.root.after(0, self.gui.process_dm_history, *row)
+
+    def on_group_history(self, fields):
+        row = self.group_history_row(*fields)
+        if self.gui and hasattr(self.gui, "process_group_history"):
+            self.gui.root.after(0, self.gui.process_group_history, *row)
+
+    def on_history_end(self, fields):
+        if self.end_history_page(*fields) and self.gui and hasattr(self.gui, "refresh_open_chat"):
+            self.gui.root.after(0, self.gui.refresh_open_chat)
+
+    def end_history_page(self, scope, key, rows, has_more):
+        """Note whether older messages remain after a page reaching back in
+        time, True if that changed what the GUI can offer"""
+        conversation = self.backward_pages.pop((scope, key), None)
+        if conversation is None:  # A page of newer messages, its has_more says nothing about older ones
+            return False
+        older = bool(has_more)
+        changed = self.history_older.get(conversation, True) != older
+        self.history_older[conversation] = older
+        return changed
+
+    def has_older_history(self, conversation):
+        """True unless the server said there is nothing older than what we have"""
+        return conversation in self.history_oldest and self.history_older.get(conversation, True)
+
+    def request_older_history(self, conversation):
+        """Ask for the page before the oldest message we have of ("dm", username) or ("group", name)"""
+        before_id = self.history_oldest.get(conversation)
+        if before_id is None:
+            return
+        kind, key = conversation
+        if kind == "dm":
+            my_username = self.username_map.get(str(self.get_port()))
+            if my_username:
+                self.request_dm_history(my_username, key, before_id=before_id)
+        else:
+            self.request_group_history(key, before_id=before_id)
+
+    def on_mailbox_end(self, fields):
+        """DMs sent while we were offline arrived, up to this id: the server can drop them"""
+        last_id = fields[0]
+        self.send_wire("MAILBOX_ACK", last_id)
+
+    # ==== text message handlers ==== #
+    def on_auth_result(self, message):
+        _, status, msg = message.split(":", 2)
+        if self.gui and hasattr(self.gui, "show_result"):
+            self.gui.show_result(status == "OK", msg)
+
+    def on_resume_result(self, message):
+        _, status, msg = message.split(":", 2)
+        if status != "OK":
+            # Back as a guest, the user has to log in again
+            self.resume_token = None
+            self.send_wire("CONNECT", self.get_port())
+        if hasattr(self.gui, "display_message"):
+            self.gui.display_message("System", msg, datetime.now().strftime("%H:%M"))
+
+    def on_resume_token(self, line):
+        # [Server] RESUME_TOKEN:<username>:<token>
+        _, username, token = line[9:].split(":")
+        self.resume_token = (username, token)
+
+    def on_groups_result(self, message):
+        _, status, msg = message.split(":", 2)
+        if self.gui and hasattr(self.gui, "show_groups_result"):
+            self.gui.show_groups_result(status == "OK", msg)
+
+    def on_file_request(self, message):
+        _, from_port, filename, filesize = message.split(":", 3)
+        if self.gui and hasattr(self.gui, "on_file_request"):
+            self.gui.root.after(0, self.gui.on_file_request, from_port, filename, int(filesize))
+
+    def on_file_response(self, message):
+        _, to_port, status = message.split(":", 2)
+        if self.gui and hasattr(self.gui, "on_file_response"):
+            self.gui.root.after(0, self.gui.on_file_response, to_port, status)
+
+    def on_server_notice(self, message_type, line):
+        if isinstance(line, str) and line.startswith("[Server]") and hasattr(self.gui, "display_message"):
+            self.gui.display_message("Server", line[9:], datetime.now().strftime("%H:%M"))
+
+    def on_username(self, line):
+        # [Server] USERNAME:<port>:<username>, our own name
+        _, port, username = line[9:].split(":")
+        self.username_map[port] = username
+        self.known_user_map.update(self.username_map)
+        if hasattr(self.gui, "update_client_list"):
+            self.gui.root.after(0, self.gui.update_client_list)
+
+    def on_presence_snapshot(self, line):
+        _, version, client_info = line[9:].split(":", 2)
+        self.apply_client_list(client_info)
+        self.presence_version = int(version)
+
+    def on_presence_version(self, line):
+        if int(line.split(":", 1)[1]) != self.presence_version:
+            self.request_presence_snapshot()
+
+    def on_registered_users(self, line):
+        self.registered_users[:] = line.split(":", 1)[1].split(",")
+        self.gen_all_lists(self.username_map)
+
+    def on_registered_user_added(self, line):
+        # A user registered since REGISTERED_USERS was sent
+        username = line.split(":", 1)[1]
+        if username and username not in self.registered_users:
+            self.registered_users.append(username)
+            self.gen_all_lists(self.username_map)
+
+    def on_group_added(self, line):
+        # A group we were just added to
+        parts = line.split(":", 1)[1].split(",", 2)
+        if len(parts) == 3:
+            group_name, group_owner, group_members = parts
+            self.groups_map[group_name] = {"group_owner": group_owner,
+                                           "group_members": group_members}
+            if hasattr(self.gui, "gen_user_groups"):
+                self.gui.root.after(0, self.gui.gen_user_groups)
+
+    def on_groups_list(self, line):
+        new_map = {}
+        for group_data in line.split(":")[1:]:
+            parts = group_data.split(",", 2)
+            if len(parts) == 3:
+                group_name, group_owner, group_members = parts
+                new_map[group_name] = {"group_owner": group_owner,
+                                       "group_members": group_members}
+        self.groups_map.clear()
+        self.groups_map.update(new_map)
+        if hasattr(self.gui, "gen_user_groups"):
+            self.gui.root.after(0, self.gui.gen_user_groups)
+
+    def send_message(self, message, dm_recipient_port=None, dm_recipient_name=None): # Handling messages, be it DM's or not
         try:
-            if dm_recipient_port is not None:
-                msg = f"DM:{dm_recipient_port}:{message}"
+            if dm_recipient_name is not None:
+                # A registered user who is offline, the server keeps it in their mailbox
+                self.send_wire("DM_TO", dm_recipient_name, message)
+            elif dm_recipient_port is not None:
+                # Between registered users DMs go by username, and wait on the server if the peer logs off
+                my_username = self.username_map.get(str(self.get_port()), "")
+                recipient = self.username_map.get(str(dm_recipient_port), "")
+                if my_username in self.registered_users and recipient in self.registered_users:
+                    self.send_wire("DM_TO", recipient, message)
+                else:
+                    self.send_wire("DM", int(dm_recipient_port), message)
             else:
-                msg = message
-            self.client_socket.sendto(msg.encode(), self.server_address)
+                self.send_wire("CHAT", message)
         except socket.error as e:
             self.gui.display_message("System", f"Failed to send message: {e}", datetime.now().strftime("%H:%M"))
 
-    def send_typing(self, text, context="all"):
-        typing_msg = f"typing:{context}:{text}"
-        self.client_socket.sendto(typing_msg.encode(), self.server_address)
+    def send_typing(self, text, context="all", target=""):
+        """`target` is the DM peer's port or the group name, the server only relays to them"""
+        # Unreliable, the next keystroke replaces it anyway
+        self.send_wire("TYPING", context, str(target or ""), text, reliable=False)
 
     def send_auth(self, action, username=None, password=None):
         if action == "enter":
@@ -272,7 +418,7 @@ class NetworkHandler:
         else:
             encrypted_password = hashlib.sha256(password.encode()).hexdigest()
             msg = f"AUTH:{action}:{username}:{encrypted_password}"
-        self.client_socket.sendto(msg.encode(), self.server_address)
+        self.send_raw(msg)
 
     def send_group(self, action, group_name, group_owner, group_member_list):
         group_member_output = ""
@@ -288,7 +434,7 @@ class NetworkHandler:
         elif action == "manage":
             print("Manage group in database")
 
-        self.client_socket.sendto(msg.encode(), self.server_address)
+        self.send_raw(msg)
 
 
     def get_port(self):
@@ -297,18 +443,66 @@ class NetworkHandler:
     def on_closing(self):
         if self.client_socket:
             port = self.get_port()
-            self.client_socket.sendto(f"disconnect @{port}".encode(), self.server_address)
+            self.send_raw(f"disconnect @{port}", reliable=False)  # No time left to retransmit
             self.running = False
             self.client_socket.close()
 
     # File Transfer Methods
     def send_file_request(self, recipient_port, filename, filesize):
         msg = f"FILE_REQ:{recipient_port}:{filename}:{filesize}"
-        self.client_socket.sendto(msg.encode(), self.server_address)
+        self.send_raw(msg)
 
     def send_file_response(self, sender_port, accepted):
         msg = f"FILE_RES:{sender_port}:{'ACCEPT' if accepted else 'REJECT'}"
-        self.client_socket.sendto(msg.encode(), self.server_address)
+        self.send_raw(msg)
+
+    # Presence
+    def apply_client_list(self, client_info):
+        """Replace the online users with a `port:username:ip,...` list"""
+        new_map, new_ip_map = {}, {}
+        for entry in client_info.split(","):
+            if not entry: continue
+            parts = entry.split(":")
+            if len(parts) < 2: continue
+            port, username = parts[0], parts[1]
+            if not username: username = f"Guest_{port}"
+            new_map[port] = username
+            if len(parts) > 2: new_ip_map[port] = parts[2]
+
+        self.username_map = new_map
+        self.port_ip_map = new_ip_map
+        self.known_user_map.update(new_map)
+        self.gen_all_lists(self.username_map)
+
+    def apply_presence_delta(self, version, kind, port, username=None, ip=None):
+        """A PRESENCE_JOIN, PRESENCE_RENAME or PRESENCE_LEAVE message, `kind` is JOIN, RENAME or LEAVE.
+
+        Deltas must be applied in order. Old or repeated ones are ignored, and
+        when one was missed the whole list is requested again.
+        """
+        if self.presence_version is None or version <= self.presence_version:
+            return
+        if version != self.presence_version + 1:
+            self.request_presence_snapshot()
+            return
+
+        if kind == "JOIN":
+            self.username_map[port] = username or f"Guest_{port}"
+            self.port_ip_map[port] = ip
+        elif kind == "RENAME":
+            self.username_map[port] = username
+        elif kind == "LEAVE":
+            self.username_map.pop(port, None)
+            self.port_ip_map.pop(port, None)
+        self.presence_version = version
+        self.known_user_map.update(self.username_map)
+        self.gen_all_lists(self.username_map)
+
+    def request_presence_snapshot(self):
+        try:
+            self.send_raw(f"PRESENCE_SYNC:{self.presence_version or 0}", reliable=False)
+        except socket.error:
+            pass
 
     # === Generates all the lists from the default client_list
     def gen_all_lists(self, client_list):
@@ -354,17 +548,85 @@ class NetworkHandler:
     def send_group_message(self, group_name, message):
         """Sends a chat message to a specific group."""
         try:
-            msg = f"GROUP_MSG:{group_name}:{message}"
-            self.client_socket.sendto(msg.encode(), self.server_address)
+            self.send_wire("GROUP_MSG", group_name, message)
         except socket.error as e:
             if self.gui:
                 self.gui.display_message("System", f"Failed to send group message: {e}", "Error")
 
-    def request_group_history(self, group_name):
-        """Requests the chat history for a specific group from the server."""
+    def request_group_history(self, group_name, since_id=None, before_id=None):
+        """Requests a page of chat history for a specific group from the server.
+
+        With `since_id` only newer messages are sent, with `before_id` the page
+        before it, and with neither the latest page.
+        """
         try:
-            msg = f"REQUEST_GROUP_HISTORY:{group_name}"
-            self.client_socket.sendto(msg.encode(), self.server_address)
+            if since_id is None:
+                self.backward_pages[("GROUP", group_name)] = ("group", group_name)
+            self.send_wire("REQUEST_GROUP_HISTORY", group_name, since_id, before_id, None)
         except socket.error as e:
             if self.gui:
-                self.gui.display_message("System", f"Failed to request group history: {e}", "Error")
\ No newline at end of file
+                self.gui.display_message("System", f"Failed to request group history: {e}", "Error")
+
+    # History rows
+    def dm_history_row(self, msg_id, sender, recipient, content, timestamp):
+        """A DM_HISTORY message -> (sender, recipient, content, timestamp, id)"""
+        my_username = self.username_map.get(str(self.get_port()))
+        other_user = recipient if sender == my_username else sender
+        self.advance_cursor(("dm", other_user), msg_id)
+        self.note_oldest(("dm", other_user), msg_id)
+        return sender, recipient, content, timestamp, msg_id
+
+    def group_history_row(self, group_name, msg_id, sender, content, timestamp):
+        """A GROUP_HISTORY_MSG message -> (group, sender, content, timestamp, id)"""
+        self.advance_cursor(("group", group_name), msg_id)
+        self.note_oldest(("group", group_name), msg_id)
+        return group_name, sender, content, timestamp, msg_id
+
+    def process_history_batch(self, records):
+        """Unpack the records of a HISTORY_BATCH and hand all of its rows to the GUI in one call"""
+        dm_rows, group_rows = [], []
+        mailbox_end = None
+        older_changed = False
+        for record in records:
+            try:
+                name, fields = wire.decode(record)
+            except ValueError:
+                continue
+            if name == "DM_HISTORY":
+                dm_rows.append(self.dm_history_row(*fields))
+            elif name == "GROUP_HISTORY_MSG":
+                group_rows.append(self.group_history_row(*fields))
+            elif name == "HISTORY_END":
+                older_changed = self.end_history_page(*fields) or older_changed
+            elif name == "MAILBOX_END":
+                mailbox_end = fields
+
+        if dm_rows and self.gui and hasattr(self.gui, "process_dm_history_batch"):
+            self.gui.root.after(0, self.gui.process_dm_history_batch, dm_rows)
+        if group_rows and self.gui and hasattr(self.gui, "process_group_history_batch"):
+            self.gui.root.after(0, self.gui.process_group_history_batch, group_rows)
+        if older_changed and not (dm_rows or group_rows) and self.gui and hasattr(self.gui, "refresh_open_chat"):
+            self.gui.root.after(0, self.gui.refresh_open_chat)  # Nothing else redraws it
+        if mailbox_end is not None:
+            self.on_mailbox_end(mailbox_end)
+
+    # History cursors
+    def advance_cursor(self, key, msg_id):
+        if msg_id > self.history_cursors.get(key, 0):
+            self.history_cursors[key] = msg_id
+
+    def reset_cursor(self, key):
+        self.history_cursors.pop(key, None)
+
+    def note_oldest(self, key, msg_id):
+        if msg_id < self.history_oldest.get(key, msg_id + 1):
+            self.history_oldest[key] = msg_id
+
+    def request_dm_history(self, my_username, other_username, since_id=None, before_id=None):
+        """Requests a page of DM history between two users, see request_group_history"""
+        try:
+            if since_id is None:
+                self.backward_pages[("DM", f"{my_username},{other_username}")] = ("dm", other_username)
+            self.send_wire("REQUEST_DM_HISTORY", my_username, other_username, since_id, before_id, None)
+        except socket.error as e:
+            self.gui.display_message("System", f"Failed to send message: {e}", datetime.now().strftime("%H:%M"))
@@ -0,0 +1,90 @@
+import time
+import types
+
+
+class Dispatcher:
+    """Routes each message to the handler registered for its type.
+
+    Finding a handler is one dict lookup, however many are registered. With
+    `timed` on, every call is also measured: `stats` keeps the calls and
+    seconds per message type, and each measurement is passed to the
+    `hooks`, as hook(message type, seconds). A handler that returns a
+    coroutine is measured while the coroutine runs, time spent waiting on
+    its awaits is not counted, so the totals are the time each handler kept
+    the event loop busy.
+    """
+
+    def __init__(self, default=None, timed=False):
+        self.handlers = {}
+        self.default = default  # Called as default(type, *args) for unregistered types
+        self.timed = timed
+        self.hooks = []
+        self.stats = {}  # {message type: [calls, seconds]}
+
+    def register(self, message_type, handler):
+        self.handlers[message_type] = handler
+
+    def dispatch(self, message_type, *args):
+        """Call the handler for `message_type`, returns what it returns"""
+        handler = self.handlers.get(message_type)
+        if handler is None:
+            if self.default is None:
+                return None
+            return self.default(message_type, *args)
+        if not self.timed:
+            return handler(*args)
+
+        started = time.perf_counter()
+        result = handler(*args)
+        self._record(message_type, time.perf_counter() - started)
+        if isinstance(result, types.CoroutineType):
+            result = _timed_coroutine(result, lambda seconds: self._record(message_type, seconds, calls=0))
+        return result
+
+    def _record(self, message_type, seconds, calls=1):
+        stat = self.stats.get(message_type)
+        if stat is None:
+            stat = self.stats[message_type] = [0, 0.0]
+        stat[0] += calls
+        stat[1] += seconds
+        for hook in self.hooks:
+            hook(message_type, seconds)
+
+    def report(self, top=10):
+        """Lines naming the handlers that took the most time, busiest first"""
+        total = sum(seconds for _, seconds in self.stats.values()) or 1.0
+        busiest = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        return [f"{message_type:<24} {calls:>8} calls {seconds * 1000:>10.1f} ms "
+                f"{seconds / calls * 1e6 if calls else 0:>8.1f} us/call {seconds / total:>6.1%}"
+                for message_type, (calls, seconds) in busiest]
+
+    def reset(self):
+        self.stats.clear()
+
+
+async def _timed_coroutine(coro, record):
+    """Run `coro`, passing the time each of its steps took to `record`"""
+    return await _timed_steps(coro, record)
+
+
+@types.coroutine
+def _timed_steps(coro, record):
+    value, error = None, None
+    while True:
+        started = time.perf_counter()
+        try:
+            if error is None:
+                future = coro.send(value)
+            else:
+                future = coro.throw(error)
+        except StopIteration as stop:
+            record(time.perf_counter() - started)
+            return stop.value
+        except BaseException:
+            record(time.perf_counter() - started)
+            raise
+        record(time.perf_counter() - started)
+        try:
+            value, error = (yield future), None
+        except BaseException as e:
+            value, error = None, e
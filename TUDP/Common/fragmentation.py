@@ -0,0 +1,146 @@
+import os
+import struct
+import time
+from collections import OrderedDict
+
+# A fragment starts with a byte no text message starts with, like the frames
+# of the reliability layer. Fragments travel inside reliable frames when that
+# layer is in use, so a lost fragment is resent on its own.
+FRAGMENT = 0x03
+# type, message id, fragment index, fragment count
+FRAGMENT_HEADER = struct.Struct("!BIHH")
+
+
+def is_fragment(data):
+    return len(data) >= FRAGMENT_HEADER.size and data[0] == FRAGMENT
+
+
+class Fragmenter:
+    """Splits payloads too big for one datagram into numbered fragments.
+
+    `max_datagram` is the biggest datagram the receiver can read, minus any
+    header added after this one. Payloads that fit are sent untouched.
+    """
+
+    def __init__(self, max_datagram):
+        self.max_datagram = max_datagram
+        self.chunk_size = max_datagram - FRAGMENT_HEADER.size
+        self.next_id = int.from_bytes(os.urandom(4), "big")
+
+    def split(self, payload):
+        if len(payload) <= self.max_datagram:
+            return [payload]
+        message_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        chunks = [payload[i:i + self.chunk_size] for i in range(0, len(payload), self.chunk_size)]
+        if len(chunks) > 0xFFFF:
+            raise ValueError(f"payload of {len(payload)} bytes needs too many fragments")
+        return [FRAGMENT_HEADER.pack(FRAGMENT, message_id, index, len(chunks)) + chunk
+                for index, chunk in enumerate(chunks)]
+
+
+class _Partial:
+    __slots__ = ("chunks", "count", "size", "started")
+
+    def __init__(self, count, started):
+        self.chunks = {}
+        self.count = count
+        self.size = 0
+        self.started = started
+
+
+class Reassembler:
+    """Puts fragmented payloads back together.
+
+    A payload still incomplete `timeout` seconds after its first fragment is
+    dropped. Payloads over `max_message` bytes are refused, and when the
+    partial payloads of all senders together pass `max_buffered` bytes, or one
+    sender has more than `max_partials_per_peer` in flight, the oldest are
+    dropped to make room. `on_refused(addr)` is told about each payload
+    refused for its size.
+    """
+
+    def __init__(self, timeout=15.0, max_message=1 << 20, max_buffered=8 << 20, max_partials_per_peer=32,
+                 on_refused=None, clock=time.monotonic):
+        self.timeout = timeout
+        self.max_message = max_message
+        self.max_buffered = max_buffered
+        self.max_partials_per_peer = max_partials_per_peer
+        self.on_refused = on_refused
+        self.clock = clock
+        self.partials = OrderedDict()  # {(addr, message id): _Partial}, oldest first
+        # Payloads finished or given up on recently, their late fragments are ignored
+        self.finished = OrderedDict()  # {(addr, message id): time}
+        self.per_peer = {}  # {addr: number of partials}
+        self.buffered = 0
+        self.stats = {"reassembled": 0, "expired": 0, "evicted": 0, "refused": 0}
+
+    def add(self, addr, data):
+        """Store one fragment, returns the whole payload once its last fragment arrives"""
+        now = self.clock()
+        self._expire(now)
+        _, message_id, index, count = FRAGMENT_HEADER.unpack_from(data)
+        chunk = data[FRAGMENT_HEADER.size:]
+        if index >= count:
+            return None
+
+        key = (addr, message_id)
+        if key in self.finished:
+            return None
+        partial = self.partials.get(key)
+        if partial is None:
+            if self.per_peer.get(addr, 0) >= self.max_partials_per_peer:
+                self._drop(self._oldest_of(addr), "evicted")
+            partial = self.partials[key] = _Partial(count, now)
+            self.per_peer[addr] = self.per_peer.get(addr, 0) + 1
+        if index in partial.chunks or count != partial.count:
+            return None
+
+        if partial.size + len(chunk) > self.max_message:
+            self._drop(key, "refused")
+            if self.on_refused is not None:
+                self.on_refused(addr)
+            return None
+        partial.chunks[index] = chunk
+        partial.size += len(chunk)
+        self.buffered += len(chunk)
+        while self.buffered > self.max_buffered and self.partials:
+            oldest = next(iter(self.partials))
+            self._drop(oldest, "evicted")
+            if oldest == key:
+                return None
+
+        if len(partial.chunks) < partial.count:
+            return None
+        self._drop(key, "reassembled")
+        return b"".join(partial.chunks[i] for i in range(partial.count))
+
+    def forget(self, addr):
+        for key in [key for key in self.partials if key[0] == addr]:
+            self._drop(key, None)
+
+    def _oldest_of(self, addr):
+        return next(key for key in self.partials if key[0] == addr)
+
+    def _expire(self, now):
+        while self.partials:
+            key, partial = next(iter(self.partials.items()))
+            if now - partial.started < self.timeout:
+                break
+            self._drop(key, "expired")
+        while self.finished:
+            key, finished_at = next(iter(self.finished.items()))
+            if now - finished_at < self.timeout and len(self.finished) <= 4096:
+                break
+            del self.finished[key]
+
+    def _drop(self, key, reason):
+        partial = self.partials.pop(key)
+        self.buffered -= partial.size
+        addr = key[0]
+        self.per_peer[addr] -= 1
+        if not self.per_peer[addr]:
+            del self.per_peer[addr]
+        if reason:
+            self.stats[reason] += 1
+            self.finished[key] = self.clock()
@@ -0,0 +1,326 @@
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+# Reliable datagrams start with a byte no text message starts with, so they
+# can share a socket with plain best-effort traffic.
+DATA = 0x02
+ACK = 0x06
+
+# DATA: type, sender's stream id, sequence number, base, payload.
+# `base` is the sender's oldest unacknowledged sequence number; everything
+# before it was delivered or given up on, so the receiver never waits for it.
+DATA_HEADER = struct.Struct("!BIII")
+# ACK: type, stream id being acknowledged, cumulative ack, selective ack bitmap.
+# Bit i of the bitmap acknowledges sequence number cumulative + 2 + i.
+ACK_FRAME = struct.Struct("!BIII")
+HEADER_SIZE = DATA_HEADER.size
+
+
+def is_frame(data):
+    return len(data) >= DATA_HEADER.size and data[0] in (DATA, ACK)
+
+
+class _Pending:
+    __slots__ = ("payload", "datagram", "sent_at", "tries", "fast_retransmitted")
+
+    def __init__(self, payload, datagram, sent_at):
+        self.payload = payload
+        self.datagram = datagram
+        self.sent_at = sent_at
+        self.tries = 0
+        self.fast_retransmitted = False
+
+
+class _Peer:
+    def __init__(self, initial_window, max_window, initial_rto, now):
+        # Sending side. A new stream id each time, so a peer we forgot and
+        # start over with does not take our sequence numbers for duplicates.
+        self.stream_id = int.from_bytes(os.urandom(4), "big")
+        self.next_seq = 1
+        self.unacked = {}  # {seq: _Pending}, in sending order
+        self.waiting = deque()  # Payloads that do not fit in the window yet
+        self.cwnd = float(initial_window)
+        self.ssthresh = float(max_window)
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.recovery_until = 0  # No further window cuts until this seq is acknowledged
+        self.last_active = now  # When we last sent to or heard from this peer
+        self.given_up = 0  # Payloads given up on
+        self.waiters = []  # (first seq not waited for, given_up then, callback) of when_delivered
+
+        # Receiving side
+        self.stream = None
+        self.cumulative = 0  # Every seq up to this one arrived
+        self.received = set()  # Seqs past `cumulative` that arrived
+
+    def base(self):
+        return next(iter(self.unacked), self.next_seq)
+
+
+class ReliableEndpoint:
+    """Sequence numbers, acknowledgements and retransmission over UDP, per peer.
+
+    It does no I/O itself: datagrams go out through `transmit(addr, datagram)`
+    and incoming ones are handed to `receive`, which returns the payload to
+    process, or None for acknowledgements and duplicates. `poll` must be called
+    every few tens of milliseconds to retransmit what timed out.
+
+    Each peer gets its own sequence numbers. The receiver acknowledges the
+    highest in-order sequence number plus a bitmap of the 32 after it, so
+    losses are retransmitted selectively. Payloads are delivered as they
+    arrive, duplicates are dropped. The retransmission timeout adapts to the
+    measured round trip (Jacobson/Karels, Karn's rule) and backs off
+    exponentially; a payload is given up on after `max_retries`, and reported
+    to `on_give_up(addr, payload)`. New payloads only go out while fewer than
+    the congestion window are unacknowledged: it grows with every ack (slow
+    start, then additive increase) and is halved on loss, down to one
+    datagram on a timeout.
+
+    `when_delivered(addr, callback)` tells when everything sent to a peer
+    so far got through, to send what must not arrive before it.
+
+    `receive` can be given an `accept(payload)` check, run on new payloads
+    before they are acknowledged: a payload it refuses is dropped unacked,
+    and the sender retransmits it later with backoff, like a lost one.
+
+    With `idle_timeout`, `poll` also forgets peers with nothing in flight
+    that were neither sent to nor heard from for that many seconds, so
+    addresses that sent a datagram or two and went away do not stay.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, transmit, on_give_up=None, initial_window=4, max_window=64, initial_rto=0.5,
+                 min_rto=0.2, max_rto=3.0, max_retries=8, receive_window=1024, idle_timeout=None,
+                 clock=time.monotonic):
+        self.transmit = transmit
+        self.on_give_up = on_give_up
+        self.initial_window = initial_window
+        self.max_window = max_window
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.max_retries = max_retries
+        self.receive_window = receive_window
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.next_expiry = clock() + idle_timeout if idle_timeout else None
+        self.peers = {}
+        self.lock = threading.Lock()
+        self.stats = {"sent": 0, "retransmitted": 0, "acked": 0, "delivered": 0,
+                      "duplicates": 0, "out_of_window": 0, "refused": 0, "given_up": 0, "expired": 0}
+
+    def _peer(self, addr):
+        now = self.clock()
+        peer = self.peers.get(addr)
+        if peer is None:
+            peer = self.peers[addr] = _Peer(self.initial_window, self.max_window, self.initial_rto, now)
+        else:
+            peer.last_active = now
+        return peer
+
+    def knows(self, addr):
+        """True once `addr` has sent us reliable traffic, so it understands it too"""
+        peer = self.peers.get(addr)
+        return peer is not None and peer.stream is not None
+
+    def forget(self, addr):
+        with self.lock:
+            peer = self.peers.pop(addr, None)
+            if peer is not None:
+                for _, _, callback in peer.waiters:
+                    callback(False)
+
+    def when_delivered(self, addr, callback):
+        """Call `callback(delivered)` once every payload sent to `addr` so far
+        is through: True if all were acknowledged, False if one was given up
+        on or the peer was forgotten. It runs with the lock held, so it must
+        not call the endpoint."""
+        with self.lock:
+            peer = self.peers.get(addr)
+            if peer is None:
+                callback(True)
+                return
+            peer.waiters.append((peer.next_seq + len(peer.waiting), peer.given_up, callback))
+            self._notify(peer)
+
+    @staticmethod
+    def _notify(peer):
+        if not peer.waiters:
+            return
+        base = peer.base()
+        waiting = []
+        for mark, given_up, callback in peer.waiters:
+            if base >= mark:
+                callback(peer.given_up == given_up)
+            else:
+                waiting.append((mark, given_up, callback))
+        peer.waiters = waiting
+
+    # ==== sending ==== #
+    def send(self, addr, payload):
+        with self.lock:
+            peer = self._peer(addr)
+            peer.waiting.append(payload)
+            self._fill_window(addr, peer)
+
+    def _fill_window(self, addr, peer):
+        while peer.waiting and len(peer.unacked) < int(peer.cwnd):
+            payload = peer.waiting.popleft()
+            seq = peer.next_seq
+            peer.next_seq += 1
+            pending = _Pending(payload, None, self.clock())
+            peer.unacked[seq] = pending
+            pending.datagram = DATA_HEADER.pack(DATA, peer.stream_id, seq, peer.base()) + payload
+            self.stats["sent"] += 1
+            self.transmit(addr, pending.datagram)
+
+    def _retransmit(self, addr, peer, seq, pending, now):
+        # Refresh the base, the receiver may have forgotten what came before it
+        pending.datagram = DATA_HEADER.pack(DATA, peer.stream_id, seq, peer.base()) + pending.payload
+        pending.sent_at = now
+        pending.tries += 1
+        self.stats["retransmitted"] += 1
+        self.transmit(addr, pending.datagram)
+
+    def poll(self):
+        """Retransmit or give up on everything whose timeout passed"""
+        given_up = []
+        with self.lock:
+            now = self.clock()
+            for addr, peer in list(self.peers.items()):
+                timed_out = False
+                for seq, pending in list(peer.unacked.items()):
+                    if now - pending.sent_at < min(peer.rto * 2 ** pending.tries, self.max_rto):
+                        continue
+                    timed_out = True
+                    if pending.tries >= self.max_retries:
+                        del peer.unacked[seq]
+                        peer.given_up += 1
+                        self.stats["given_up"] += 1
+                        given_up.append((addr, pending.payload))
+                    else:
+                        self._retransmit(addr, peer, seq, pending, now)
+                if timed_out:
+                    peer.ssthresh = max(len(peer.unacked) / 2, 2.0)
+                    peer.cwnd = 1.0
+                    peer.recovery_until = peer.next_seq - 1
+                    self._fill_window(addr, peer)
+                    self._notify(peer)
+            if self.next_expiry is not None and now >= self.next_expiry:
+                self._expire(now)
+        if self.on_give_up:
+            for addr, payload in given_up:
+                self.on_give_up(addr, payload)
+
+    def _expire(self, now):
+        for addr, peer in list(self.peers.items()):
+            if not peer.unacked and not peer.waiting and now - peer.last_active >= self.idle_timeout:
+                del self.peers[addr]
+                self.stats["expired"] += 1
+        self.next_expiry = now + self.idle_timeout / 4
+
+    # ==== receiving ==== #
+    def receive(self, addr, data, accept=None):
+        """Process a reliable frame, returns its payload if it is new and `accept` takes it"""
+        with self.lock:
+            if data[0] == ACK:
+                if len(data) >= ACK_FRAME.size:
+                    self._on_ack(addr, *ACK_FRAME.unpack_from(data)[1:])
+                return None
+
+            _, stream, seq, base = DATA_HEADER.unpack_from(data)
+            peer = self._peer(addr)
+            if stream != peer.stream:
+                # First datagram from this peer, or it restarted
+                peer.stream = stream
+                peer.cumulative = base - 1
+                peer.received.clear()
+            if base - 1 > peer.cumulative:
+                peer.cumulative = base - 1
+                peer.received = {s for s in peer.received if s > peer.cumulative}
+
+            if seq <= peer.cumulative or seq in peer.received:
+                self.stats["duplicates"] += 1
+                self._send_ack(addr, peer)
+                return None
+            if seq > peer.cumulative + self.receive_window:
+                self.stats["out_of_window"] += 1
+                return None
+            payload = data[DATA_HEADER.size:]
+            if accept is not None and not accept(payload):
+                self.stats["refused"] += 1
+                return None
+
+            peer.received.add(seq)
+            while peer.cumulative + 1 in peer.received:
+                peer.cumulative += 1
+                peer.received.discard(peer.cumulative)
+            self.stats["delivered"] += 1
+            self._send_ack(addr, peer)
+            return payload
+
+    def _send_ack(self, addr, peer):
+        bitmap = 0
+        for seq in peer.received:
+            offset = seq - peer.cumulative - 2
+            if 0 <= offset < 32:
+                bitmap |= 1 << offset
+        self.transmit(addr, ACK_FRAME.pack(ACK, peer.stream, peer.cumulative, bitmap))
+
+    def _on_ack(self, addr, stream, cumulative, bitmap):
+        peer = self.peers.get(addr)
+        if peer is None or stream != peer.stream_id or not peer.unacked:
+            return
+        now = peer.last_active = self.clock()
+        acked = [seq for seq in peer.unacked if seq <= cumulative]
+        highest_sacked = cumulative
+        for offset in range(32):
+            if bitmap >> offset & 1:
+                seq = cumulative + 2 + offset
+                highest_sacked = seq
+                if seq in peer.unacked:
+                    acked.append(seq)
+
+        rtt = None
+        for seq in acked:
+            pending = peer.unacked.pop(seq)
+            if pending.tries == 0:  # Karn: a retransmitted datagram's rtt is ambiguous
+                rtt = now - pending.sent_at
+            self.stats["acked"] += 1
+            if peer.cwnd < peer.ssthresh:
+                peer.cwnd += 1
+            else:
+                peer.cwnd += 1 / peer.cwnd
+        peer.cwnd = min(peer.cwnd, float(self.max_window))
+        if rtt is not None:
+            self._sample_rtt(peer, rtt)
+        self._notify(peer)
+
+        # Three later datagrams arrived but this one did not: it was lost
+        for seq, pending in list(peer.unacked.items()):
+            if seq + 3 > highest_sacked:
+                break
+            if pending.fast_retransmitted:
+                continue
+            pending.fast_retransmitted = True
+            if seq > peer.recovery_until:
+                peer.ssthresh = max(len(peer.unacked) / 2, 2.0)
+                peer.cwnd = peer.ssthresh
+                peer.recovery_until = peer.next_seq - 1
+            self._retransmit(addr, peer, seq, pending, now)
+
+        self._fill_window(addr, peer)
+
+    def _sample_rtt(self, peer, rtt):
+        if peer.srtt is None:
+            peer.srtt = rtt
+            peer.rttvar = rtt / 2
+        else:
+            peer.rttvar = 0.75 * peer.rttvar + 0.25 * abs(peer.srtt - rtt)
+            peer.srtt = 0.875 * peer.srtt + 0.125 * rtt
+        peer.rto = min(max(peer.srtt + max(4 * peer.rttvar, 0.01), self.min_rto), self.max_rto)
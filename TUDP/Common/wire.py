@@ -0,0 +1,212 @@
+import operator
+import struct
+
+# Binary messages start with a byte no text message starts with, like the
+# frames of the reliability and fragmentation layers, then the codec version
+# and the message type.
+MESSAGE = 0x04
+VERSION = 1
+HEADER = struct.Struct("!BBB")
+
+# Field kinds. Integers are big-endian; a kind ending in "?" is optional and
+# sends None as 0. "str" is up to 255 bytes of UTF-8 (names, timestamps), with
+# a one byte length. "text" (message content) has no length: a message has at
+# most one, sent last, and it runs to the end of the datagram. "records" is a
+# list of already encoded messages, it must be the only field.
+_INTEGERS = {"u8": "B", "u16": "H", "u32": "I", "u64": "Q"}
+RECORD_LENGTH = struct.Struct("!H")
+
+# name: (type byte, fields, the same message in the text protocol)
+MESSAGES = {
+    # Client to server
+    "CONNECT": (0x01, ("u16",), "connected @{}"),
+    "HEARTBEAT": (0x02, (), "HEARTBEAT:"),  # Sent when the client was quiet, so the server keeps its session
+    "CHAT": (0x10, ("text",), "{}"),
+    "DM": (0x11, ("u16", "text"), "DM:{}:{}"),
+    "GROUP_MSG": (0x12, ("str", "text"), "GROUP_MSG:{}:{}"),
+    "TYPING": (0x13, ("str", "str", "text"), "typing:{}:{}:{}"),
+    # user, other user, since id, before id, limit
+    "REQUEST_DM_HISTORY": (0x14, ("str", "str", "u64?", "u64?", "u16?"), "REQUEST_DM_HISTORY:{}:{}:{}:{}:{}"),
+    "REQUEST_MY_DM_HISTORY": (0x15, ("str", "u64?", "u64?", "u16?"), "REQUEST_MY_DM_HISTORY:{}:{}:{}:{}"),
+    "REQUEST_GROUP_HISTORY": (0x16, ("str", "u64?", "u64?", "u16?"), "REQUEST_GROUP_HISTORY:{}:{}:{}:{}"),
+    "DM_TO": (0x17, ("str", "text"), "DM_TO:{}:{}"),  # recipient username, content; queued while they are offline
+    "MAILBOX_ACK": (0x18, ("u64",), "MAILBOX_ACK:{}"),  # every queued DM up to this id was received
+    # username, resume token, id of the newest DM the client has
+    "RESUME": (0x19, ("str", "str", "u64?"), "RESUME:{}:{}:{}"),
+
+    # Server to client
+    "CHAT_IN": (0x20, ("str", "text"), "{}> {}"),  # sender, content
+    "DM_IN": (0x21, ("u16", "u64?", "text"), "DM:{}:{}:{}"),  # sender port, id, content
+    "DM_NOTIFY": (0x22, ("u16", "u16", "u64?"), "DM_NOTIFY:{}:{}:{}"),  # from port, to port, id
+    # group, id, sender, content
+    "GROUP_MSG_IN": (0x23, ("str", "u64?", "str", "text"), "GROUP_MSG_IN:{}:{}:{}:{}"),
+    # context, group name (empty outside groups), sender, text
+    "TYPING_IN": (0x24, ("str", "str", "str", "text"), "typing:{}:{}:{}:{}"),
+    # id, sender, recipient, content, timestamp
+    "DM_HISTORY": (0x25, ("u64", "str", "str", "text", "str"), "DM_HISTORY:{}:{}:{}:{}:{}"),
+    # group, id, sender, content, timestamp
+    "GROUP_HISTORY_MSG": (0x26, ("str", "u64", "str", "text", "str"), "GROUP_HISTORY_MSG:{}:{}:{}:{}:{}"),
+    # scope, key, rows sent, 1 if more rows remain
+    "HISTORY_END": (0x27, ("str", "str", "u16", "u8"), "HISTORY_END:{}:{}:{}:{}"),
+    "HISTORY_BATCH": (0x28, ("records",), None),
+    # presence version, port, username, ip
+    "PRESENCE_JOIN": (0x29, ("u32", "u16", "str", "str"), "[Server] PRESENCE:{}:JOIN:{}:{}:{}"),
+    "PRESENCE_RENAME": (0x2A, ("u32", "u16", "str"), "[Server] PRESENCE:{}:RENAME:{}:{}"),
+    "PRESENCE_LEAVE": (0x2B, ("u32", "u16"), "[Server] PRESENCE:{}:LEAVE:{}"),
+    # Ends a page of queued DMs (sent as DM_HISTORY): last id, rows sent, 1 if more are queued
+    "MAILBOX_END": (0x2C, ("u64", "u16", "u8"), "MAILBOX_END:{}:{}:{}"),
+}
+
+
+class WireError(ValueError):
+    pass
+
+
+class _Spec:
+    """How one message type is laid out, and its encoder and decoder.
+
+    After the header come the integer fields and the lengths of the "str"
+    fields, in one fixed-size block, then the "str" bytes back to back, then
+    the "text" bytes. Encoding and decoding are one call of the type's
+    struct.Struct plus slicing, with the positions of each kind of field
+    worked out once, here.
+    """
+
+    def __init__(self, name, type_byte, kinds, text):
+        self.name = name
+        self.type_byte = type_byte
+        self.text = text
+        self.kinds = kinds
+        self.prefix = HEADER.pack(MESSAGE, VERSION, type_byte)
+        if kinds == ("records",):
+            self.encode = lambda records: self.prefix + b"".join(
+                RECORD_LENGTH.pack(len(record)) + record for record in records)
+            self.decode = _split_records
+            return
+        if kinds.count("text") > 1:
+            raise ValueError(f"{name} has more than one text field")
+        integers = [i for i, kind in enumerate(kinds) if kind.rstrip("?") in _INTEGERS]
+        self.strings = [i for i, kind in enumerate(kinds) if kind == "str"]
+        self.text_field = kinds.index("text") if "text" in kinds else None
+        self.integers = integers
+        self.optional = [kinds[i].endswith("?") for i in integers]  # Per integer field, None is sent as 0
+        self.fixed = struct.Struct("!" + "".join(_INTEGERS[kinds[i].rstrip("?")] for i in integers)
+                                   + "B" * len(self.strings))
+        self.get_integers = _getter(integers)
+        self.encode = self._encoder()
+        self.decode = self._decoder()
+
+    def _encoder(self):
+        name, prefix, pack = self.name, self.prefix, self.fixed.pack
+        count, get_integers, optional = len(self.kinds), self.get_integers, self.optional
+        string_fields, text_field = self.strings, self.text_field
+        has_optional = any(optional)
+
+        def encode(*values):
+            if len(values) != count:
+                raise TypeError(f"{name} has {count} fields, got {len(values)}")
+            integers = get_integers(values)
+            if has_optional and None in integers:
+                integers = [0 if value is None and is_optional else value
+                            for value, is_optional in zip(integers, optional)]
+            try:
+                if string_fields:
+                    strings = [values[i].encode() for i in string_fields]
+                    head = prefix + pack(*integers, *map(len, strings)) + b"".join(strings)
+                else:
+                    head = prefix + pack(*integers)
+            except struct.error as e:
+                raise WireError(f"cannot encode {name}: {e}") from None
+            if text_field is None:
+                return head
+            return head + values[text_field].encode()
+        return encode
+
+    def _decoder(self):
+        name, unpack_from, start = self.name, self.fixed.unpack_from, HEADER.size + self.fixed.size
+        count, integer_fields, optional = len(self.kinds), self.integers, self.optional
+        string_fields, text_field = self.strings, self.text_field
+
+        def decode(data):
+            try:
+                numbers = unpack_from(data, HEADER.size)
+            except struct.error:
+                raise WireError(f"truncated {name}") from None
+            values = [None] * count
+            for i, value, is_optional in zip(integer_fields, numbers, optional):
+                values[i] = value or None if is_optional else value
+            offset = start
+            if string_fields:
+                for i, length in zip(string_fields, numbers[len(integer_fields):]):
+                    values[i] = str(data[offset:offset + length], "utf-8")
+                    offset += length
+                if offset > len(data):
+                    raise WireError(f"truncated {name}")
+            if text_field is not None:
+                values[text_field] = str(data[offset:], "utf-8")
+            return values
+        return decode
+
+
+def _getter(indices):
+    """A function picking the values at `indices` out of a tuple, as a tuple"""
+    if not indices:
+        return lambda values: ()
+    if len(indices) == 1:  # itemgetter of one index returns the value alone
+        return operator.itemgetter(slice(indices[0], indices[0] + 1))
+    return operator.itemgetter(*indices)
+
+
+def _split_records(data):
+    """The records of a HISTORY_BATCH, as a one field list"""
+    records = []
+    offset = HEADER.size
+    while offset < len(data):
+        if offset + RECORD_LENGTH.size > len(data):
+            raise WireError("truncated HISTORY_BATCH")
+        (length,) = RECORD_LENGTH.unpack_from(data, offset)
+        offset += RECORD_LENGTH.size
+        if offset + length > len(data):
+            raise WireError("truncated HISTORY_BATCH")
+        records.append(data[offset:offset + length])
+        offset += length
+    return [records]
+
+
+_BY_NAME = {}
+_BY_TYPE = {}
+for _name, (_type_byte, _kinds, _text) in MESSAGES.items():
+    _BY_NAME[_name] = _BY_TYPE[_type_byte] = _Spec(_name, _type_byte, _kinds, _text)
+
+BATCH_OVERHEAD = HEADER.size  # Bytes a HISTORY_BATCH adds around its records...
+RECORD_OVERHEAD = RECORD_LENGTH.size  # ...and per record
+
+
+def is_message(data):
+    return len(data) >= HEADER.size and data[0] == MESSAGE
+
+
+def encode(name, *values):
+    """Encode one message, `values` in the order MESSAGES lists its fields"""
+    return _BY_NAME[name].encode(*values)
+
+
+def message_name(data):
+    """The name of an encoded message's type without decoding it, None if unknown"""
+    spec = _BY_TYPE.get(data[2])
+    return spec.name if spec is not None else None
+
+
+def decode(data):
+    """Decode one message, returns (name, [values])"""
+    if len(data) < HEADER.size or data[1] != VERSION:
+        raise WireError("not a message in this codec version")
+    spec = _BY_TYPE.get(data[2])
+    if spec is None:
+        raise WireError(f"unknown message type 0x{data[2]:02x}")
+    return spec.name, spec.decode(data)
+
+
+def to_text(name, *values):
+    """The same message in the colon-delimited text protocol, for clients that do not speak this codec"""
+    return _BY_NAME[name].text.format(*["" if value is None else value for value in values])
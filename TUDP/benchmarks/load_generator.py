@@ -0,0 +1,448 @@
+"""Load generator for the chat server: simulated clients that connect, log in, chat, DM, post to groups,
+type and ask for history, in a configurable mix.
+
+Every client has its own UDP socket and speaks the binary wire codec. Before
+the measured run the clients connect and register an account, a batch at a
+time, and are split into groups; those that failed to log in sit the run
+out. During the run every client acts at random (a Poisson process
+of --rate actions per second), picking what to do by the weights of --mix.
+Chat, DM and group messages carry the time they were sent, so whoever
+receives them measures the end-to-end latency, and as the recipients of each
+message are known, those that never arrived are counted as lost. History
+requests are timed until their HISTORY_END.
+
+The clients run either on one asyncio event loop, or on plain threads: the
+main thread sends and --threads threads receive. Results are printed, and
+with --json written to a file too, to compare runs between versions.
+
+Every run registers new users, point it at a server using a scratch database:
+
+    python benchmarks/load_generator.py [--clients N] [--duration S] [--rate R]
+        [--mix chat=1,dm=4,group=4,typing=6,history=1] [--driver asyncio|threads] [--json FILE]
+"""
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import random
+import selectors
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common import wire
+
+KINDS = ("chat", "dm", "group", "typing", "history")
+MEASURED = ("chat", "dm", "group", "history")  # Kinds with a reply to time, typing is fire and forget
+
+
+class Results:
+    """What one receiving thread (or the sender) saw, merged at the end"""
+
+    def __init__(self):
+        self.sent = dict.fromkeys(KINDS, 0)
+        self.expected = dict.fromkeys(KINDS, 0)
+        self.delivered = dict.fromkeys(KINDS, 0)
+        self.latencies = {kind: [] for kind in KINDS}  # Nanoseconds
+
+    def merge(self, other):
+        for kind in KINDS:
+            self.sent[kind] += other.sent[kind]
+            self.expected[kind] += other.expected[kind]
+            self.delivered[kind] += other.delivered[kind]
+            self.latencies[kind] += other.latencies[kind]
+
+    def deliver(self, kind, sent_ns):
+        self.delivered[kind] += 1
+        self.latencies[kind].append(time.perf_counter_ns() - sent_ns)
+
+
+class SimClient:
+    """One simulated user, without any I/O: the driver sends what it returns
+    and hands it what arrives"""
+
+    def __init__(self, scenario, index):
+        self.scenario = scenario
+        self.index = index
+        self.username = f"{scenario.run_id}_{index}"
+        self.port = None
+        self.send = None  # send(datagram), set by the driver
+        self.group = None  # (name, members)
+        self.authed = False
+        self.auth_failed = False
+        self.group_ready = False
+        self.history_sent = []  # Send times of the history requests not answered yet, oldest first
+
+    def setup_messages(self):
+        return [wire.encode("CONNECT", self.port), f"AUTH:register:{self.username}:bench".encode()]
+
+    def goodbye(self):
+        return f"disconnect @{self.port}".encode()
+
+    def group_messages(self):
+        name, members = self.group
+        if members[0] is not self:
+            return []
+        others = ",".join(member.username for member in members[1:])
+        return [f"GROUPS:create:{name}:{self.username}:{others}".encode()]
+
+    def act(self, kind, rng, sent):
+        """The datagram for one action, counting it in `sent`"""
+        scenario = self.scenario
+        if kind in ("group", "history", "typing") and not self.group[1][0].group_ready:
+            kind = "dm"  # Its group could not be created
+        tag = f"{scenario.run_id}|{kind}|{time.perf_counter_ns()}"
+        sent.sent[kind] += 1
+        if kind == "chat":
+            sent.expected[kind] += len(scenario.online) - 1
+            return wire.encode("CHAT", tag)
+        if kind == "dm":
+            peer = rng.choice(scenario.online)
+            while peer is self and len(scenario.online) > 1:
+                peer = rng.choice(scenario.online)
+            sent.expected[kind] += 1
+            return wire.encode("DM", peer.port, tag)
+        if kind == "group":
+            # Every logged in member gets it, the sender too
+            sent.expected[kind] += sum(member.authed for member in self.group[1])
+            return wire.encode("GROUP_MSG", self.group[0], tag)
+        if kind == "history":
+            sent.expected[kind] += 1
+            self.history_sent.append(time.perf_counter_ns())
+            return wire.encode("REQUEST_GROUP_HISTORY", self.group[0], None, None, scenario.history_limit)
+        return wire.encode("TYPING", "group", self.group[0], "bench is typing")
+
+    def receive(self, data, results):
+        self.scenario.last_received = time.monotonic()
+        if not wire.is_message(data):
+            text = data.decode(errors="replace")
+            if text.startswith("AUTH_RESULT:"):
+                self.authed = text.startswith("AUTH_RESULT:OK")
+                self.auth_failed = not self.authed
+            elif text.startswith("GROUPS_RESULT:OK"):
+                self.group_ready = True
+            return
+        try:
+            name, fields = wire.decode(data)
+        except wire.WireError:
+            return
+        if name == "CHAT_IN":
+            self.tagged(fields[1], results)
+        elif name == "DM_IN":
+            self.tagged(fields[2], results)
+        elif name == "GROUP_MSG_IN":
+            self.tagged(fields[3], results)
+        elif name == "HISTORY_END" or (name == "HISTORY_BATCH" and any(
+                wire.decode(record)[0] == "HISTORY_END" for record in fields[0])):
+            if self.history_sent:
+                results.deliver("history", self.history_sent.pop(0))
+
+    def tagged(self, content, results):
+        run_id, _, rest = content.partition("|")
+        if run_id == self.scenario.run_id:
+            kind, _, sent_ns = rest.partition("|")
+            results.deliver(kind, int(sent_ns))
+
+
+class Scenario:
+    """The clients, their groups, and when each one acts next"""
+
+    def __init__(self, args):
+        self.run_id = f"bench{random.randrange(1 << 30):x}"
+        self.args = args
+        self.history_limit = args.history_limit
+        self.rng = random.Random(args.seed)
+        self.clients = [SimClient(self, i) for i in range(args.clients)]
+        self.online = []  # The clients that logged in, the only ones taking part in the run
+        size = max(args.group_size, 2)
+        for start in range(0, len(self.clients), size):
+            members = self.clients[start:start + size]
+            if len(members) < 2 and start:
+                members = self.clients[start - size:]  # Fold a lone leftover into the previous group
+            group = (f"{self.run_id}_g{start // size}", members)
+            for member in members:
+                member.group = group
+        kinds, weights = zip(*args.mix.items())
+        self.kinds, self.weights = kinds, weights
+        self.queue = []  # [(next action time, client index)]
+        self.sent = Results()
+        self.last_received = 0.0  # time.monotonic() of the last datagram any client received
+
+    def settled(self):
+        """True once the server stopped sending, the presence updates of the setup are a burst of their own"""
+        return time.monotonic() - self.last_received > self.args.settle
+
+    def setup_steps(self):
+        """(datagrams to send as (client, datagram), condition to wait for) for each setup step.
+        Clients connect a batch at a time, every connect is announced to everyone already online."""
+        batch_size = self.args.connect_batch
+        for start in range(0, len(self.clients), batch_size):
+            batch = self.clients[start:start + batch_size]
+            yield ([(client, datagram) for client in batch for datagram in client.setup_messages()],
+                   lambda batch=batch: all(client.authed or client.auth_failed for client in batch))
+        yield ([(client, datagram) for client in self.clients if client.authed
+                for datagram in client.group_messages()],
+               lambda: all(client.group_ready for client in self.clients
+                           if client.authed and client.group[1][0] is client))
+
+    def start(self, now):
+        self.online = [client for client in self.clients if client.authed]
+        for client in self.online:
+            heapq.heappush(self.queue, (now + self.rng.expovariate(self.args.rate), client.index))
+
+    def due(self, now):
+        """The (client, datagram) pairs due by `now`, and when the next one is"""
+        actions = []
+        while self.queue and self.queue[0][0] <= now:
+            _, index = heapq.heappop(self.queue)
+            client = self.clients[index]
+            kind = self.rng.choices(self.kinds, self.weights)[0]
+            actions.append((client, client.act(kind, self.rng, self.sent)))
+            heapq.heappush(self.queue, (now + self.rng.expovariate(self.args.rate), index))
+        return actions, self.queue[0][0] if self.queue else now + 1
+
+
+def send_all(actions, stats):
+    for client, datagram in actions:
+        try:
+            client.send(datagram)
+        except OSError:
+            stats["send_errors"] += 1
+
+
+# ==== drivers ==== #
+class _Protocol(asyncio.DatagramProtocol):
+    def __init__(self, client, results):
+        self.client = client
+        self.results = results
+
+    def datagram_received(self, data, addr):
+        self.client.receive(data, self.results)
+
+
+async def run_asyncio(scenario, args, stats):
+    loop = asyncio.get_running_loop()
+    results = Results()
+    transports = []
+    for client in scenario.clients:
+        transport, _ = await loop.create_datagram_endpoint(lambda client=client: _Protocol(client, results),
+                                                           remote_addr=(args.host, args.port))
+        transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, args.rcvbuf)
+        client.port = transport.get_extra_info("sockname")[1]
+        client.send = transport.sendto
+        transports.append(transport)
+
+    started = time.monotonic()
+    for actions, done in scenario.setup_steps():
+        send_all(actions, stats)
+        deadline = time.monotonic() + args.setup_timeout
+        while not done() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+    deadline = time.monotonic() + args.setup_timeout
+    while not scenario.settled() and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    stats["setup_seconds"] = time.monotonic() - started
+
+    now = time.monotonic()
+    end = now + args.duration
+    scenario.start(now)
+    while now < end:
+        actions, next_at = scenario.due(now)
+        send_all(actions, stats)
+        await asyncio.sleep(max(0.0, min(next_at, end) - time.monotonic()))
+        now = time.monotonic()
+    await asyncio.sleep(args.drain)
+    send_all([(client, client.goodbye()) for client in scenario.clients], stats)
+    for transport in transports:
+        transport.close()
+    return [results]
+
+
+def run_threads(scenario, args, stats):
+    server = (args.host, args.port)
+    sockets = []
+    for client in scenario.clients:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, args.rcvbuf)
+        sock.bind(("127.0.0.1", 0))
+        sock.setblocking(False)
+        client.port = sock.getsockname()[1]
+        client.send = lambda datagram, sock=sock: sock.sendto(datagram, server)
+        sockets.append((sock, client))
+
+    stop = threading.Event()
+    all_results = []
+
+    def receive(pairs, results):
+        selector = selectors.DefaultSelector()
+        for sock, client in pairs:
+            selector.register(sock, selectors.EVENT_READ, client)
+        while not stop.is_set():
+            for key, _ in selector.select(0.05):
+                while True:
+                    try:
+                        data = key.fileobj.recv(65536)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError:
+                        break
+                    key.data.receive(data, results)
+        selector.close()
+
+    threads = []
+    for i in range(args.threads):
+        results = Results()
+        all_results.append(results)
+        thread = threading.Thread(target=receive, args=(sockets[i::args.threads], results), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    started = time.monotonic()
+    for actions, done in scenario.setup_steps():
+        send_all(actions, stats)
+        deadline = time.monotonic() + args.setup_timeout
+        while not done() and time.monotonic() < deadline:
+            time.sleep(0.05)
+    deadline = time.monotonic() + args.setup_timeout
+    while not scenario.settled() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    stats["setup_seconds"] = time.monotonic() - started
+
+    now = time.monotonic()
+    end = now + args.duration
+    scenario.start(now)
+    while now < end:
+        actions, next_at = scenario.due(now)
+        send_all(actions, stats)
+        time.sleep(max(0.0, min(next_at, end) - time.monotonic()))
+        now = time.monotonic()
+    time.sleep(args.drain)
+    send_all([(client, client.goodbye()) for client in scenario.clients], stats)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    for sock, _ in sockets:
+        sock.close()
+    return all_results
+
+
+# ==== report ==== #
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report(scenario, args, stats, results):
+    total = Results()
+    total.merge(scenario.sent)
+    for partial in results:
+        total.merge(partial)
+
+    by_type = {}
+    for kind in KINDS:
+        if not total.sent[kind]:
+            continue
+        entry = {"sent": total.sent[kind]}
+        if kind in MEASURED:
+            ordered = sorted(total.latencies[kind])
+            expected = total.expected[kind]
+            entry.update({
+                "expected": expected,
+                "delivered": total.delivered[kind],
+                "loss": round(1 - min(total.delivered[kind], expected) / expected, 4) if expected else 0.0,
+                "latency_ms": {name: None if value is None else round(value / 1e6, 3) for name, value in (
+                    ("p50", percentile(ordered, 0.5)), ("p90", percentile(ordered, 0.9)),
+                    ("p99", percentile(ordered, 0.99)), ("max", ordered[-1] if ordered else None))},
+            })
+        by_type[kind] = entry
+
+    return {
+        "run": scenario.run_id,
+        "config": {"clients": args.clients, "duration": args.duration, "rate": args.rate, "mix": args.mix,
+                   "group_size": args.group_size, "driver": args.driver, "threads": args.threads},
+        "setup": {"authenticated": sum(client.authed for client in scenario.clients),
+                  "groups": sum(client.group_ready for client in scenario.clients),
+                  "seconds": round(stats["setup_seconds"], 3)},
+        "send_errors": stats["send_errors"],
+        "sent_per_second": round(sum(total.sent.values()) / args.duration, 1),
+        "delivered_per_second": round(sum(total.delivered.values()) / args.duration, 1),
+        "by_type": by_type,
+    }
+
+
+def print_report(summary):
+    setup = summary["setup"]
+    print(f"{summary['config']['clients']} clients ({setup['authenticated']} logged in, {setup['groups']} groups, "
+          f"set up in {setup['seconds']} s), {summary['config']['duration']} s, driver "
+          f"{summary['config']['driver']}")
+    print(f"sent {summary['sent_per_second']}/s, delivered {summary['delivered_per_second']}/s, "
+          f"{summary['send_errors']} send errors")
+    print(f"{'type':<8} {'sent':>8} {'expected':>9} {'delivered':>9} {'loss':>7} "
+          f"{'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for kind, entry in summary["by_type"].items():
+        if "latency_ms" not in entry:
+            print(f"{kind:<8} {entry['sent']:>8}")
+            continue
+        latency = [f"{value:>8.2f}" if value is not None else f"{'-':>8}" for value in entry["latency_ms"].values()]
+        print(f"{kind:<8} {entry['sent']:>8} {entry['expected']:>9} {entry['delivered']:>9} "
+              f"{entry['loss']:>7.2%} {' '.join(latency)}")
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown action {kind!r}, expected one of {', '.join(KINDS)}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=10, help="seconds of measured load")
+    parser.add_argument("--rate", type=float, default=1.0, help="actions per second per client")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("chat=1,dm=4,group=4,typing=6,history=1"),
+                        help="action weights, as kind=weight,...")
+    parser.add_argument("--group-size", type=int, default=8)
+    parser.add_argument("--history-limit", type=int, default=20, help="rows per history request")
+    parser.add_argument("--driver", choices=("asyncio", "threads"), default="asyncio")
+    parser.add_argument("--threads", type=int, default=4, help="receiving threads of the threads driver")
+    parser.add_argument("--connect-batch", type=int, default=50, help="clients connecting at once during setup")
+    parser.add_argument("--setup-timeout", type=float, default=5,
+                        help="seconds to wait for each batch of logins, and for the groups")
+    parser.add_argument("--settle", type=float, default=0.5,
+                        help="seconds without traffic that end the setup, up to --setup-timeout")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to keep receiving after the run")
+    parser.add_argument("--rcvbuf", type=int, default=1 << 20,
+                        help="receive buffer per client socket, every login is announced to every client")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE, - for stdout only")
+    args = parser.parse_args()
+
+    scenario = Scenario(args)
+    stats = {"send_errors": 0, "setup_seconds": 0.0}
+    if args.driver == "asyncio":
+        results = asyncio.run(run_asyncio(scenario, args, stats))
+    else:
+        results = run_threads(scenario, args, stats)
+    summary = report(scenario, args, stats, results)
+
+    if args.json == "-":
+        print(json.dumps(summary, indent=2))
+        return
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Microbenchmark of the binary wire codec against the colon-delimited text protocol.
+
+For a mix of the messages the server sends and receives most, compares the
+datagram sizes and times encoding and parsing. Parsing a text message means
+what the receivers did with it: decode the datagram, find its handler by
+trying each prefix of the receive loop in turn, then split it and convert
+the numbers. Parsing a wire message is one wire.decode().
+
+    python benchmarks/wire_benchmark.py [--rounds N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common import wire
+
+# The prefixes NetworkHandler's receive loop tried, in order, before the wire
+# codec. Chat lines matched none of them.
+CLIENT_PREFIXES = ("REQUEST_DM_HISTORY:", "REQUEST_MY_DM_HISTORY:", "DM:", "GROUP_MSG_IN:", "HISTORY_BATCH:",
+                   "GROUP_HISTORY_MSG:", "DM_HISTORY:", "HISTORY_END:", "REQUEST_DM_HISTORY:", "DM_NOTIFY:",
+                   "DM:", "AUTH_RESULT:", "GROUPS_RESULT:", "[Server] USERNAME:",
+                   "[Server] PRESENCE_SNAPSHOT:", "[Server] PRESENCE:", "FILE_REQ:", "FILE_RES:", "typing:")
+# The same for the server's handle_datagram
+SERVER_PREFIXES = ("connected @", "disconnect @", "PRESENCE_SYNC:", "typing:", "AUTH:", "REQUEST_MY_DM_HISTORY:",
+                   "REQUEST_DM_HISTORY:", "DM:", "FILE_REQ:", "FILE_RES:", "GROUPS:", "GROUP_MSG:",
+                   "REQUEST_GROUP_HISTORY:")
+
+
+def route(text, prefixes):
+    for prefix in prefixes:
+        if text.startswith(prefix):
+            return prefix
+    return None
+
+
+def split_timestamp(rest):
+    content, date_hour, minutes, seconds = rest.rsplit(":", 3)
+    return content, f"{date_hour}:{minutes}:{seconds}"
+
+
+def parse_presence(text):
+    _, version, kind, rest = text[9:].split(":", 3)
+    port, username, ip = rest.split(":", 2)
+    return int(version), kind, port, username, ip
+
+
+def parse_group_history(text):
+    _, group_name, msg_id, sender, rest = text.split(":", 4)
+    return group_name, int(msg_id), sender, *split_timestamp(rest)
+
+
+# (message, fields, who receives it, the text protocol's parser for it)
+SAMPLES = [
+    ("CHAT_IN", ("alice", "see you at 10:30, bring the slides"), CLIENT_PREFIXES,
+     lambda text: text.split(">", 1)),
+    ("TYPING_IN", ("group", "project-x", "alice", "see you at 10:3"), CLIENT_PREFIXES,
+     lambda text: text.split(":", 4)),
+    ("DM_NOTIFY", (53122, 53200, 48213), CLIENT_PREFIXES,
+     lambda text: [int(field) for field in text.split(":")[1:]]),
+    ("GROUP_MSG_IN", ("project-x", 91234, "bob", "merged, deploying now"), CLIENT_PREFIXES,
+     lambda text: text.split(":", 4)),
+    ("GROUP_HISTORY_MSG", ("project-x", 91234, "bob", "merged, deploying now", "2025-06-01 14:03:59"),
+     CLIENT_PREFIXES, parse_group_history),
+    ("PRESENCE_JOIN", (1042, 53200, "carol", "192.168.1.20"), CLIENT_PREFIXES, parse_presence),
+    ("CHAT", ("see you at 10:30, bring the slides",), SERVER_PREFIXES, lambda text: text),
+    ("DM", (53200, "did the build pass?"), SERVER_PREFIXES,
+     lambda text: (lambda _, port, content: (int(port), content))(*text.split(":", 2))),
+    ("TYPING", ("dm", "53200", "did the bu"), SERVER_PREFIXES,
+     lambda text: text.split(":", 3)),
+]
+
+
+def parse_text(data, prefixes, parse):
+    text = data.decode()
+    route(text, prefixes)
+    return parse(text)
+
+
+def bench(func, rounds):
+    return min(timeit.repeat(func, number=rounds, repeat=5)) / rounds * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=100000, help="calls per timing")
+    args = parser.parse_args()
+
+    print(f"{'message':<18} {'text B':>7} {'wire B':>7} {'text enc':>9} {'wire enc':>9} "
+          f"{'text parse':>10} {'wire parse':>10}   (ns per message)")
+    totals = [0, 0, 0.0, 0.0, 0.0, 0.0]
+    for name, fields, prefixes, parse in SAMPLES:
+        text = wire.to_text(name, *fields).encode()
+        binary = wire.encode(name, *fields)
+        row = [
+            len(text),
+            len(binary),
+            bench(lambda: wire.to_text(name, *fields).encode(), args.rounds),
+            bench(lambda: wire.encode(name, *fields), args.rounds),
+            bench(lambda: parse_text(text, prefixes, parse), args.rounds),
+            bench(lambda: wire.decode(binary), args.rounds),
+        ]
+        totals = [total + value for total, value in zip(totals, row)]
+        print(f"{name:<18} {row[0]:>7} {row[1]:>7} {row[2]:>9.0f} {row[3]:>9.0f} {row[4]:>10.0f} {row[5]:>10.0f}")
+    print(f"{'total':<18} {totals[0]:>7} {totals[1]:>7} {totals[2]:>9.0f} {totals[3]:>9.0f} "
+          f"{totals[4]:>10.0f} {totals[5]:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import multiprocessing
+import os
+import signal
+from multiprocessing.connection import wait
+
+
+class LocalBus:
+    """Bus used when the server runs as a single process.
+
+    There is nobody else to tell, it only numbers each event and hands it
+    back to the handler on the next loop iteration, like the broker would.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.handler = None
+        self.versions = {}
+
+    def publish(self, topic, event):
+        version = self.versions[topic] = self.versions.get(topic, 0) + 1
+        self.loop.call_soon(self.handler, topic, version, event)
+
+    def attach(self, loop, handler):
+        self.loop = loop
+        self.handler = handler
+
+    def close(self):
+        pass
+
+
+class WorkerBus:
+    """A worker's pipe to the broker process.
+
+    Events are small tuples published under a topic, e.g.
+    ("presence", ("connect", port, ip, last_active)). The broker numbers them
+    per topic and delivers every event, including the publisher's own, to
+    all workers. The handler is called on the worker's event loop as
+    handler(topic, version, event), in the same order on every worker.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.loop = None
+        self.handler = None
+
+    def publish(self, topic, event):
+        try:
+            self.conn.send((topic, event))
+        except (OSError, EOFError):
+            pass  # Broker is gone, we are shutting down
+
+    def attach(self, loop, handler):
+        self.loop = loop
+        self.handler = handler
+        loop.add_reader(self.conn.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        try:
+            while self.conn.poll():
+                self.handler(*self.conn.recv())
+        except (OSError, EOFError):
+            self.loop.remove_reader(self.conn.fileno())
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.conn.fileno())
+        self.conn.close()
+
+
+def run_broker(conns):
+    """Number every event a worker publishes and relay it to all workers"""
+    conns = list(conns)
+    versions = {}
+    while conns:
+        for conn in wait(conns):
+            try:
+                topic, event = conn.recv()
+            except (OSError, EOFError):
+                conns.remove(conn)
+                continue
+            version = versions[topic] = versions.get(topic, 0) + 1
+            for other in conns:
+                try:
+                    other.send((topic, version, event))
+                except (OSError, EOFError):
+                    pass
+
+
+def run_workers(worker_count, worker_target):
+    """Start a broker and `worker_count` copies of `worker_target(worker_id, bus_conn)`"""
+    broker_ends, workers = [], []
+    for worker_id in range(worker_count):
+        broker_end, worker_end = multiprocessing.Pipe()
+        broker_ends.append(broker_end)
+        workers.append(multiprocessing.Process(target=worker_target, args=(worker_id, worker_end),
+                                               name=f"worker-{worker_id}", daemon=True))
+
+    broker = multiprocessing.Process(target=run_broker, args=(broker_ends,), name="broker", daemon=True)
+    broker.start()
+    for worker in workers:
+        worker.start()
+
+    # A terminal's Ctrl+C reaches every worker already, a SIGTERM to the parent
+    # has to be passed on so each worker flushes its writes before exiting.
+    # So is a SIGUSR1, every worker then takes a profile.
+    def pass_on(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signum)
+    signal.signal(signal.SIGTERM, pass_on)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, pass_on)
+
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        broker.terminate()
@@ -0,0 +1,81 @@
+class Directory:
+    """Registered users and groups, cached in memory.
+
+    Loaded from the database once at startup, then kept current from the
+    changes the server makes itself: a worker that registers a user or creates
+    a group publishes it on the cluster bus, and every worker, the publisher
+    included, replays it with `apply`. `listeners` are called with each
+    replayed event, to push it to the clients it concerns.
+
+    Membership is also indexed both ways, `members` and `user_groups`, so
+    relaying to a group or listing someone's groups never scans every group.
+    """
+
+    def __init__(self, bus, users=(), groups=None):
+        self.bus = bus
+        self.users = list(users)  # Registration order, like the userdata table
+        self._user_set = set(self.users)
+        self.groups = {}  # {groupname: (owner, [members, owner included])}
+        self.members = {}  # {groupname: {members}}
+        self.user_groups = {}  # {username: {groupnames}}
+        for group_name, (owner, members) in (groups or {}).items():
+            self._add_group(group_name, owner, members)
+        self.listeners = []
+
+    # ==== local changes ==== #
+    def add_user(self, username):
+        self.bus.publish("directory", ("user", username))
+
+    def add_group(self, group_name, owner, members):
+        self.bus.publish("directory", ("group", group_name, owner, list(members)))
+
+    # ==== replicated changes ==== #
+    def apply(self, version, event):
+        kind = event[0]
+        if kind == "user":
+            username = event[1]
+            if username in self._user_set:
+                return
+            self._user_set.add(username)
+            self.users.append(username)
+        elif kind == "group":
+            _, group_name, owner, members = event
+            if group_name in self.groups:
+                return
+            self._add_group(group_name, owner, members)
+        for listener in self.listeners:
+            listener(event)
+
+    def _add_group(self, group_name, owner, members):
+        self.groups[group_name] = (owner, members)
+        self.members[group_name] = set(members)
+        for member in members:
+            self.user_groups.setdefault(member, set()).add(group_name)
+
+    # ==== lookups ==== #
+    def has_user(self, username):
+        return username in self._user_set
+
+    def groups_of(self, username):
+        return {name: self.groups[name] for name in self.user_groups.get(username, ())}
+
+    def members_of(self, group_name):
+        return self.members.get(group_name, frozenset())
+
+    def is_member(self, group_name, username):
+        return username in self.members.get(group_name, ())
+
+    def users_message(self):
+        return f"[Server] REGISTERED_USERS:{','.join(self.users)}"
+
+    def groups_message(self, username):
+        """GROUPS_LISTS with only the groups `username` belongs to"""
+        groups_info = "[Server] GROUPS_LISTS"
+        for group_name, group in self.groups_of(username).items():
+            groups_info += f":{format_group(group_name, group)}"
+        return groups_info
+
+
+def format_group(group_name, group):
+    owner, members = group
+    return f"{group_name},{owner},{','.join(members)}"
@@ -0,0 +1,179 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import socket
+import sys
+import time
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+
+class _sockaddr_in(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort), ("sin_port", ctypes.c_uint16),
+                ("sin_addr", ctypes.c_ubyte * 4), ("sin_zero", ctypes.c_ubyte * 8)]
+
+
+def _load_sendmmsg():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+class FanOut:
+    """Send one payload to many clients.
+
+    The payload is encoded once by the caller and the recipient list is a
+    snapshot, so clients coming and going during a send change nothing. On
+    Linux each chunk of recipients goes out in one sendmmsg() call, elsewhere
+    (or while the transport has datagrams queued) through transport.sendto.
+
+    Up to `chunk_size` recipients are sent right away. Bigger fan-outs, and
+    anything sent while one is still running, are queued and sent a chunk at
+    a time by a background task that yields between chunks, so a broadcast to
+    thousands of clients never holds up the receive loop. Queued fan-outs go
+    out in order, so every client still sees messages in the order they were
+    sent.
+
+    `on_failed(addrs)` is called with the addresses a send failed for, and
+    `on_report(recipients, failed, seconds)` after every fan-out finishes.
+    `stats` keeps running totals.
+    """
+
+    def __init__(self, transport, chunk_size=256, on_failed=None, on_report=None):
+        self.transport = transport
+        self.chunk_size = chunk_size
+        self.on_failed = on_failed
+        self.on_report = on_report
+        self.pending = []  # [(payload, addrs, started)]
+        self.task = None
+        self.stats = {"fanouts": 0, "datagrams": 0, "failed": 0, "seconds": 0.0}
+
+        sock = transport.get_extra_info("socket")
+        self._fd = sock.fileno() if sock is not None and sock.family == socket.AF_INET else None
+        self._iov = _iovec()
+        self._headers = {}
+        self._names = {}
+
+    def send(self, payload, addrs):
+        """Queue `payload` (bytes) for every (ip, port) in `addrs`"""
+        addrs = list(addrs)
+        if not addrs:
+            return
+        started = time.perf_counter()
+        if not self.pending and len(addrs) <= self.chunk_size:
+            self._finish(len(addrs), self._send_chunk(payload, addrs), started)
+            return
+        self.pending.append((payload, addrs, started))
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._drain())
+
+    async def _drain(self):
+        try:
+            while self.pending:
+                payload, addrs, started = self.pending[0]
+                failed = []
+                try:
+                    for i in range(0, len(addrs), self.chunk_size):
+                        failed += self._send_chunk(payload, addrs[i:i + self.chunk_size])
+                        await asyncio.sleep(0)
+                finally:
+                    self.pending.pop(0)
+                self._finish(len(addrs), failed, started)
+        finally:
+            self.task = None
+
+    def _finish(self, recipients, failed, started):
+        elapsed = time.perf_counter() - started
+        self.stats["fanouts"] += 1
+        self.stats["datagrams"] += recipients
+        self.stats["failed"] += len(failed)
+        self.stats["seconds"] += elapsed
+        if failed and self.on_failed:
+            self.on_failed(failed)
+        if self.on_report:
+            self.on_report(recipients, len(failed), elapsed)
+
+    def _send_chunk(self, payload, addrs):
+        """Send to one chunk of recipients, returns the addresses that failed"""
+        if self._fd is not None and _sendmmsg is not None and self.transport.get_write_buffer_size() == 0:
+            return self._sendmmsg(payload, addrs)
+        return self._sendto(payload, addrs)
+
+    def _sendto(self, payload, addrs):
+        failed = []
+        for addr in addrs:
+            try:
+                self.transport.sendto(payload, addr)
+            except OSError:
+                failed.append(addr)
+        return failed
+
+    def _sendmmsg(self, payload, addrs):
+        count = len(addrs)
+        if len(self._headers) > 65536:
+            self._headers.clear()
+            self._names.clear()
+        buffer = ctypes.create_string_buffer(payload, len(payload))
+        self._iov.iov_base = ctypes.addressof(buffer)
+        self._iov.iov_len = len(payload)
+        # Every header points at the same iovec, so each one only depends on the address
+        messages = (_mmsghdr * count).from_buffer_copy(b"".join(map(self._header, addrs)))
+
+        failed = []
+        sent = 0
+        while sent < count:
+            result = _sendmmsg(self._fd, ctypes.addressof(messages) + sent * ctypes.sizeof(_mmsghdr),
+                               count - sent, 0)
+            if result > 0:
+                sent += result
+                continue
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                # Socket buffer is full, the transport queues the rest for us
+                return failed + self._sendto(payload, addrs[sent:])
+            # sendmmsg reports the error of the first datagram it could not send
+            failed.append(addrs[sent])
+            sent += 1
+        return failed
+
+    def _header(self, addr):
+        """Packed mmsghdr sending self._iov to `addr`, cached per address"""
+        header = self._headers.get(addr)
+        if header is None:
+            ip, port = addr
+            name = _sockaddr_in(socket.AF_INET, socket.htons(port),
+                                (ctypes.c_ubyte * 4)(*socket.inet_aton(ip)))
+            message = _mmsghdr()
+            message.msg_hdr.msg_name = ctypes.addressof(name)
+            message.msg_hdr.msg_namelen = ctypes.sizeof(name)
+            message.msg_hdr.msg_iov = ctypes.pointer(self._iov)
+            message.msg_hdr.msg_iovlen = 1
+            self._names[addr] = name  # Keep the sockaddr alive while headers point at it
+            header = self._headers[addr] = bytes(message)
+        return header
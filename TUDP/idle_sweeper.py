@@ -0,0 +1,74 @@
+import math
+import time
+
+
+class IdleSweeper:
+    """Finds sessions that went quiet, with a hashed timer wheel.
+
+    The wheel has one slot per `tick` seconds of `timeout`. A session sits in
+    the slot of its deadline, `timeout` seconds after it was last heard from.
+    Activity only updates the session's timestamp, it does not move the
+    session. When the wheel reaches a slot, each session in it has either
+    expired or is put back in the slot of its new deadline. A sweep
+    therefore only touches sessions whose slot came due, never every
+    session, and each session is looked at about once per `timeout`.
+    Sessions expire at most one tick late, never early.
+    """
+
+    def __init__(self, timeout, tick=1.0, clock=time.monotonic):
+        self.timeout = timeout
+        self.tick = tick
+        self.clock = clock
+        self.slots = [set() for _ in range(math.ceil(timeout / tick) + 1)]
+        self.position = 0  # The slot that comes due next...
+        self.due = clock() + tick  # ...and when
+        self.last_active = {}  # {key: time last heard from}
+        self.slot_of = {}  # {key: slot index}
+        self.stats = {"expired": 0, "rescheduled": 0}
+
+    def touch(self, key):
+        """Record activity of `key`, starting to track it if it is new"""
+        now = self.clock()
+        self.last_active[key] = now
+        if key not in self.slot_of:
+            self._schedule(key, now + self.timeout)
+
+    def discard(self, key):
+        index = self.slot_of.pop(key, None)
+        if index is not None:
+            self.slots[index].discard(key)
+        self.last_active.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.slot_of
+
+    def _schedule(self, key, deadline):
+        ahead = min(max(0, math.ceil((deadline - self.due) / self.tick)), len(self.slots) - 1)
+        index = (self.position + ahead) % len(self.slots)
+        self.slots[index].add(key)
+        self.slot_of[key] = index
+
+    def expire(self):
+        """Advance the wheel to now, returns the keys idle for `timeout` seconds and stops tracking them"""
+        now = self.clock()
+        expired = []
+        for _ in range(len(self.slots)):
+            if self.due > now:
+                break
+            slot, self.slots[self.position] = self.slots[self.position], set()
+            self.position = (self.position + 1) % len(self.slots)
+            self.due += self.tick
+            for key in slot:
+                del self.slot_of[key]
+                deadline = self.last_active[key] + self.timeout
+                if deadline <= now:
+                    del self.last_active[key]
+                    expired.append(key)
+                else:
+                    self._schedule(key, deadline)
+                    self.stats["rescheduled"] += 1
+        else:
+            # A whole turn behind, every slot was just swept once
+            self.due = max(self.due, now + self.tick)
+        self.stats["expired"] += len(expired)
+        return expired
@@ -0,0 +1,153 @@
+import asyncio
+import bisect
+import math
+
+# Histogram buckets: seconds, from 50 us to 10 s...
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+# ...and counts, for fan-out sizes
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # {label values: count}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name, self.labels, label_values, value
+
+
+class Histogram:
+    """Counts of observations per bucket, with their sum. Observing is one
+    bisect and two additions, cheap enough for every message."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self.values = {}  # {label values: [count per bucket..., count above the last, sum]}
+
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        bucket_labels = self.labels + ("le",)
+        for label_values, series in self.values.items():
+            count = 0
+            for bound, observed in zip(self.buckets + (math.inf,), series):
+                count += observed
+                yield f"{self.name}_bucket", bucket_labels, label_values + (_format(bound),), count
+            yield f"{self.name}_sum", self.labels, label_values, series[-1]
+            yield f"{self.name}_count", self.labels, label_values, count
+
+
+class Callback:
+    """A metric read when rendered, for state other objects already keep:
+    `read()` returns a number, or {label value (a tuple with several
+    labels): number}"""
+
+    def __init__(self, name, help, kind, read, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.read = read
+        self.labels = labels
+
+    def samples(self):
+        value = self.read()
+        if not isinstance(value, dict):
+            yield self.name, (), (), value
+            return
+        for label_values, item in value.items():
+            yield self.name, self.labels, label_values if isinstance(label_values, tuple) else (label_values,), item
+
+
+class Metrics:
+    """The server's counters, histograms and gauges, rendered in the
+    Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        return self._add(Histogram(name, help, buckets, labels))
+
+    def gauge(self, name, help, read, labels=()):
+        return self._add(Callback(name, help, "gauge", read, labels))
+
+    def counters(self, name, help, read, labels=()):
+        """Counters kept elsewhere, such as the `stats` dicts of the server's components"""
+        return self._add(Callback(name, help, "counter", read, labels))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, label_values, value in metric.samples():
+                if labels:
+                    pairs = ",".join(f'{label}="{_escape(label_value)}"'
+                                     for label, label_value in zip(labels, label_values))
+                    lines.append(f"{name}{{{pairs}}} {_format(value)}")
+                else:
+                    lines.append(f"{name} {_format(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _format(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+async def serve(metrics, host, port):
+    """Serve `metrics` over HTTP at http://host:port/metrics, for Prometheus or curl"""
+
+    async def respond(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+                pass  # Headers, not needed
+            parts = request.split()
+            if len(parts) > 1 and parts[1] == b"/metrics":
+                status, body = "200 OK", metrics.render().encode()
+            else:
+                status, body = "404 Not Found", b"See /metrics\n"
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(respond, host, port)
@@ -0,0 +1,171 @@
+import sqlite3
+
+# Versioned schema changes, applied in order. The version a database is at is
+# kept in SQLite's `PRAGMA user_version`; files created before migrations
+# existed are at version 0. Never edit a migration that has shipped, add a new
+# one instead.
+MIGRATIONS = [
+    (1, "baseline schema", [
+        """
+        CREATE TABLE IF NOT EXISTS userdata (
+            id INTEGER PRIMARY KEY,
+            username VARCHAR(255) NOT NULL,
+            password VARCHAR(255) NOT NULL,
+            UNIQUE(username)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_group_owner (
+            groupname VARCHAR(255) PRIMARY KEY,
+            username VARCHAR(255) NOT NULL,
+            UNIQUE(groupname)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_group (
+            groupname VARCHAR(255),
+            username VARCHAR(255),
+            PRIMARY KEY(groupname, username),
+            FOREIGN KEY(groupname) REFERENCES user_group_owner(groupname)
+                ON DELETE CASCADE ON UPDATE NO ACTION
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS dm_histories (
+            id INTEGER PRIMARY KEY,
+            sender_username VARCHAR(255) NOT NULL,
+            recipient_username VARCHAR(255) NOT NULL,
+            message TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sender_username) REFERENCES userdata(username),
+            FOREIGN KEY (recipient_username) REFERENCES userdata(username)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_ports (
+            id INTEGER PRIMARY KEY,
+            username VARCHAR(255) NOT NULL,
+            port VARCHAR(255) NOT NULL,
+            last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(username) REFERENCES userdata (username)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS group_chat_histories (
+            id INTEGER PRIMARY KEY,
+            groupname VARCHAR(255) NOT NULL,
+            sender_username VARCHAR(255) NOT NULL,
+            message TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (groupname) REFERENCES user_group_owner(groupname) ON DELETE CASCADE,
+            FOREIGN KEY (sender_username) REFERENCES userdata(username)
+        )
+        """,
+    ]),
+    (2, "history indexes and unique usernames", [
+        # DM history between two users, and everything a user sent
+        """
+        CREATE INDEX IF NOT EXISTS idx_dm_histories_sender_recipient
+            ON dm_histories (sender_username, recipient_username, timestamp)
+        """,
+        # Everything a user received
+        """
+        CREATE INDEX IF NOT EXISTS idx_dm_histories_recipient
+            ON dm_histories (recipient_username, timestamp)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_group_chat_histories_group
+            ON group_chat_histories (groupname, timestamp)
+        """,
+        # user_ports gained a row on every login, keep the latest one per user
+        """
+        DELETE FROM user_ports
+        WHERE id NOT IN (SELECT MAX(id) FROM user_ports GROUP BY username)
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_user_ports_username
+            ON user_ports (username)
+        """,
+        # Early databases were created without UNIQUE(username) on userdata
+        """
+        DELETE FROM userdata
+        WHERE id NOT IN (SELECT MIN(id) FROM userdata GROUP BY username)
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_userdata_username
+            ON userdata (username)
+        """,
+    ]),
+    (3, "id-ordered history indexes for cursor paging", [
+        # History is paged by message id, and every index already ends with the
+        # rowid, so these replace the timestamp-ordered ones from version 2
+        "DROP INDEX IF EXISTS idx_dm_histories_sender_recipient",
+        "DROP INDEX IF EXISTS idx_dm_histories_recipient",
+        "DROP INDEX IF EXISTS idx_group_chat_histories_group",
+        """
+        CREATE INDEX IF NOT EXISTS idx_dm_histories_sender_recipient_id
+            ON dm_histories (sender_username, recipient_username, id)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_dm_histories_recipient_id
+            ON dm_histories (recipient_username, id)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_group_chat_histories_group_id
+            ON group_chat_histories (groupname, id)
+        """,
+    ]),
+    (4, "offline DM mailbox", [
+        # DMs sent to a user who was offline, until their client acknowledges them
+        """
+        CREATE TABLE IF NOT EXISTS dm_mailbox (
+            dm_id INTEGER PRIMARY KEY,
+            recipient_username VARCHAR(255) NOT NULL,
+            FOREIGN KEY (dm_id) REFERENCES dm_histories(id) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_dm_mailbox_recipient_id
+            ON dm_mailbox (recipient_username, dm_id)
+        """,
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(path="userdata.db"):
+    """Bring the database at `path` up to SCHEMA_VERSION in place.
+
+    Each migration and its version bump commit together, so an interrupted
+    upgrade resumes from the last migration that finished.
+    Returns the list of (version, description) that were applied.
+    """
+    conn = sqlite3.connect(path, isolation_level=None)
+    applied = []
+    try:
+        current = get_version(conn)
+        if current > SCHEMA_VERSION:
+            raise RuntimeError(f"{path} is at schema version {current}, "
+                               f"newer than this server ({SCHEMA_VERSION})")
+
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+            applied.append((version, description))
+    finally:
+        conn.close()
+    return applied
@@ -0,0 +1,131 @@
+import time
+
+
+class PresenceRegistry:
+    """Who is online and under which name.
+
+    Every server worker keeps a full copy of this registry. Changes made by the
+    worker that owns a client (the one the kernel hands that client's datagrams
+    to) take effect locally at once and are published on the cluster bus. The
+    bus numbers them and hands every change back to every worker, in the same
+    order, through `apply`. `version` is the number of the last change applied,
+    so it means the same thing on every worker, and each change is passed on to
+    `listeners` as (version, event) to be turned into a presence delta.
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        # Track clients: {port: (ip, connect time)}, the owning worker tracks activity in its IdleSweeper
+        self.clients = {}
+        self.client_users = {}  # Track usernames
+        self.user_ports = {}  # {username: {ports}}, the reverse of client_users
+        self.codecs = {}  # {port: wire codec version}, for clients that speak the binary codec
+        self.owned = set()  # Ports whose datagrams arrive at this worker
+        # {port: our connects not replayed yet}, an older disconnect replayed meanwhile is not ours to apply to `owned`
+        self.connecting = {}
+        self.version = 0
+        self.listeners = []
+
+    # ==== local changes ==== #
+    def connect(self, port, ip, codec=None):
+        self.owned.add(port)
+        self.connecting[port] = self.connecting.get(port, 0) + 1
+        self._connect(port, ip, time.time(), codec)
+        self.bus.publish("presence", ("connect", port, ip, self.clients[port][1], codec))
+
+    def set_username(self, port, username):
+        self._set_username(port, username)
+        self.bus.publish("presence", ("username", port, username))
+
+    def disconnect(self, port):
+        """Forget a client, returns the name it was known by"""
+        self.owned.discard(port)
+        username = self._disconnect(port)
+        self.bus.publish("presence", ("disconnect", port))
+        return username
+
+    # ==== replicated changes ==== #
+    def apply(self, version, event):
+        """Replay a numbered change, our own ones included (replaying is harmless)"""
+        if version <= self.version:
+            return
+        self.version = version
+        kind = event[0]
+        if kind == "connect":
+            _, port, ip, connected_at, codec = event
+            pending = self.connecting.get(port, 0)
+            if pending > 1:
+                self.connecting[port] = pending - 1
+            elif pending:
+                del self.connecting[port]
+            self._connect(port, ip, connected_at, codec)
+        elif kind == "username":
+            _, port, username = event
+            self._set_username(port, username)
+        elif kind == "disconnect":
+            port = event[1]
+            # Another worker may have ended the session, it is no longer ours either
+            if port not in self.connecting:
+                self.owned.discard(port)
+            self._disconnect(port)
+        for listener in self.listeners:
+            listener(version, event)
+
+    def _connect(self, port, ip, connected_at, codec):
+        self.clients[port] = (ip, connected_at)
+        if codec:
+            self.codecs[port] = codec
+        else:
+            self.codecs.pop(port, None)
+
+    def _set_username(self, port, username):
+        old = self.client_users.get(port)
+        if old == username:
+            return
+        if old is not None:
+            self._unindex(old, port)
+        self.client_users[port] = username
+        self.user_ports.setdefault(username, set()).add(port)
+
+    def _unindex(self, username, port):
+        ports = self.user_ports.get(username)
+        if ports is not None:
+            ports.discard(port)
+            if not ports:
+                del self.user_ports[username]
+
+    def _disconnect(self, port):
+        self.clients.pop(port, None)
+        self.codecs.pop(port, None)
+        username = self.client_users.pop(port, None)
+        if username is None:
+            return f"Guest_{port}"
+        self._unindex(username, port)
+        return username
+
+    # ==== lookups ==== #
+    def username(self, port, default=None):
+        return self.client_users.get(port, default)
+
+    def ports_of(self, username):
+        return self.user_ports.get(username, ())
+
+    def ports_of_any(self, usernames):
+        """The ports of whichever of `usernames` (a set) are online. Walks
+        the smaller of the set and the online users, so a big group with
+        few members online costs no more than a small one."""
+        if len(usernames) <= len(self.user_ports):
+            return [port for username in usernames for port in self.user_ports.get(username, ())]
+        return [port for username, ports in self.user_ports.items() if username in usernames for port in ports]
+
+    def is_logged_in(self, username):
+        return username in self.user_ports
+
+    def is_online(self, port):
+        return port in self.clients
+
+    def codec(self, port):
+        return self.codecs.get(port)
+
+    def address(self, port):
+        return self.clients[port][0], port
@@ -0,0 +1,107 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread from a thread of its own.
+
+    Every `interval` seconds the sampler reads the target thread's current
+    frame and counts its stack. Nothing is traced, so the profiled thread
+    runs at full speed, and the samples show where its time went: the
+    stacks are written in the collapsed format ("frame;frame;frame count"
+    per line, root first) that flamegraph.pl and speedscope read.
+
+    Samples are also attributed to the innermost frame running one of the
+    functions named in `attribute`, such as the server's message handlers:
+    "self" counts those samples, "total" the samples with the function
+    anywhere on the stack. A thread waiting in its selector is idle, not
+    working, and counted apart.
+    """
+
+    def __init__(self, interval, attribute=()):
+        self.interval = interval
+        self.attribute = frozenset(attribute)
+        self.thread = None
+        self.stopping = threading.Event()
+        self.labels = {}  # {code object: "file:function"}, so each frame is named once
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds, path, on_done=None):
+        """Sample the calling thread for `seconds`, then write the stacks to
+        `path` and call on_done(path, summary lines) from the sampling thread.
+        False if a profile is already running."""
+        if self.running:
+            return False
+        target = threading.get_ident()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, args=(target, seconds, path, on_done),
+                                       name="profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def _run(self, target, seconds, path, on_done):
+        stacks = collections.Counter()
+        started = time.monotonic()
+        deadline = started + seconds
+        while time.monotonic() < deadline and not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            if frame is None:  # The thread is gone
+                break
+            stacks[self._stack(frame)] += 1
+        self._write(stacks, path)
+        if on_done is not None:
+            on_done(path, self.summary(stacks, time.monotonic() - started))
+
+    def stop(self):
+        """End a running profile early, its samples are still written"""
+        if self.running:
+            self.stopping.set()
+            self.thread.join()
+
+    def _stack(self, frame):
+        labels = self.labels
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+            stack.append(label)
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    @staticmethod
+    def _write(stacks, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+    def summary(self, stacks, seconds, top=15):
+        """Lines with the samples of each attributed function, busiest first"""
+        sampled = sum(stacks.values())
+        idle = 0
+        own, total = collections.Counter(), collections.Counter()
+        for stack, count in stacks.items():
+            if stack[-1].startswith("selectors.py:"):
+                idle += count
+                continue
+            names = [label.rpartition(":")[2] for label in stack]
+            attributed = [name for name in names if name in self.attribute]
+            own[attributed[-1] if attributed else "(other)"] += count
+            for name in set(attributed):
+                total[name] += count
+        lines = [f"{sampled} samples in {seconds:.1f} s, "
+                 f"{1 - idle / sampled if sampled else 0:.1%} busy"]
+        for name, count in own.most_common(top):
+            lines.append(f"{name:<28} self {count:>7} {count / sampled:>6.1%}  "
+                         f"total {total.get(name, count):>7} {total.get(name, count) / sampled:>6.1%}")
+        return lines
@@ -0,0 +1,87 @@
+import time
+
+# Message classes shed under overload, first to last
+SHED_ORDER = ("typing", "history", "chat")
+
+
+class RateLimiter:
+    """Token buckets per client, and load shedding.
+
+    Every client has one bucket for all its messages and one per message
+    class. `limits` maps a class to (tokens per second, burst), and
+    `session_limit` is the same for the client's overall bucket. A message
+    is let through only if both of its buckets hold a token.
+
+    The server reports how overloaded it is with `set_load(level)`: at
+    level n the first n classes of SHED_ORDER are dropped for everyone,
+    typing indicators first, then history requests, then chat.
+
+    `stats` counts, per class, the messages let through, throttled (over a
+    client's limit) and shed (dropped for overload).
+
+    Buckets are made for whatever port sends, connected or not. `sweep`
+    drops those that refilled: a full bucket lets through the same as a
+    new one, so forgetting it changes nothing.
+    """
+
+    def __init__(self, limits, session_limit, clock=time.monotonic):
+        self.limits = limits
+        self.session_limit = session_limit
+        self.clock = clock
+        self.buckets = {}  # {client: {class, or None for the session bucket: [tokens, last refill]}}
+        self.load = 0
+        self.shed = frozenset()
+        self.stats = {message_class: {"allowed": 0, "throttled": 0, "shed": 0} for message_class in limits}
+
+    def set_load(self, level):
+        self.load = level
+        self.shed = frozenset(SHED_ORDER[:level])
+
+    def allow(self, client, message_class):
+        """Take a token for one message, False if it must be dropped"""
+        stats = self.stats[message_class]
+        if message_class in self.shed:
+            stats["shed"] += 1
+            return False
+        now = self.clock()
+        buckets = self.buckets.get(client)
+        if buckets is None:
+            buckets = self.buckets[client] = {}
+        session = self._refill(buckets, None, self.session_limit, now)
+        bucket = self._refill(buckets, message_class, self.limits[message_class], now)
+        if session[0] < 1 or bucket[0] < 1:
+            stats["throttled"] += 1
+            return False
+        session[0] -= 1
+        bucket[0] -= 1
+        stats["allowed"] += 1
+        return True
+
+    @staticmethod
+    def _refill(buckets, key, limit, now):
+        rate, burst = limit
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [float(burst), now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        return bucket
+
+    def sweep(self):
+        """Forget the clients all of whose buckets are full again, returns how many"""
+        now = self.clock()
+        idle = [client for client, buckets in self.buckets.items()
+                if all(self._is_full(bucket, self.session_limit if key is None else self.limits[key], now)
+                       for key, bucket in buckets.items())]
+        for client in idle:
+            del self.buckets[client]
+        return len(idle)
+
+    @staticmethod
+    def _is_full(bucket, limit, now):
+        rate, burst = limit
+        return bucket[0] + (now - bucket[1]) * rate >= burst
+
+    def forget(self, client):
+        self.buckets.pop(client, None)
@@ -1,612 +1,1248 @@
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import signal
 import socket
-import threading
 import time
-import sqlite3
-
-class Colors:
-    HEADER = '\033[95m'
-    BLUE = '\033[94m'
-    GREEN = '\033[92m'
-    WARNING = '\033[93m'
-    FAIL = '\033[91m'
-    END = '\033[0m'
-    BOLD = '\033[1m'
-    UNDERLINE = '\033[4m'
-    BG_DARK = '\033[48;5;234m'  # Dark background
-    TEXT_LIGHT = '\033[38;5;250m'  # Light text
 
+import migrations
+import storage
+from Common import wire
+from Common.dispatch import Dispatcher
+from Common.fragmentation import FRAGMENT_HEADER, Fragmenter, Reassembler, is_fragment
+from Common.reliability import HEADER_SIZE, ReliableEndpoint, is_frame
+from cluster import LocalBus, WorkerBus, run_workers
+from directory import Directory, format_group
+from fanout import FanOut
+from idle_sweeper import IdleSweeper
+from metrics import SIZE_BUCKETS, Metrics, serve as serve_metrics
+from typing_aggregator import TypingAggregator
+from presence import PresenceRegistry
+from profiler import SamplingProfiler
+from rate_limiter import RateLimiter
+from session_tokens import TokenSigner
+from storage import Storage
+from structured_log import dropped as dropped_log_records, log_event, setup as setup_logging
+
+log = logging.getLogger("tudp.server")
 
 # Config
 local_IP = "0.0.0.0"
 local_port = 12345
 buffer_size = 1024
+db_path = "userdata.db"
+db_readers = 4  # Reader connections, writes always go through a single writer thread
+db_flush_interval = 0.005  # Durability window: queued writes are committed together at most this late
+db_max_batch = 256  # Writes committed in one transaction before the window is up
+history_yield_every = 16  # Datagrams sent before a history replay yields to other clients
+max_message_size = 32 << 10  # Bytes of one message put back together from fragments, longer ones are refused
+history_batch_budget = buffer_size - HEADER_SIZE  # Max bytes per history datagram: the client's recv buffer, under a 1500 byte MTU
+reliable_delivery = True  # Resend to clients that speak the reliability layer until they acknowledge
+reliable_tick = 0.02  # Seconds between retransmission checks
+fanout_chunk_size = 256  # Recipients per sendmmsg() call, bigger fan-outs are sent in the background
+fanout_slow_report = 0.05  # Seconds, fan-outs slower than this (or with failed sends) are reported
+typing_flush_interval = 0.25  # Typing indicators are relayed at most this often (4 Hz)
+typing_stale_after = 1.0  # Seconds, a typing update that waited longer than this is dropped
+typing_max_per_flush = 64  # Typing updates relayed per flush, the oldest are dropped past this
+client_update_interval = 5  # Seconds between presence version beacons
+session_timeout = 35  # Seconds without a datagram (clients heartbeat every 10) before a session is evicted
+session_sweep_tick = 1.0  # Seconds between idle session sweeps, evictions are at most this late
+max_name_bytes = 127  # UTF-8 bytes in a user or group name: a wire "str" holds 255, a DM's history key two names
+history_page_size = 200  # Default and maximum rows per history request
+resume_token_lifetime = 3600  # Seconds a session resumption token is good for, each resume issues a new one
+mailbox_page_size = 200  # Queued DMs sent at once, the next page follows the client's MAILBOX_ACK
+handler_report_interval = 60  # Seconds between reports of the busiest handlers, when timing them
+metrics_host = "127.0.0.1"  # Metrics are only served on loopback, see --metrics-port
+profile_interval = 0.005  # Seconds between stack samples when profiling (200 Hz)
+profile_seconds = 30  # How long a profile asked for with SIGUSR1 runs
+profile_dir = "profiles"  # Where profiles are written, as collapsed stacks
+# Token buckets per client: (messages per second, burst) for each message class...
+rate_limits = {"typing": (10, 20), "history": (2, 5), "chat": (20, 40), "session": (0.5, 5), "other": (5, 10)}
+session_rate_limit = (40, 80)  # ...and for all of a client's messages together
+overload_check_interval = 0.1  # Seconds between event loop lag measurements
+overload_lag = (0.05, 0.2, 0.5)  # Seconds of loop lag from which typing, then history, then chat is shed
+rate_report_interval = 10  # Seconds between reports of throttled and shed messages, when there were any
+log_level = "INFO"  # Chat lines and connections are INFO, group details DEBUG
+log_format = "text"  # Or "json", one object per line; text is colored only on a terminal
+log_sampling = {"chat": 10, "gave_up": 10}  # Log one in n of these events, see --log-sample
+log_queue_size = 10000  # Records waiting for the log writer thread, more are dropped (and counted)
+
+CHAT_LINE = "(chat)"  # Dispatch key of text lines without a known prefix, they are All-chat messages
+# The rate limit class of each dispatch key, "other" if not listed. Heartbeats
+# are never limited: dropping them would only make clients look gone. Connects,
+# resumes and disconnects each tell everyone, so they have a small bucket.
+MESSAGE_CLASSES = {
+    "HEARTBEAT": None, "HEARTBEAT:": None,
+    "CONNECT": "session", "connected @": "session", "disconnect @": "session",
+    "RESUME": "session", "RESUME:": "session",
+    "TYPING": "typing", "typing:": "typing",
+    "REQUEST_MY_DM_HISTORY": "history", "REQUEST_DM_HISTORY": "history", "REQUEST_GROUP_HISTORY": "history",
+    "REQUEST_MY_DM_HISTORY:": "history", "REQUEST_DM_HISTORY:": "history", "REQUEST_GROUP_HISTORY:": "history",
+    "CHAT": "chat", "DM": "chat", "DM_TO": "chat", "GROUP_MSG": "chat", CHAT_LINE: "chat",
+    "DM:": "chat", "DM_TO:": "chat", "GROUP_MSG:": "chat",
+    "FILE_REQ:": "chat", "FILE_RES:": "chat",
+}
+# Besides the message handlers (handle_* and parse_*), functions profiles attribute time to
+PROFILED = ("datagram_received", "broadcast", "send_rows", "send_typing", "send_presence_delta",
+            "sweep_idle_sessions", "retransmit_loop")
+BATCH_SEPARATOR = b"\x1e"  # ASCII record separator, between the records of a HISTORY_BATCH
+BATCH_END = b"HISTORY_BATCH_END"
+
+
+def text_message_type(message_str):
+    """The dispatch key of a text message: everything up to its first colon
+    included, or up to " @" for connect and disconnect"""
+    head, colon, _ = message_str.partition(":")
+    if colon:
+        return head + colon
+    at = message_str.find(" @")
+    return message_str[:at + 2] if at >= 0 else CHAT_LINE
+
+
+def parse_history_cursor(fields):
+    """Read the optional since_id:before_id:limit fields of a history request"""
+    values = []
+    for i in range(3):
+        field = fields[i] if i < len(fields) else ""
+        values.append(int(field) if field.isdigit() else None)
+    return values
+
+
+def page_limit(limit):
+    return min(limit or history_page_size, history_page_size)
+
+
+def pack_batches(records, budget, binary=False):
+    """Pack encoded records into as few datagrams as fit under `budget` bytes each.
+
+    A text batch is "HISTORY_BATCH:<count>" followed by the records and a
+    closing "HISTORY_BATCH_END", all separated by BATCH_SEPARATOR. A receiver
+    that does not find the closing marker knows the datagram was cut short.
+    A binary batch is a wire HISTORY_BATCH message. A record too big to share
+    a datagram is sent on its own, as a plain message.
+    """
+    if binary:
+        overhead, per_record = wire.BATCH_OVERHEAD, wire.RECORD_OVERHEAD
+        encode = lambda batch: wire.encode("HISTORY_BATCH", batch)
+    else:
+        overhead = len(f"HISTORY_BATCH:{len(records)}") + len(BATCH_SEPARATOR) + len(BATCH_END)
+        per_record, encode = len(BATCH_SEPARATOR), encode_batch
+    batch, size = [], overhead
+    for data in records:
+        if len(data) + per_record + overhead > budget:
+            if batch:
+                yield encode(batch)
+                batch, size = [], overhead
+            yield data
+            continue
+        if size + len(data) + per_record > budget:
+            yield encode(batch)
+            batch, size = [], overhead
+        batch.append(data)
+        size += len(data) + per_record
+    if batch:
+        yield encode(batch)
 
-# Track clients: {port: (ip, last_active)}
-clients = {}
-client_users = {} # Track usernames
-clients_lock = threading.RLock()
-all_clients = ""
 
-# server setup
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-server_socket.bind((local_IP, local_port))
-print(f"{Colors.TEXT_LIGHT}{Colors.BG_DARK}Server up{Colors.END}")
+def encode_batch(batch):
+    return BATCH_SEPARATOR.join([f"HISTORY_BATCH:{len(batch)}".encode()] + batch + [BATCH_END])
 
 
-# Initialize database
-def init_database():
-    conn = sqlite3.connect("userdata.db")
-    cursor = conn.cursor()
+def dm_history_row(msg):
+    return "DM_HISTORY", msg
 
-    enable_foreignkey = """
-        PRAGMA foreign_keys = ON;
-    """
 
-    create_userdata = """
-        CREATE TABLE IF NOT EXISTS userdata (
-            id INTEGER PRIMARY KEY,
-            username VARCHAR(255) NOT NULL,
-            password VARCHAR(255) NOT NULL,
-            UNIQUE(username)
-        )
-    """
+class ChatServer(asyncio.DatagramProtocol):
+    """UDP chat server driven by the asyncio event loop.
 
-    create_user_group_owner = """
-        CREATE TABLE IF NOT EXISTS user_group_owner (
-            groupname VARCHAR(255) PRIMARY KEY,
-            username VARCHAR(255) NOT NULL,
-            UNIQUE(groupname)
-        )
-    """
+    Datagrams are parsed on the loop; anything that touches SQLite is handed to
+    the Storage reader pool or writer thread and awaited in its own task, so a client pulling a long history
+    never holds up All-chat traffic for everyone else.
 
-    create_user_group = """
-        CREATE TABLE IF NOT EXISTS user_group (
-            groupname VARCHAR(255),
-            username VARCHAR(255),
-            PRIMARY KEY(groupname, username),
-            FOREIGN KEY(groupname) REFERENCES user_group_owner(groupname)
-                ON DELETE CASCADE ON UPDATE NO ACTION
-        )
+    When started with several workers, each process runs its own ChatServer on
+    the shared port and `presence` is kept in sync over the cluster bus.
     """
 
-    cursor.execute(enable_foreignkey)
-
-    cursor.execute(create_userdata)
-    cursor.execute(create_user_group_owner)
-    cursor.execute(create_user_group)
-
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS dm_histories (
-            id INTEGER PRIMARY KEY,
-            sender_username VARCHAR(255) NOT NULL,
-            recipient_username VARCHAR(255) NOT NULL,
-            message TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (sender_username) REFERENCES userdata(username),
-            FOREIGN KEY (recipient_username) REFERENCES userdata(username)
-        )
-    """)
-    cursor.execute("""
-                   CREATE TABLE IF NOT EXISTS user_ports
-                    (
-                       id INTEGER PRIMARY KEY,
-                       username VARCHAR(255) NOT NULL,
-                       port VARCHAR(255) NOT NULL,
-                       last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
-                       FOREIGN KEY(username) REFERENCES userdata (username)
-                    )
-                   """)
-
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS group_chat_histories (
-            id INTEGER PRIMARY KEY,
-            groupname VARCHAR(255) NOT NULL,
-            sender_username VARCHAR(255) NOT NULL,
-            message TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (groupname) REFERENCES user_group_owner(groupname) ON DELETE CASCADE,
-            FOREIGN KEY (sender_username) REFERENCES userdata(username)
-        )
-    """)
-    
-    conn.commit()
-    conn.close()
-    print(f"{Colors.TEXT_LIGHT}{Colors.BG_DARK}Databases initialized{Colors.END}")
-
-
-# Call the initialization function
-init_database()
-
-def broadcast(text, exclude=None):
-    """Send `text` to all clients, except the one with `exclude` port"""
-    with clients_lock:
-        for port, (ip, _) in list(clients.items()):
-            if port == exclude:
-                continue
-            try:
-                server_socket.sendto(text.encode(), (ip, port))
-            except socket.error:
-                # If fails, remove client from list
-                del clients[port]
-
-def periodic_client_updates():
-    """Send client list updates to all connected clients every 5 seconds"""
-    while True:
-        time.sleep(5)  # Update interval (5 seconds)
-        with clients_lock:
-            if clients:  # Only send if there are clients
-                client_info = [f"{p}:{client_users.get(p, f'Guest_{p}')}:{clients[p][0]}" for p in clients]
-                client_list = ",".join(client_info)
-                broadcast(f"[Server] CLIENTS:{client_list}")
-
-        gen_all_users()
-        gen_groups_lists()
-
-
-# Start periodic updates thread
-update_thread = threading.Thread(target=periodic_client_updates, daemon=True)
-update_thread.start()
-
-def handle_auth(message_str, client_ip, client_port):
-    parts = message_str.split(":")
-    action = parts[1]  # Get the action (login, register, or enter)
-
-    if action == "enter":
-        username = f"Guest_{client_port}"
-        client_users[client_port] = username
-        result = f"AUTH_RESULT:OK:Entered as {username}"
-        server_socket.sendto(result.encode(), (client_ip, client_port))
-
-        # Build complete client list
-        with clients_lock:
-            client_info = [f"{p}:{client_users.get(p, '')}:{clients[p][0]}" for p in clients]
-            client_list = ",".join(client_info)
-
-        # Send username assignment and full client list to ALL clients
-        broadcast(f"[Server] USERNAME:{client_port}:{username}")
-        broadcast(f"[Server] CLIENTS:{client_list}")
-        broadcast(f"[Server] {username} joined the chat")
-        return
-
-    # Handle authenticated access (login/register)
-    if len(parts) != 4:
-        result = "AUTH_RESULT:FAIL:Invalid authentication format"
-        server_socket.sendto(result.encode(), (client_ip, client_port))
-        return
-
-    username = parts[2]
-    password = parts[3]
-
-    conn = sqlite3.connect("userdata.db")
-    cursor = conn.cursor()
-
-    if action == "register":
-        cursor.execute("SELECT * FROM userdata WHERE username=?", (username,))
-        if cursor.fetchone():
-            result = "AUTH_RESULT:FAIL:Username already exists"
-        else:
-            cursor.execute("INSERT INTO userdata (username, password) VALUES (?, ?)", (username, password))
-            conn.commit()
-            result = f"AUTH_RESULT:OK:User {username} registered successfully"
-            client_users[client_port] = username
-
-    elif action == "login":
-        # First check if username is already in use
-        if username in client_users.values():
-            result = f"AUTH_RESULT:FAIL:Username {username} is already in use"
-        else:
-            cursor.execute("SELECT password FROM userdata WHERE username=?", (username,))
-            db_password = cursor.fetchone()
-            if db_password and db_password[0] == password:
-                result = f"AUTH_RESULT:OK:User {username} logged in successfully"
-                client_users[client_port] = username
-                update_user_port(username, str(client_port))  # Track this user-port association
-
-                # Send DM history
-                history = get_dm_history(username)
-                for msg in history:
-                    history_msg = f"DM_HISTORY:{msg[0]}:{msg[1]}:{msg[2]}:{msg[3]}"
-                    server_socket.sendto(history_msg.encode(), (client_ip, client_port))
-
-                # Notify client and update all clients
-                server_socket.sendto(f"[Server] USERNAME:{client_port}:{username}".encode(), (client_ip, client_port))
-
-                # Build updated client list
-                with clients_lock:
-                    client_info = [f"{p}:{client_users.get(p, '')}:{clients[p][0]}" for p in clients]
-                    client_list = ",".join(client_info)
-
-                # Update ALL clients
-                broadcast(f"[Server] USERNAME:{client_port}:{username}")
-                broadcast(f"[Server] CLIENTS:{client_list}")
-                broadcast(f"[Server] {username} joined the chat")
+    def __init__(self, storage, bus=None, users=(), groups=None, time_handlers=False, resume_key=None):
+        self.transport = None
+        self.bus = bus or LocalBus()
+        self.presence = PresenceRegistry(self.bus)
+        # Read-only views, all changes go through self.presence
+        self.clients = self.presence.clients
+        self.client_users = self.presence.client_users
+        self.storage = storage
+        self.tasks = set()
+        self.presence.listeners.append(self.send_presence_delta)
+        # Registered users and groups, loaded by main() and kept current in memory
+        self.directory = Directory(self.bus, users, groups)
+        self.directory.listeners.append(self.send_directory_change)
+        self.beacon_version = 0  # Presence version announced by the last beacon
+        self.typing = TypingAggregator(self.send_typing, typing_flush_interval, typing_stale_after,
+                                       typing_max_per_flush)
+        self.presence.listeners.append(self.forget_client)
+        # When this worker's clients were last heard from, those quiet for too long are evicted
+        self.idle = IdleSweeper(session_timeout, session_sweep_tick)
+        # Keeps one client from starving the others, and sheds load when the loop falls behind
+        self.limiter = RateLimiter(rate_limits, session_rate_limit)
+        # Lets a logged in client that lost its connection resume without a password check,
+        # the workers of one server share the key
+        self.tokens = TokenSigner(resume_key or os.urandom(32), resume_token_lifetime)
+        # With time_handlers, measures how long each message handler keeps the event loop busy
+        self.dispatcher = Dispatcher(timed=time_handlers)
+        self.register_handlers()
+        self.loop_lag = 0.0  # Seconds, smoothed, measured by watch_load
+        self.profiler = SamplingProfiler(profile_interval, PROFILED + tuple(
+            name for name in dir(type(self)) if name.startswith(("handle_", "parse_"))))
+        self.metrics = Metrics()
+        self.register_metrics()
+
+    # ==== asyncio protocol callbacks ==== #
+    def connection_made(self, transport):
+        self.transport = transport
+        self.fanout = FanOut(transport, fanout_chunk_size, on_failed=self.fanout_failed,
+                             on_report=self.fanout_report)
+        # Peers quiet for a session timeout are dropped, such as addresses that never connected
+        self.reliable = ReliableEndpoint(self.transmit, on_give_up=self.reliable_gave_up,
+                                         idle_timeout=session_timeout)
+        # Clients read at most buffer_size bytes, a reliability header included
+        self.fragmenter = Fragmenter(buffer_size - HEADER_SIZE)
+        # Every recipient of a long chat message is sent all its fragments, for one rate limit token
+        self.reassembler = Reassembler(max_message=max_message_size, on_refused=self.message_refused)
+        self.bus.attach(asyncio.get_running_loop(), self.on_bus_event)
+        self.spawn(self.typing.run())
+        self.spawn(self.retransmit_loop())
+        self.spawn(self.sweep_idle_sessions())
+        self.spawn(self.watch_load())
+        self.spawn(self.report_rate_limits())
+        if self.dispatcher.timed:
+            self.spawn(self.report_handlers())
+        log.info("Server up", extra=log_event("server_up"))
+
+    def datagram_received(self, data, addr):
+        # Acks count too: a client reading a busy chat may send nothing else
+        if addr[1] in self.idle:
+            self.idle.touch(addr[1])
+        if is_frame(data):
+            # Rate limited before it is acked, so a refused message is resent with backoff
+            data = self.reliable.receive(addr, data, accept=functools.partial(self.admit, addr[1]))
+            if data is None:  # An ack, a duplicate or refused
+                return
+        elif not self.admit(addr[1], data):
+            return
+        if is_fragment(data):
+            data = self.reassembler.add(addr, data)
+            if data is None:  # More fragments to come
+                return
+        client_ip, client_port = addr[0], addr[1]
+
+        try:
+            if wire.is_message(data):
+                message_type, message = wire.decode(data)
             else:
-                result = "AUTH_RESULT:FAIL:Invalid credentials"
-
-    conn.close()
-    server_socket.sendto(result.encode(), (client_ip, client_port))
-
-def get_dm_history(username):
-    """Fetch all DM history for a given username (both sent and received)"""
-    conn = sqlite3.connect("userdata.db")
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        SELECT DISTINCT sender_username, recipient_username, message, timestamp
-        FROM dm_histories
-        WHERE sender_username=? OR recipient_username=?
-        ORDER BY timestamp
-    """, (username, username))
-
-    history = cursor.fetchall()
-    conn.close()
-    return history
-
-def get_dm_history_between(user1, user2):
-    conn = sqlite3.connect("userdata.db")
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT sender_username, recipient_username, message, timestamp
-        FROM dm_histories
-        WHERE
-            (sender_username=? AND recipient_username=?) OR
-            (sender_username=? AND recipient_username=?)
-        ORDER BY timestamp
-    """, (user1, user2, user2, user1))
-    history = cursor.fetchall()
-    conn.close()
-    return history
-
-def update_user_port(username, port):
-    conn = sqlite3.connect("userdata.db")
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT OR REPLACE INTO user_ports (username, port, last_seen)
-        VALUES (?, ?, datetime('now'))
-    """, (username, port))
-    conn.commit()
-    conn.close()
-
-def get_user_ports(username):
-    conn = sqlite3.connect("userdata.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT port FROM user_ports WHERE username=?", (username,))
-    ports = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return ports
-
-
-def handle_groups(message_str, client_ip, client_port):
-    conn = sqlite3.connect("userdata.db")
-    cursor = conn.cursor()
-
-    parts = message_str.split(":")
-    action = parts[1]
-
-    if action == "create":
-        group_name = parts[2]
-        group_owner = parts[3]
-        group_members = parts[4]
-
-        group_members_list = [member for member in group_members.split(",")]
-        print(group_members_list)
-
-        verify_group_existence = """
-            SELECT username FROM user_group_owner WHERE groupname = ?
-        """
-
-        cursor.execute(verify_group_existence, (group_name, ))
-        output = cursor.fetchall()
-
-        if output:
-            result = f"GROUPS_RESULT:FAIL:Already exists a group with the name {group_name} owned by {output[0]}"
+                message = data.decode()
+                message_type = text_message_type(message)
+                if message_type not in self.dispatcher.handlers:
+                    message_type = CHAT_LINE
+            self.received.inc(message_type)
+            started = time.perf_counter()
+            result = self.dispatcher.dispatch(message_type, message, client_ip, client_port)
+            if result is None:
+                self.handler_seconds.observe(time.perf_counter() - started, message_type)
+            else:
+                self.spawn(result).add_done_callback(functools.partial(self.handler_done, message_type, started))
+        except UnicodeDecodeError:
+            return
+        except Exception as e:
+            log.error("Error: %s", e, extra=log_event("handler_error", port=client_port))
+
+    def admit(self, port, payload):
+        """Take a rate limit token for one incoming datagram, False if it must be dropped"""
+        message_class = self.message_class(payload)
+        return message_class is None or self.limiter.allow(port, message_class)
+
+    def message_class(self, payload):
+        """The rate limit class of a datagram's message, None if it is not
+        limited. A fragmented message is charged on its first fragment only."""
+        if is_fragment(payload):
+            if FRAGMENT_HEADER.unpack_from(payload)[2] != 0:
+                return None
+            payload = payload[FRAGMENT_HEADER.size:]
+        if wire.is_message(payload):
+            message_type = wire.message_name(payload)
         else:
-            insert_group_owner_data = """
-                INSERT INTO user_group_owner (groupname, username) VALUES (?, ?)
-            """
-
-            insert_group_data = """
-                INSERT INTO user_group (groupname, username) VALUES (?, ?)
-            """
-
-            cursor.execute(insert_group_owner_data, (group_name, group_owner))
-            cursor.execute(insert_group_data, (group_name, group_owner))
-
-            if group_members:
-                for member in group_members_list:
-                    cursor.execute(insert_group_data, (group_name, member))
-
-            conn.commit()
-
-            result = f"GROUPS_RESULT:OK:Created successfully the group, {group_name}"
-
-
-    elif action == "manage":
-        print("Handling group action manage")
-
-    conn.close()
-    server_socket.sendto(result.encode(), (client_ip, client_port))
-
-
-# Generate a message with all registered clients on database
-def gen_all_users():
-    all_clients = []
-    conn = sqlite3.connect("userdata.db")
-    cursor = conn.cursor()
-
-    get_all_users = """
-        SELECT username FROM userdata
-    """
-
-    cursor.execute(get_all_users)
-
-    result = cursor.fetchall()
-
-    users = ""
-
-    for user in result:
-        users += f"{user[0]},"
-
-    users = users[:-1]
-
-    conn.close()
-
-    broadcast(f"[Server] REGISTERED_USERS:{users}")
-
-
-def gen_groups_lists():
-    groups_info = "[Server] GROUPS_LISTS"
-
-    conn = sqlite3.connect("userdata.db")
-    cursor = conn.cursor()
-
-    get_group_info = """
-                     SELECT o.groupname,
-                            o.username               as owner,
-                            GROUP_CONCAT(m.username) as members
-                     FROM user_group_owner o
-                              LEFT JOIN user_group m ON o.groupname = m.groupname
-                     GROUP BY o.groupname \
-                     """
+            message_type = text_message_type(payload.decode(errors="ignore"))
+            if message_type not in self.dispatcher.handlers:
+                message_type = CHAT_LINE
+        return MESSAGE_CLASSES.get(message_type, "other")
+
+    def message_refused(self, addr):
+        self.send(f"[Server] Message not sent, it is longer than {max_message_size} bytes", addr)
+
+    def error_received(self, exc):
+        self.send_failures.inc("socket")
+        log.error("Error: %s", exc, extra=log_event("socket_error"))
+
+    def on_bus_event(self, topic, version, event):
+        if topic == "presence":
+            self.presence.apply(version, event)
+        elif topic == "directory":
+            self.directory.apply(version, event)
+        elif topic == "relay":
+            addr, payload = event
+            if addr[1] in self.presence.owned:
+                self.send_bytes(payload, addr)
+
+    # ==== helpers ==== #
+    def send(self, text, addr, reliable=True):
+        self.send_bytes(text.encode(), addr, reliable)
+
+    def encode_binary(self, name, *fields):
+        """The message in the wire codec, or None (logged) if a field does not
+        fit it, so the clients reading text still get their copy"""
+        try:
+            return wire.encode(name, *fields)
+        except wire.WireError as e:
+            self.send_failures.inc("encode")
+            log.warning("Not sent to binary clients, %s", e, extra=log_event("encode_failed", type=name))
+            return None
+
+    def encode_for(self, port, name, *fields):
+        """Encode a message with the wire codec if the client speaks it, as text
+        otherwise. None if it does not fit the wire codec."""
+        if self.presence.codec(port):
+            return self.encode_binary(name, *fields)
+        return wire.to_text(name, *fields).encode()
+
+    def send_message(self, addr, name, *fields, reliable=True):
+        payload = self.encode_for(addr[1], name, *fields)
+        if payload is not None:
+            self.send_bytes(payload, addr, reliable)
+
+    def split_by_codec(self, addrs):
+        """Group recipients into (binary, text), so each form is encoded once"""
+        binary, text = [], []
+        for addr in addrs:
+            (binary if self.presence.codec(addr[1]) else text).append(addr)
+        return binary, text
+
+    def fan_out_message(self, addrs, name, *fields):
+        binary, text = self.split_by_codec(addrs)
+        payload = self.encode_binary(name, *fields) if binary else None
+        if payload is not None:
+            self.fan_out(payload, binary)
+        if text:
+            self.fan_out(wire.to_text(name, *fields).encode(), text)
+
+    def deliver_message(self, addrs, name, *fields):
+        binary, text = self.split_by_codec(addrs)
+        payload = self.encode_binary(name, *fields) if binary else None
+        if payload is not None:
+            self.deliver(payload, binary)
+        if text:
+            self.deliver(wire.to_text(name, *fields).encode(), text)
+
+    def send_bytes(self, payload, addr, reliable=True):
+        """Send one datagram to a client.
+
+        Reliable sends are retransmitted until acknowledged, if the client
+        speaks the reliability layer. A client's acks reach the worker that
+        owns it, so a reliable send to another worker's client is relayed to
+        that worker over the cluster bus.
+        """
+        reliable = reliable and reliable_delivery
+        port = addr[1]
+        if reliable and port in self.clients and port not in self.presence.owned:
+            self.bus.publish("relay", (addr, payload))
+            return
+        reliable = reliable and self.reliable.knows(addr)
+        for datagram in self.fragmenter.split(payload):
+            if reliable:
+                self.reliable.send(addr, datagram)
+            else:
+                self.transport.sendto(datagram, addr)
+
+    def fan_out(self, payload, addrs):
+        """Best-effort send to many clients, split into fragments if needed"""
+        for datagram in self.fragmenter.split(payload):
+            self.fanout.send(datagram, addrs)
+
+    def deliver(self, payload, addrs):
+        """Send `payload` to several clients: reliably where possible, the rest in one fan-out"""
+        if not reliable_delivery:
+            self.fan_out(payload, addrs)
+            return
+        plain = []
+        for addr in addrs:
+            if self.reliable.knows(addr) or (addr[1] in self.clients and addr[1] not in self.presence.owned):
+                self.send_bytes(payload, addr)
+            else:
+                plain.append(addr)
+        self.fan_out(payload, plain)
 
-    cursor.execute(get_group_info)
+    def transmit(self, addr, datagram):
+        self.transport.sendto(datagram, addr)
 
-    for group_name, group_owner, group_members in cursor.fetchall():
-        # Handle cases where a group might have no members other than the owner yet
-        groups_info += f":{group_name},{group_owner},{group_members or ''}"
+    async def retransmit_loop(self):
+        while True:
+            await asyncio.sleep(reliable_tick)
+            self.reliable.poll()
 
-    conn.close()
-    broadcast(groups_info)
+    def reliable_gave_up(self, addr, payload):
+        self.send_failures.inc("gave_up")
+        log.warning("Gave up delivering to %s:%s: %r", addr[0], addr[1], payload[:40],
+                    extra=log_event("gave_up", ip=addr[0], port=addr[1]))
 
+    def broadcast(self, text, exclude=None, owned_only=False):
+        """Send `text` to all clients, except the one with `exclude` port.
 
-while True:
-    try:
-        message, (client_ip, client_port) = server_socket.recvfrom(buffer_size)
-        message_str = message.decode()
-
-        # Handle connection messages
-        if message_str.startswith("connected @"):
-            print(f"{Colors.BLUE}{Colors.BG_DARK}New connection: {client_ip}:{client_port}{Colors.END}")
-            with clients_lock:
-                clients[client_port] = (client_ip, time.time())
-                # Build COMPLETE client info with both ports and usernames
-                client_info = []
-                for port in clients:
-                    username = client_users.get(port, f"Guest_{port}")
-                    client_info.append(f"{port}:{username}")
-                client_list = ",".join(client_info)
-
-            # 1. Welcome message
-            server_socket.sendto(f"[Server] Connected as {client_ip}:{client_port}".encode(), (client_ip, client_port))
-            # 2. Complete client list
-            server_socket.sendto(f"[Server] CLIENTS:{client_list}".encode(), (client_ip, client_port))
-            # 3. Their own username assignment (even if guest)
-            username = client_users.get(client_port, f"Guest_{client_port}")
-            server_socket.sendto(f"[Server] USERNAME:{client_port}:{username}".encode(), (client_ip, client_port))
-
-            # Then broadcast to ALL other clients about the new connection
-            broadcast(f"[Server] {client_port} joined\n[Server] CLIENTS:{client_list}", exclude=client_port)
-            continue
+        Every worker shares the listening port, so clients owned by other workers
+        are reached directly. `owned_only` limits the send to this worker's own
+        clients, for pushes every worker makes on its own schedule.
+        """
+        self.fan_out(text.encode(), self.recipients(exclude, owned_only))
+
+    def broadcast_message(self, name, *fields, exclude=None, owned_only=False):
+        """Like broadcast, for a wire message"""
+        self.fan_out_message(self.recipients(exclude, owned_only), name, *fields)
+
+    def recipients(self, exclude=None, owned_only=False):
+        owned = self.presence.owned
+        return [(ip, port) for port, (ip, _) in self.clients.items()
+                if port != exclude and (not owned_only or port in owned)]
+
+    def fanout_failed(self, addrs):
+        self.send_failures.inc("fanout", amount=len(addrs))
+        # If fails, remove client from list
+        for _, port in addrs:
+            if port in self.clients:
+                self.presence.disconnect(port)
+
+    def fanout_report(self, recipients, failed, seconds):
+        self.fanout_recipients.observe(recipients)
+        self.fanout_seconds.observe(seconds)
+        if failed or seconds > fanout_slow_report:
+            log.warning("Fan-out to %d clients took %.1f ms, %d failed", recipients, seconds * 1000, failed,
+                        extra=log_event("slow_fanout", recipients=recipients, seconds=seconds, failed=failed))
+
+    async def report_handlers(self):
+        """Print the handlers that kept the event loop busiest, every handler_report_interval seconds"""
+        while True:
+            await asyncio.sleep(handler_report_interval)
+            lines = self.dispatcher.report()
+            if lines:
+                log.info("Busiest handlers, worker %d, last %d s:\n%s", os.getpid(), handler_report_interval,
+                         "\n".join(lines), extra=log_event("busiest_handlers"))
+            self.dispatcher.reset()
+
+    # ==== overload ==== #
+    async def watch_load(self):
+        """Set the limiter's load level from how late the event loop wakes up.
+
+        A sleep that overruns means callbacks are queued behind each other.
+        The lag is smoothed so one slow handler does not shed anything, and
+        each threshold of overload_lag it passes sheds one more class.
+        """
+        loop = asyncio.get_running_loop()
+        lag = 0.0
+        while True:
+            started = loop.time()
+            await asyncio.sleep(overload_check_interval)
+            lag = self.loop_lag = 0.8 * lag + 0.2 * max(0.0, loop.time() - started - overload_check_interval)
+            level = sum(lag >= threshold for threshold in overload_lag)
+            if level != self.limiter.load:
+                log.warning("Load level %d -> %d, loop lag %.0f ms", self.limiter.load, level, lag * 1000,
+                            extra=log_event("load_level", level=level, lag=lag))
+                self.limiter.set_load(level)
+
+    async def report_rate_limits(self):
+        """Log the messages throttled and shed in the last rate_report_interval seconds, if any,
+        and drop the rate limit buckets of clients that went quiet"""
+        reported = {message_class: (0, 0) for message_class in self.limiter.stats}
+        while True:
+            await asyncio.sleep(rate_report_interval)
+            self.limiter.sweep()
+            changes = []
+            for message_class, stats in self.limiter.stats.items():
+                throttled, shed = reported[message_class]
+                if (stats["throttled"], stats["shed"]) != (throttled, shed):
+                    changes.append(f"{message_class} {stats['throttled'] - throttled} throttled "
+                                   f"{stats['shed'] - shed} shed")
+                    reported[message_class] = stats["throttled"], stats["shed"]
+            if changes:
+                log.warning("Rate limited, last %d s: %s", rate_report_interval, ", ".join(changes),
+                            extra=log_event("rate_limited"))
+
+    # ==== metrics ==== #
+    def register_metrics(self):
+        """Counters and histograms kept up to date as the server runs, and
+        gauges read from its components when the metrics are scraped"""
+        metrics = self.metrics
+        self.received = metrics.counter("tudp_messages_received_total", "Messages received, by type", ("type",))
+        self.handler_seconds = metrics.histogram(
+            "tudp_handler_seconds", "Time from dispatching a message to its handler finishing, "
+            "database waits included", labels=("type",))
+        self.db_seconds = metrics.histogram(
+            "tudp_db_seconds", "Time from queueing a query to its result, commit included", labels=("query",))
+        self.fanout_recipients = metrics.histogram("tudp_fanout_recipients", "Recipients per fan-out", SIZE_BUCKETS)
+        self.fanout_seconds = metrics.histogram("tudp_fanout_seconds", "Time to send a fan-out to every recipient")
+        self.send_failures = metrics.counter("tudp_send_failures_total", "Datagrams not delivered, by reason",
+                                             ("reason",))
+        metrics.gauge("tudp_sessions", "Sessions on the whole server, and owned by this worker",
+                      lambda: {"all": len(self.clients), "owned": len(self.presence.owned)}, ("scope",))
+        metrics.gauge("tudp_queue_depth", "Work waiting, by queue", self.queue_depths, ("queue",))
+        metrics.gauge("tudp_loop_lag_seconds", "Event loop lag, smoothed", lambda: self.loop_lag)
+        metrics.gauge("tudp_load_level", "Message classes shed for overload", lambda: self.limiter.load)
+        metrics.counters("tudp_idle_sessions_total", "Idle sweeps: sessions evicted, and rescheduled",
+                         lambda: self.idle.stats, ("outcome",))
+        metrics.counters("tudp_rate_limit_total", "Messages let through, throttled and shed, by class",
+                         lambda: {(message_class, outcome): count
+                                  for message_class, stats in self.limiter.stats.items()
+                                  for outcome, count in stats.items()}, ("class", "outcome"))
+        metrics.counters("tudp_fanout_total", "Fan-out totals", lambda: self.fanout.stats, ("stat",))
+        metrics.counters("tudp_reliable_total", "Reliability layer events", lambda: self.reliable.stats, ("event",))
+        metrics.counters("tudp_log_records_dropped_total", "Log records not written, sampled out or past a full queue",
+                         dropped_log_records, ("reason",))
+        metrics.counters("tudp_reassembly_total", "Fragmented payloads, by outcome",
+                         lambda: self.reassembler.stats, ("outcome",))
+        metrics.counters("tudp_typing_total", "Typing indicator updates", lambda: self.typing.stats, ("event",))
+        metrics.counters("tudp_resume_tokens_total", "Session resumption tokens", lambda: self.tokens.stats,
+                         ("outcome",))
+
+    def queue_depths(self):
+        return {
+            "db_writes": self.storage.pending_writes(),
+            "fanout": len(self.fanout.pending),
+            "tasks": len(self.tasks),
+            "reliable": sum(len(peer.unacked) + len(peer.waiting) for peer in list(self.reliable.peers.values())),
+            "typing": len(self.typing.pending),
+            "reassembly": len(self.reassembler.partials),
+        }
+
+    # ==== profiling ==== #
+    def start_profile(self, seconds=profile_seconds):
+        """Sample the event loop for `seconds`, called on SIGUSR1 and for --profile"""
+        path = os.path.join(profile_dir, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.collapsed")
+        if self.profiler.start(seconds, path, self.profile_done):
+            log.info("Profiling worker %d for %s s", os.getpid(), seconds, extra=log_event("profile_start"))
+        else:
+            log.warning("Worker %d is already profiling", os.getpid(), extra=log_event("profile_start"))
+
+    def profile_done(self, path, lines):
+        # Called from the profiler's thread, logging is all it does
+        log.info("Profile of worker %d written to %s\n%s", os.getpid(), path, "\n".join(lines),
+                 extra=log_event("profile_done", path=path))
+
+    def handler_done(self, message_type, started, task):
+        self.handler_seconds.observe(time.perf_counter() - started, message_type)
+
+    def spawn(self, coro):
+        """Run a handler coroutine concurrently with the receive path"""
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Error: %s", task.exception(), exc_info=task.exception(), extra=log_event("task_error"))
+
+    async def db_read(self, func, *args):
+        """Run a query from `storage` on a reader connection"""
+        started = time.perf_counter()
+        try:
+            return await asyncio.wrap_future(self.storage.read(func, *args))
+        finally:
+            self.db_seconds.observe(time.perf_counter() - started, func.__name__)
+
+    async def db_write(self, func, *args):
+        """Queue a query from `storage` on the writer thread and wait for its commit"""
+        started = time.perf_counter()
+        try:
+            return await asyncio.wrap_future(self.storage.write(func, *args))
+        finally:
+            self.db_seconds.observe(time.perf_counter() - started, func.__name__)
+
+    async def db_write_behind(self, func, *args):
+        """Queue a query on the writer thread and wait only until it ran, for
+        messages relayed with their id: the commit follows within
+        db_flush_interval, and a failed one is logged"""
+        started = time.perf_counter()
+        ran, committed = self.storage.write_behind(func, *args)
+        committed.add_done_callback(self.write_behind_done)
+        try:
+            return await asyncio.wrap_future(ran)
+        finally:
+            self.db_seconds.observe(time.perf_counter() - started, func.__name__)
+
+    def write_behind_done(self, committed):
+        # Called on the writer thread, logging is all it does
+        if not committed.cancelled() and committed.exception() is not None:
+            log.error("Relayed message not saved: %s", committed.exception(), extra=log_event("write_lost"))
+
+    async def send_rows(self, rows, addr):
+        """Send history rows, (message name, fields) pairs, packed into
+        HISTORY_BATCH datagrams, yielding so other clients keep being served"""
+        binary = bool(self.presence.codec(addr[1]))
+        records = [record for record in (self.encode_for(addr[1], name, *fields) for name, fields in rows)
+                   if record is not None]
+        for i, payload in enumerate(pack_batches(records, history_batch_budget, binary), 1):
+            self.send_bytes(payload, addr)
+            if i % history_yield_every == 0:
+                await asyncio.sleep(0)
+
+    def client_list(self, with_ip=False, guest_default=True):
+        client_info = []
+        for port in self.clients:
+            username = self.client_users.get(port, f"Guest_{port}" if guest_default else "")
+            if with_ip:
+                client_info.append(f"{port}:{username}:{self.clients[port][0]}")
+            else:
+                client_info.append(f"{port}:{username}")
+        return ",".join(client_info)
 
-        # Handle disconnection messages
-        if message_str.startswith("disconnect @"):
-            disc_port = int(message_str.split("@")[1])
-            with clients_lock:
-                if disc_port in clients:
-                    username = client_users.pop(disc_port, f"Guest_{disc_port}")
-                    del clients[disc_port]
-                    # Build UPDATED complete list
-                    client_info = []
-                    for port in clients:
-                        uname = client_users.get(port, f"Guest_{port}")
-                        client_info.append(f"{port}:{uname}")
-                    client_list = ",".join(client_info)
-
-            # 1. Leave notification
-            broadcast(f"[Server] {username} left")
-            # 2. Updated client list
-            broadcast(f"[Server] CLIENTS:{client_list}")
-            continue
+    # ==== typing ==== #
+    def send_typing(self, key, text):
+        """Relay the latest typing state of one sender, called by the aggregator.
 
-        # Handle typing
-        if message_str.startswith("typing:"):
+        Sent as TYPING_IN (context, group name or empty, sender, text), to
+        everyone for All-chat, to the peer only for a DM, and to the group's
+        other online members for a group.
+        """
+        port, context, target = key
+        sender_name = self.client_users.get(port, str(port))
+        if context == "dm":
             try:
-                _, context, text = message_str.split(":", 2)
-                with clients_lock:
-                    sender_name = client_users.get(client_port, str(client_port))
-                # Only broadcast the typing indicator, don't let it become a regular message
-                broadcast(f"typing:{context}:{sender_name}:{text}", exclude=client_port)
-                continue
+                peer = int(target)
             except ValueError:
+                return
+            if peer in self.clients and peer != port:
+                self.send_message(self.presence.address(peer), "TYPING_IN", "dm", "", sender_name, text,
+                                  reliable=False)
+        elif context == "group":
+            if not self.directory.is_member(target, sender_name):
+                return
+            self.fan_out_message([self.presence.address(member_port)
+                                  for member_port in self.presence.ports_of_any(self.directory.members_of(target))
+                                  if member_port != port],
+                                 "TYPING_IN", "group", target, sender_name, text)
+        else:
+            self.broadcast_message("TYPING_IN", "all", "", sender_name, text, exclude=port)
+
+    def forget_client(self, version, event):
+        if event[0] == "disconnect":
+            port = event[1]
+            self.idle.discard(port)
+            # Its rate limit buckets stay until they refill, see limiter.sweep(): a
+            # client reconnecting right away must not start over with full ones
+            self.typing.forget(port)
+            for addr in [addr for addr in self.reliable.peers if addr[1] == port]:
+                self.reliable.forget(addr)
+            for addr in {key[0] for key in self.reassembler.partials if key[0][1] == port}:
+                self.reassembler.forget(addr)
+
+    # ==== presence ==== #
+    def send_presence_delta(self, version, event):
+        """Tell this worker's clients about one numbered presence change.
+
+        [Server] PRESENCE:<version>:JOIN:<port>:<username>:<ip>
+        [Server] PRESENCE:<version>:RENAME:<port>:<username>
+        [Server] PRESENCE:<version>:LEAVE:<port>
+        A client whose version is not exactly one behind asks for a snapshot.
+        """
+        kind, port = event[0], event[1]
+        if kind == "connect":
+            self.broadcast_message("PRESENCE_JOIN", version, port, self.client_users.get(port, ""), event[2],
+                                   owned_only=True)
+        elif kind == "username":
+            self.broadcast_message("PRESENCE_RENAME", version, port, event[2], owned_only=True)
+        else:
+            self.broadcast_message("PRESENCE_LEAVE", version, port, owned_only=True)
+
+    def send_presence_snapshot(self, addr):
+        """[Server] PRESENCE_SNAPSHOT:<version>:<port>:<username>:<ip>,..."""
+        self.send(f"[Server] PRESENCE_SNAPSHOT:{self.presence.version}:"
+                  f"{self.client_list(with_ip=True, guest_default=False)}", addr)
+
+    def handle_presence_sync(self, client_ip, client_port):
+        """PRESENCE_SYNC:<known version>, sent by a client that missed a delta"""
+        self.send_presence_snapshot((client_ip, client_port))
+
+    # ==== directory ==== #
+    def send_directory_change(self, event):
+        """Push a new user to every client of this worker, a new group only to its online members"""
+        if event[0] == "user":
+            self.broadcast(f"[Server] REGISTERED_USERS_ADD:{event[1]}", owned_only=True)
+        elif event[0] == "group":
+            _, group_name, owner, members = event
+            text = f"[Server] GROUPS_ADD:{format_group(group_name, (owner, members))}"
+            self.deliver(text.encode(), [self.presence.address(port) for port in self.presence.owned
+                                         if self.client_users.get(port) in members and port in self.clients])
+
+    async def periodic_client_updates(self):
+        """Every few seconds, announce the presence version if it moved, so a
+        client that lost the last delta notices the gap. An idle server sends
+        no presence traffic at all."""
+        while True:
+            await asyncio.sleep(client_update_interval)
+            if not self.presence.owned:  # Only send if there are clients
                 continue
+            if self.presence.version != self.beacon_version:
+                self.beacon_version = self.presence.version
+                self.broadcast(f"[Server] PRESENCE_VERSION:{self.beacon_version}", owned_only=True)
+
+    # ==== datagram routing ==== #
+    def register_handlers(self):
+        """Fill the dispatch table, keyed on the message type.
+
+        Wire messages are keyed by name and their handlers get the decoded
+        fields. Text messages are keyed by their prefix (see
+        text_message_type) and their handlers get the whole line. A handler
+        returning a coroutine has it run as a task of its own.
+        """
+        handlers = {
+            # Binary wire codec
+            "CONNECT": lambda fields, ip, port: self.handle_connect(ip, port, codec=wire.VERSION),
+            "TYPING": lambda fields, ip, port: self.typing.update((port, fields[0], fields[1]), fields[2]),
+            "CHAT": lambda fields, ip, port: self.handle_chat(fields[0], port),
+            "DM": lambda fields, ip, port: self.handle_dm(*fields, ip, port),
+            "DM_TO": lambda fields, ip, port: self.handle_dm_to(*fields, ip, port),
+            "MAILBOX_ACK": lambda fields, ip, port: self.handle_mailbox_ack(fields[0], ip, port),
+            "GROUP_MSG": lambda fields, ip, port: self.handle_group_msg(*fields, port),
+            "REQUEST_MY_DM_HISTORY": lambda fields, ip, port: self.handle_my_dm_history(*fields, ip, port),
+            "REQUEST_DM_HISTORY": lambda fields, ip, port: self.handle_dm_history(*fields, ip, port),
+            "REQUEST_GROUP_HISTORY": lambda fields, ip, port: self.handle_group_history(*fields, ip, port),
+
+            "RESUME": lambda fields, ip, port: self.handle_resume(*fields, ip, port, codec=wire.VERSION),
+            "HEARTBEAT": lambda fields, ip, port: self.handle_heartbeat(ip, port),
+
+            # Text protocol
+            "connected @": lambda message_str, ip, port: self.handle_connect(ip, port),
+            "HEARTBEAT:": lambda message_str, ip, port: self.handle_heartbeat(ip, port),
+            "RESUME:": self.parse_resume,
+            "disconnect @": lambda message_str, ip, port: self.handle_disconnect(message_str),
+            "PRESENCE_SYNC:": lambda message_str, ip, port: self.handle_presence_sync(ip, port),
+            "typing:": self.parse_typing,
+            "AUTH:": self.handle_auth,
+            "REQUEST_MY_DM_HISTORY:": self.parse_my_dm_history_request,
+            "REQUEST_DM_HISTORY:": self.parse_dm_history_request,
+            "DM:": self.parse_dm,
+            "DM_TO:": self.parse_dm_to,
+            "MAILBOX_ACK:": self.parse_mailbox_ack,
+            "FILE_REQ:": self.handle_file_request,
+            "FILE_RES:": self.handle_file_response,
+            "GROUPS:": self.handle_groups,
+            "GROUP_MSG:": self.parse_group_msg,
+            "REQUEST_GROUP_HISTORY:": self.parse_group_history_request,
+            CHAT_LINE: lambda message_str, ip, port: self.handle_chat(message_str, port),
+        }
+        for message_type, handler in handlers.items():
+            self.dispatcher.register(message_type, handler)
+
+    def parse_typing(self, message_str, client_ip, client_port):
+        # typing:<context>:<DM peer port or group name, empty for All-chat>:<text>
+        try:
+            _, context, target, text = message_str.split(":", 3)
+        except ValueError:
+            return
+        # Only relay the typing indicator, don't let it become a regular message
+        self.typing.update((client_port, context, target), text)
+
+    def parse_my_dm_history_request(self, message_str, client_ip, client_port):
+        # REQUEST_MY_DM_HISTORY:username[:since_id:before_id:limit]
+        parts = message_str.split(":")
+        return self.handle_my_dm_history(parts[1], *parse_history_cursor(parts[2:]), client_ip, client_port)
+
+    def parse_dm_history_request(self, message_str, client_ip, client_port):
+        # REQUEST_DM_HISTORY:user1:user2[:since_id:before_id:limit]
+        parts = message_str.split(":")
+        if len(parts) < 3:
+            return None
+        return self.handle_dm_history(parts[1], parts[2], *parse_history_cursor(parts[3:]), client_ip, client_port)
+
+    def parse_dm(self, message_str, client_ip, client_port):
+        try:
+            _, recipient_port, dm_content = message_str.split(":", 2)
+            recipient_port = int(recipient_port)
+        except ValueError as e:
+            log.warning("DM parse error: %s", e, extra=log_event("parse_error", port=client_port))
+            return None
+        return self.handle_dm(recipient_port, dm_content, client_ip, client_port)
+
+    def parse_dm_to(self, message_str, client_ip, client_port):
+        try:
+            _, recipient_name, dm_content = message_str.split(":", 2)
+        except ValueError as e:
+            log.warning("DM parse error: %s", e, extra=log_event("parse_error", port=client_port))
+            return None
+        return self.handle_dm_to(recipient_name, dm_content, client_ip, client_port)
+
+    def parse_mailbox_ack(self, message_str, client_ip, client_port):
+        try:
+            up_to_id = int(message_str.split(":", 1)[1])
+        except ValueError as e:
+            log.warning("MAILBOX_ACK parse error: %s", e, extra=log_event("parse_error", port=client_port))
+            return None
+        return self.handle_mailbox_ack(up_to_id, client_ip, client_port)
+
+    def parse_group_msg(self, message_str, client_ip, client_port):
+        try:
+            _, group_name, content = message_str.split(":", 2)
+        except ValueError as e:
+            log.warning("GROUP_MSG parse error: %s", e, extra=log_event("parse_error", port=client_port))
+            return None
+        return self.handle_group_msg(group_name, content, client_port)
+
+    def parse_group_history_request(self, message_str, client_ip, client_port):
+        # REQUEST_GROUP_HISTORY:group_name[:since_id:before_id:limit]
+        parts = message_str.split(":")
+        return self.handle_group_history(parts[1], *parse_history_cursor(parts[2:]), client_ip, client_port)
+
+    def handle_chat(self, content, client_port):
+        # Broadcast regular messages with sender info
+        sender_name = self.client_users.get(client_port, str(client_port))
+        log.info("%s> %s", sender_name, content, extra=log_event("chat", sender=sender_name))
+        self.broadcast_message("CHAT_IN", sender_name, content, exclude=client_port)
+
+    # ==== file transfer ==== #
+    def handle_file_request(self, message_str, client_ip, client_port):
+        try:
+            _, recipient_port, filename, filesize = message_str.split(":", 3)
+            recipient_port = int(recipient_port)
+            if recipient_port in self.clients:
+                # Forward to recipient
+                self.send(f"FILE_REQ:{client_port}:{filename}:{filesize}",
+                          (self.clients[recipient_port][0], recipient_port))
+        except Exception as e:
+            log.warning("File request error: %s", e, extra=log_event("file_error", port=client_port))
+
+    def handle_file_response(self, message_str, client_ip, client_port):
+        try:
+            _, sender_port, status = message_str.split(":", 2)
+            sender_port = int(sender_port)
+            if sender_port in self.clients:
+                # Forward to sender
+                self.send(f"FILE_RES:{client_port}:{status}",
+                          (self.clients[sender_port][0], sender_port))
+        except Exception as e:
+            log.warning("File response error: %s", e, extra=log_event("file_error", port=client_port))
+
+    # ==== connection handling ==== #
+    def handle_connect(self, client_ip, client_port, codec=None):
+        log.info("New connection: %s:%s", client_ip, client_port,
+                 extra=log_event("connect", ip=client_ip, port=client_port))
+        self.presence.connect(client_port, client_ip, codec)
+        self.idle.touch(client_port)
+
+        # 1. Welcome message
+        self.send(f"[Server] Connected as {client_ip}:{client_port}", (client_ip, client_port))
+        # 2. Who is online, everyone else learns about the new client from its JOIN delta
+        self.send_presence_snapshot((client_ip, client_port))
+        # 3. Their own username assignment (even if guest)
+        username = self.client_users.get(client_port, f"Guest_{client_port}")
+        self.send(f"[Server] USERNAME:{client_port}:{username}", (client_ip, client_port))
+        # 4. Registered users, later registrations arrive as REGISTERED_USERS_ADD
+        self.send(self.directory.users_message(), (client_ip, client_port))
+
+        self.broadcast(f"[Server] {client_port} joined", exclude=client_port)
+
+    def handle_heartbeat(self, client_ip, client_port):
+        # Receiving it was the point, unless the session was evicted while the client was cut off
+        if client_port not in self.clients:
+            self.send("[Server] SESSION_EXPIRED", (client_ip, client_port), reliable=False)
+
+    def parse_resume(self, message_str, client_ip, client_port):
+        try:
+            _, username, token, last_dm_id = message_str.split(":", 3)
+            last_dm_id = int(last_dm_id) if last_dm_id else None
+        except ValueError as e:
+            log.warning("RESUME parse error: %s", e, extra=log_event("parse_error", port=client_port))
+            return None
+        return self.handle_resume(username, token, last_dm_id, client_ip, client_port)
+
+    async def handle_resume(self, username, token, last_dm_id, client_ip, client_port, codec=None):
+        """Give a logged in client its session back after it lost its
+        connection, on the strength of the token it was issued, with no
+        password check. Its username and groups come from memory, and it is
+        only sent the DMs after `last_dm_id`, the newest it has, and its
+        mailbox. Nobody is told it joined, only the presence deltas go out."""
+        addr = (client_ip, client_port)
+        if not self.tokens.verify(username, token):
+            self.send("RESUME_RESULT:FAIL:Session expired, please log in again", addr)
+            return
+
+        # The session it left behind, if it now comes from another port
+        for port in list(self.presence.ports_of(username)):
+            if port != client_port:
+                self.presence.disconnect(port)
+        if self.clients.get(client_port, (None,))[0] != client_ip:
+            self.presence.connect(client_port, client_ip, codec)
+            self.send_presence_snapshot(addr)
+            self.send(self.directory.users_message(), addr)
+        self.idle.touch(client_port)
+        if self.presence.username(client_port) != username:  # Each set is published, even to the same name
+            self.presence.set_username(client_port, username)
+
+        self.send(f"RESUME_RESULT:OK:Resumed session as {username}", addr)
+        self.send(f"[Server] RESUME_TOKEN:{username}:{self.tokens.issue(username)}", addr)
+        self.send(f"[Server] USERNAME:{client_port}:{username}", addr)
+        self.send(self.directory.groups_message(username), addr)
+        if last_dm_id is not None:
+            history, has_more = await self.db_read(storage.get_delivered_dm_history, username, last_dm_id,
+                                                   None, history_page_size)
+            await self.send_history_page([dm_history_row(msg) for msg in history], has_more,
+                                         "MY_DM", username, addr)
+        await self.send_mailbox_page(username, addr)
+
+    def handle_disconnect(self, message_str):
+        disc_port = int(message_str.split("@")[1])
+        if disc_port not in self.clients:
+            return
+        self.end_session(disc_port)
+
+    def end_session(self, port):
+        username = self.presence.disconnect(port)
+        # Leave notification, the LEAVE delta updates the client lists
+        self.broadcast(f"[Server] {username} left")
+
+    async def sweep_idle_sessions(self):
+        """Evict this worker's clients that sent nothing for session_timeout
+        seconds, they crashed or lost their connection without saying goodbye"""
+        while True:
+            await asyncio.sleep(session_sweep_tick)
+            for port in self.idle.expire():
+                if port in self.presence.owned:
+                    log.warning("Evicting idle session %s", port, extra=log_event("idle_evicted", port=port))
+                    self.end_session(port)
+
+    # ==== authentication ==== #
+    async def handle_auth(self, message_str, client_ip, client_port):
+        addr = (client_ip, client_port)
+        parts = message_str.split(":")
+        action = parts[1]  # Get the action (login, register, or enter)
+
+        if action == "enter":
+            username = f"Guest_{client_port}"
+            self.presence.set_username(client_port, username)
+            self.send(f"AUTH_RESULT:OK:Entered as {username}", addr)
+            # The RENAME delta carries the new name to everyone
+            self.broadcast(f"[Server] {username} joined the chat")
+            return
+
+        # Handle authenticated access (login/register)
+        if len(parts) != 4:
+            self.send("AUTH_RESULT:FAIL:Invalid authentication format", addr)
+            return
+
+        username = parts[2]
+        password = parts[3]
+        result = f"AUTH_RESULT:FAIL:Unknown action {action}"
+
+        if action == "register":
+            if len(username.encode()) > max_name_bytes:
+                result = f"AUTH_RESULT:FAIL:Username longer than {max_name_bytes} bytes"
+            elif await self.db_write(storage.register_user, username, password):
+                result = f"AUTH_RESULT:OK:User {username} registered successfully"
+                self.presence.set_username(client_port, username)
+                self.directory.add_user(username)
+                self.send(f"[Server] RESUME_TOKEN:{username}:{self.tokens.issue(username)}", addr)
+                self.send(self.directory.groups_message(username), addr)
+            else:
+                result = "AUTH_RESULT:FAIL:Username already exists"
 
-        # Handle authentication
-        if message_str.startswith("AUTH:"):
-            handle_auth(message_str, client_ip, client_port)
-            continue
-
-        # Handle DM's
-        if any(message_str.startswith(prefix) for prefix in [
-            "REQUEST_DM_HISTORY:",
-            "REQUEST_MY_DM_HISTORY:",
-            "DM:"
-        ]):
-            # Process but don't broadcast
-            if message_str.startswith("REQUEST_MY_DM_HISTORY:"):
-                try:
-                    _, username = message_str.split(":", 1)
-                    history = get_dm_history(username)
-                    for msg in history:
-                        history_msg = f"DM_HISTORY:{msg[0]}:{msg[1]}:{msg[2]}:{msg[3]}"
-                        server_socket.sendto(history_msg.encode(), (client_ip, client_port))
-                except ValueError as e:
-                    print(f"Error processing MY_DM_HISTORY: {e}")
-                continue  # Skip broadcasting
-            if message_str.startswith("DM:"):
-                try:
-                    _, recipient_port, dm_content = message_str.split(":", 2)
-                    recipient_port = int(recipient_port)
-                    with clients_lock:
-                        sender_name = client_users.get(client_port, str(client_port))
-                        recipient_name = client_users.get(recipient_port, str(recipient_port))
-                        if recipient_port in clients:
-                            dm_msg = f"DM:{client_port}:{dm_content}"
-                            server_socket.sendto(dm_msg.encode(), (clients[recipient_port][0], recipient_port))
-
-                            # Store in DB if both users are authenticated
-                            if not sender_name.startswith("Guest_") and not recipient_name.startswith("Guest_"):
-                                conn = sqlite3.connect("userdata.db")
-                                cursor = conn.cursor()
-                                cursor.execute("""
-                                               INSERT INTO dm_histories (sender_username, recipient_username, message)
-                                               VALUES (?, ?, ?)
-                                               """, (sender_name, recipient_name, dm_content))
-                                conn.commit()
-                                conn.close()
-
-                            # Notify both parties
-                            notify_dm = f"DM_NOTIFY:{client_port}:{recipient_port}"
-                            server_socket.sendto(notify_dm.encode(), (clients[recipient_port][0], recipient_port))
-                            server_socket.sendto(notify_dm.encode(), (client_ip, client_port))
-                except Exception as e:
-                    print("DM parse error: ", e)
-
-            elif message_str.startswith("REQUEST_DM_HISTORY:"):
-                try:
-                    parts = message_str.split(":")
-                    if len(parts) == 3:  # REQUEST_DM_HISTORY:user1:user2
-                        _, user1, user2 = parts
-                        history = get_dm_history_between(user1, user2)
-                        for msg in history:
-                            history_msg = f"DM_HISTORY:{msg[0]}:{msg[1]}:{msg[2]}:{msg[3]}"
-                            server_socket.sendto(history_msg.encode(), (client_ip, client_port))
-                except ValueError as e:
-                    print(f"Error processing DM history request: {e}")
-
-            elif message_str.startswith("REQUEST_MY_DM_HISTORY:"):
-                try:
-                    _, username = message_str.split(":", 1)
-                    history = get_dm_history(username)
-                    for msg in history:
-                        history_msg = f"DM_HISTORY:{msg[0]}:{msg[1]}:{msg[2]}:{msg[3]}"
-                        server_socket.sendto(history_msg.encode(), (client_ip, client_port))
-                except ValueError as e:
-                    print(f"Error processing MY_DM_HISTORY request: {e}")
-
-            continue  # Skip broadcasting these messages to all clients
-
-        # Handle file transfer requests
-        if message_str.startswith("FILE_REQ:"):
-            try:
-                _, recipient_port, filename, filesize = message_str.split(":", 3)
-                recipient_port = int(recipient_port)
-                if recipient_port in clients:
-                    # Forward to recipient
-                    server_socket.sendto(f"FILE_REQ:{client_port}:{filename}:{filesize}".encode(),
-                                         (clients[recipient_port][0], recipient_port))
-            except Exception as e:
-                print("File req error:", e)
-            continue
+        elif action == "login":
+            # First check if username is already in use
+            if self.presence.is_logged_in(username):
+                result = f"AUTH_RESULT:FAIL:Username {username} is already in use"
+            else:
+                db_password = await self.db_read(storage.get_password, username)
+                # Another login for the same name may have finished while we waited on the DB
+                if self.presence.is_logged_in(username):
+                    result = f"AUTH_RESULT:FAIL:Username {username} is already in use"
+                elif db_password is not None and db_password == password:
+                    result = f"AUTH_RESULT:OK:User {username} logged in successfully"
+                    self.presence.set_username(client_port, username)
+                    self.send(f"[Server] RESUME_TOKEN:{username}:{self.tokens.issue(username)}", addr)
+                    self.send(self.directory.groups_message(username), addr)
+                    # Track this user-port association
+                    self.spawn(self.db_write(storage.update_user_port, username, str(client_port)))
+
+                    # Send the latest page of DM history, but for the queued DMs...
+                    history, has_more = await self.db_read(storage.get_delivered_dm_history, username,
+                                                           None, None, history_page_size)
+                    await self.send_history_page([dm_history_row(msg) for msg in history], has_more,
+                                                 "MY_DM", username, addr)
+                    # ...which follow as the mailbox, what was sent to us while we were offline
+                    await self.send_mailbox_page(username, addr)
+
+                    # Notify client, the RENAME delta updates everyone else
+                    self.send(f"[Server] USERNAME:{client_port}:{username}", addr)
+                    self.broadcast(f"[Server] {username} joined the chat")
+                else:
+                    result = "AUTH_RESULT:FAIL:Invalid credentials"
+
+        self.send(result, addr)
+
+    # ==== DMs ==== #
+    async def send_history_page(self, rows, has_more, scope, key, addr):
+        """Send history rows followed by HISTORY_END (scope, key, rows, 1 if older/newer rows remain)"""
+        await self.send_rows(rows + [("HISTORY_END", (scope, key, len(rows), int(has_more)))], addr)
+
+    async def handle_my_dm_history(self, username, since_id, before_id, limit, client_ip, client_port):
+        history, has_more = await self.db_read(storage.get_dm_history, username, since_id, before_id,
+                                               page_limit(limit))
+        await self.send_history_page([dm_history_row(msg) for msg in history], has_more,
+                                     "MY_DM", username, (client_ip, client_port))
+
+    async def handle_dm_history(self, user1, user2, since_id, before_id, limit, client_ip, client_port):
+        history, has_more = await self.db_read(storage.get_dm_history_between, user1, user2,
+                                               since_id, before_id, page_limit(limit))
+        await self.send_history_page([dm_history_row(msg) for msg in history], has_more,
+                                     "DM", f"{user1},{user2}", (client_ip, client_port))
+
+    async def handle_dm(self, recipient_port, dm_content, client_ip, client_port):
+        sender_name = self.client_users.get(client_port, str(client_port))
+        recipient_name = self.client_users.get(recipient_port, str(recipient_port))
+        if recipient_port not in self.clients:
+            return
+
+        # Store in DB if both users are authenticated, the id lets clients move their history cursor
+        msg_id = None
+        if not sender_name.startswith("Guest_") and not recipient_name.startswith("Guest_"):
+            msg_id = await self.db_write_behind(storage.store_dm, sender_name, recipient_name, dm_content)
+            if recipient_port not in self.clients:
+                return
+
+        # Notify both parties
+        self.send_dm(client_port, recipient_port, msg_id, dm_content)
+        self.send_message((client_ip, client_port), "DM_NOTIFY", client_port, recipient_port, msg_id)
+
+    async def handle_dm_to(self, recipient_name, dm_content, client_ip, client_port):
+        """A DM addressed by username, between registered users. Sent at once
+        to the recipient's session if they are logged in, otherwise kept in
+        their mailbox until they log in."""
+        addr = (client_ip, client_port)
+        sender_name = self.presence.username(client_port)
+        if sender_name is None or sender_name.startswith("Guest_"):
+            self.send("[Server] Log in to send direct messages by username", addr)
+            return
+        if not self.directory.has_user(recipient_name):
+            self.send(f"[Server] No user named {recipient_name}", addr)
+            return
+
+        if self.presence.ports_of(recipient_name):
+            msg_id = await self.db_write_behind(storage.store_dm, sender_name, recipient_name, dm_content)
+            if not self.presence.ports_of(recipient_name):  # Logged out while we saved it
+                await self.db_write_behind(storage.queue_dm, msg_id, recipient_name)
+        else:
+            msg_id = await self.db_write_behind(storage.store_offline_dm, sender_name, recipient_name, dm_content)
+
+        # Logged in meanwhile, the mailbox sends it again and the client drops the duplicate id
+        recipient_ports = list(self.presence.ports_of(recipient_name))
+        for recipient_port in recipient_ports:
+            self.send_dm(client_port, recipient_port, msg_id, dm_content)
+        if recipient_ports:
+            self.send_message(addr, "DM_NOTIFY", client_port, recipient_ports[0], msg_id)
+        else:
+            self.send(f"[Server] {recipient_name} is offline, they get your message when they log in", addr)
+
+    def send_dm(self, sender_port, recipient_port, msg_id, dm_content):
+        recipient_addr = self.presence.address(recipient_port)
+        self.send_message(recipient_addr, "DM_IN", sender_port, msg_id, dm_content)
+        self.send_message(recipient_addr, "DM_NOTIFY", sender_port, recipient_port, msg_id)
+
+    # ==== offline mailbox ==== #
+    async def send_mailbox_page(self, username, addr):
+        """Send the oldest queued DMs of `username` as DM_HISTORY rows, in
+        HISTORY_BATCH datagrams, ended by MAILBOX_END. They stay queued until
+        the client acknowledges them, the ack then asks for the next page.
+
+        Reliable datagrams may arrive out of order, so MAILBOX_END, which the
+        client acks, is only sent once all the rows were acknowledged."""
+        rows, has_more = await self.db_read(storage.get_mailbox, username, mailbox_page_size)
+        if rows:
+            await self.send_rows([dm_history_row(msg) for msg in rows], addr)
+            if await self.delivered(addr):
+                self.send_message(addr, "MAILBOX_END", rows[-1][0], len(rows), int(has_more))
+
+    def delivered(self, addr):
+        """A future of whether everything sent reliably to `addr` so far was
+        acknowledged, see ReliableEndpoint.when_delivered"""
+        future = asyncio.get_running_loop().create_future()
+        self.reliable.when_delivered(addr, lambda delivered: future.done() or future.set_result(delivered))
+        return future
+
+    async def handle_mailbox_ack(self, up_to_id, client_ip, client_port):
+        username = self.presence.username(client_port)
+        if username is None or username.startswith("Guest_"):
+            return
+        await self.db_write(storage.ack_mailbox, username, up_to_id)
+        await self.send_mailbox_page(username, (client_ip, client_port))
+
+    # ==== Groups ==== #
+    async def handle_groups(self, message_str, client_ip, client_port):
+        parts = message_str.split(":")
+        action = parts[1]
+        result = None
+
+        if action == "create":
+            group_name = parts[2]
+            group_owner = parts[3]
+            group_members = parts[4]
+
+            group_members_list = [member for member in group_members.split(",")] if group_members else []
+            if len(group_name.encode()) > max_name_bytes:
+                self.send(f"GROUPS_RESULT:FAIL:Group name longer than {max_name_bytes} bytes",
+                          (client_ip, client_port))
+                return
+            log.debug("Creating group %s of %s: %s", group_name, group_owner, group_members_list,
+                      extra=log_event("group_create", group=group_name))
+
+            output = await self.db_write(storage.create_group, group_name, group_owner, group_members_list)
+            if output:
+                result = f"GROUPS_RESULT:FAIL:Already exists a group with the name {group_name} owned by {output}"
+            else:
+                result = f"GROUPS_RESULT:OK:Created successfully the group, {group_name}"
+                self.directory.add_group(group_name, group_owner,
+                                         [group_owner] + [member for member in group_members_list if member])
+
+        elif action == "manage":
+            log.debug("Handling group action manage", extra=log_event("group_manage"))
+
+        if result:
+            self.send(result, (client_ip, client_port))
+
+    async def handle_group_msg(self, group_name, content, client_port):
+        sender_name = self.client_users.get(client_port, f"Guest_{client_port}")
+
+        # Only members with an account get their messages saved and relayed
+        if sender_name.startswith("Guest_"):
+            return
+
+        msg_id = await self.db_write_behind(storage.store_group_message, group_name, sender_name, content)
+
+        # Relay to the online members, looked up in memory once the message has its id
+        self.deliver_message([self.presence.address(port)
+                              for port in self.presence.ports_of_any(self.directory.members_of(group_name))],
+                             "GROUP_MSG_IN", group_name, msg_id, sender_name, content)
+
+    async def handle_group_history(self, group_name, since_id, before_id, limit, client_ip, client_port):
+        history, has_more = await self.db_read(storage.get_group_history, group_name, since_id, before_id,
+                                               page_limit(limit))
+        await self.send_history_page(
+            [("GROUP_HISTORY_MSG", (group_name, msg_id, sender, msg, ts)) for msg_id, sender, msg, ts in history],
+            has_more, "GROUP", group_name, (client_ip, client_port))
+
+
+async def main(bus=None, reuse_port=False, time_handlers=False, resume_key=None, metrics_port=None, profile=None):
+    loop = asyncio.get_running_loop()
+    if not reuse_port:
+        # In worker mode the parent process has already done this
+        await loop.run_in_executor(None, init_database)
+    db = Storage(db_path, readers=db_readers, flush_interval=db_flush_interval, max_batch=db_max_batch)
+    users, groups = await asyncio.wrap_future(db.read(storage.load_directory))
+
+    transport, server = await loop.create_datagram_endpoint(
+        lambda: ChatServer(db, bus, users, groups, time_handlers, resume_key), local_addr=(local_IP, local_port),
+        allow_broadcast=True, reuse_port=reuse_port)
+    updates = loop.create_task(server.periodic_client_updates())
+    if profile:
+        server.start_profile(profile)
+    metrics_server = None
+    if metrics_port:
+        metrics_server = await serve_metrics(server.metrics, metrics_host, metrics_port)
+        log.info("Metrics at http://%s:%d/metrics", metrics_host, metrics_port, extra=log_event("metrics_up"))
+    # Stop cleanly so the write queue is flushed before we exit
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, updates.cancel)
+        except (NotImplementedError, RuntimeError):
+            pass  # Not available on Windows, Ctrl+C still cancels through asyncio.run
+    if hasattr(signal, "SIGUSR1"):
+        loop.add_signal_handler(signal.SIGUSR1, server.start_profile)
+    try:
+        await updates
+    except asyncio.CancelledError:
+        pass
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        server.profiler.stop()
+        transport.close()
+        server.bus.close()
+        await loop.run_in_executor(None, db.close)
 
-        # Handle file transfer responses
-        if message_str.startswith("FILE_RES:"):
-            try:
-                _, sender_port, status = message_str.split(":", 2)
-                sender_port = int(sender_port)
-                if sender_port in clients:
-                    # Forward to sender
-                    server_socket.sendto(f"FILE_RES:{client_port}:{status}".encode(),
-                                         (clients[sender_port][0], sender_port))
-            except Exception as e:
-                print("File res error:", e)
-            continue
 
-        # Handles Groups
-        if message_str.startswith("GROUPS:"):
-            handle_groups(message_str, client_ip, client_port)
-            continue
+def init_database():
+    for version, description in migrations.migrate(db_path):
+        log.info("Applied migration %d: %s", version, description, extra=log_event("migration", version=version))
+    log.info("Databases initialized", extra=log_event("database_ready"))
 
-        if message_str.startswith("GROUP_MSG:"):
-            try:
-                _, group_name, content = message_str.split(":", 2)
-                with clients_lock:
-                    sender_name = client_users.get(client_port, f"Guest_{client_port}")
-
-                # 1. Save to DB (only if sender is not a guest)
-                if not sender_name.startswith("Guest_"):
-                    conn = sqlite3.connect("userdata.db")
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        "INSERT INTO group_chat_histories (groupname, sender_username, message) VALUES (?, ?, ?)",
-                        (group_name, sender_name, content)
-                    )
-                    conn.commit()
-
-                    # 2. Get all members of the group
-                    cursor.execute("SELECT username FROM user_group WHERE groupname=?", (group_name,))
-                    members = [row[0] for row in cursor.fetchall()]
-                    conn.close()
-
-                    # 3. Broadcast to online members
-                    forward_msg = f"GROUP_MSG_IN:{group_name}:{sender_name}:{content}"
-                    with clients_lock:
-                        online_recipients = {port: uname for port, uname in client_users.items() if uname in members}
-                        for port, uname in online_recipients.items():
-                            if port in clients:  # Check if client is still connected
-                                member_ip, _ = clients[port]
-                                server_socket.sendto(forward_msg.encode(), (member_ip, port))
-            except Exception as e:
-                print(f"{Colors.FAIL}Error handling GROUP_MSG: {e}{Colors.END}")
-            continue
 
-            # Handle Group History Request
-        if message_str.startswith("REQUEST_GROUP_HISTORY:"):
-            try:
-                _, group_name = message_str.split(":", 1)
-                conn = sqlite3.connect("userdata.db")
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT sender_username, message, timestamp FROM group_chat_histories WHERE groupname=? ORDER BY timestamp",
-                    (group_name,)
-                )
-                history = cursor.fetchall()
-                conn.close()
-
-                for sender, msg, ts in history:
-                    history_msg = f"GROUP_HISTORY_MSG:{group_name}:{sender}:{msg}:{ts}"
-                    server_socket.sendto(history_msg.encode(), (client_ip, client_port))
-            except Exception as e:
-                print(f"{Colors.FAIL}Error handling REQUEST_GROUP_HISTORY: {e}{Colors.END}")
-            continue
+def run_worker(worker_id, bus_conn, time_handlers=False, resume_key=None, metrics_port=None, profile=None,
+               log_config=None):
+    """Entry point of one worker process in multi-process mode"""
+    listener = setup_logging(**(log_config or {}))
+    try:
+        asyncio.run(main(bus=WorkerBus(bus_conn), reuse_port=True, time_handlers=time_handlers,
+                         resume_key=resume_key, metrics_port=metrics_port and metrics_port + worker_id,
+                         profile=profile))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.stop()
+
+
+def parse_sampling(value):
+    """EVENT=N, for --log-sample"""
+    name, _, every = value.partition("=")
+    if not name or not every.isdigit() or int(every) < 1:
+        raise argparse.ArgumentTypeError(f"expected EVENT=N with N at least 1, got {value!r}")
+    return name, int(every)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Typewriter UDP chat server")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes sharing the port through SO_REUSEPORT")
+    parser.add_argument("--time-handlers", action="store_true",
+                        help=f"report the busiest message handlers every {handler_report_interval} seconds")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics on this loopback port, worker N on the port plus N")
+    parser.add_argument("--profile", type=float, metavar="SECONDS",
+                        help=f"sample the event loop for the first SECONDS, into {profile_dir}/; "
+                             f"SIGUSR1 takes a {profile_seconds} s profile at any time")
+    parser.add_argument("--log-level", default=log_level, choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help=f"least severe messages logged, default {log_level}")
+    parser.add_argument("--log-format", default=log_format, choices=("text", "json"),
+                        help="text, colored when writing to a terminal, or one JSON object per line")
+    parser.add_argument("--log-sample", type=parse_sampling, action="append", default=[], metavar="EVENT=N",
+                        help="log one in N of an event, such as chat=100 "
+                             f"(defaults: {', '.join(f'{name}={n}' for name, n in log_sampling.items())})")
+    args = parser.parse_args()
+    log_config = {"level": args.log_level, "format": args.log_format,
+                  "sample": {**log_sampling, **dict(args.log_sample)}, "queue_size": log_queue_size}
+    # The parent of several workers only logs while starting them, and writes
+    # directly: a writer thread could hold stdout's lock as a worker is forked
+    listener = setup_logging(**log_config, background=args.workers <= 1)
 
-        # Broadcast regular messages with sender info
-        with clients_lock:
-            sender_name = client_users.get(client_port, str(client_port))
-        broadcast_msg = f"{sender_name}> {message_str}"
-        print(f"{Colors.GREEN}{Colors.BG_DARK}{broadcast_msg}{Colors.END}")
-        broadcast(broadcast_msg, exclude=client_port)
-
-    except OSError as e:
-        print(f"{Colors.FAIL}{Colors.BG_DARK}Error: {e}{Colors.END}")
+    try:
+        if args.workers > 1:
+            if not hasattr(socket, "SO_REUSEPORT"):
+                parser.error("--workers needs SO_REUSEPORT, which this platform does not support")
+            init_database()
+            log.info("Starting %d workers", args.workers, extra=log_event("workers_start", workers=args.workers))
+            # One key for all workers, a client may resume on any of them
+            run_workers(args.workers, functools.partial(run_worker, time_handlers=args.time_handlers,
+                                                        resume_key=os.urandom(32), metrics_port=args.metrics_port,
+                                                        profile=args.profile, log_config=log_config))
+        else:
+            asyncio.run(main(time_handlers=args.time_handlers, metrics_port=args.metrics_port,
+                             profile=args.profile))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if listener is not None:
+            listener.stop()
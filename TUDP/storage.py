@@ -0,0 +1,372 @@
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Applied to every connection Storage opens
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",  # Readers never block the writer and vice versa
+    "PRAGMA synchronous = NORMAL",  # WAL stays consistent, fsync only at checkpoints
+    "PRAGMA busy_timeout = 5000",  # Other server workers may hold the write lock
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",  # 16 MB page cache per connection
+)
+
+
+class Storage:
+    """Long-lived SQLite connections for the server.
+
+    Reads run on a small pool of threads, each with its own connection. Every
+    write goes through one writer thread that owns the only write connection,
+    so writers never fight over the database lock. Both `read` and `write`
+    return a concurrent Future; ChatServer awaits them with asyncio.wrap_future.
+
+    The writer group-commits: the first write opens a transaction and runs at
+    once, the writes arriving in the next `flush_interval` seconds (or up to
+    `max_batch` jobs) run in the same transaction as they come, and they are
+    committed together. `flush_interval` is the durability window, a write is
+    committed at most that long after it was queued. Each job runs in its own
+    savepoint, so one failing write does not undo the others. `write_behind`
+    also hands out a job's result as soon as it ran, before the commit, for
+    callers that need an inserted id but not durability.
+
+    Query functions take the connection as their first argument and must not
+    commit, the writer thread does that.
+
+    When the database stays locked past busy_timeout (another process holding
+    the write lock), or cannot be opened, the writes of that batch fail with
+    the sqlite3 error and the writer carries on with the next one. A writer
+    that could not connect tries again after `retry_delay` seconds, doubling
+    up to `max_retry_delay`.
+    """
+
+    def __init__(self, path="userdata.db", readers=4, flush_interval=0.005, max_batch=256,
+                 retry_delay=0.1, max_retry_delay=5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._writer_loop, name="db-write", daemon=True)
+        self._writer.start()
+
+    def _connect(self, isolation_level=""):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=isolation_level)
+        try:
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+        except sqlite3.Error:
+            conn.close()
+            raise
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    # ==== reads ==== #
+    def read(self, func, *args):
+        return self._readers.submit(self._run_read, func, args)
+
+    def _run_read(self, func, args):
+        # Opened on first use, a reader that failed to connect tries again on its next read
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return func(conn, *args)
+
+    # ==== writes ==== #
+    def pending_writes(self):
+        return self._writes.qsize()
+
+    def write(self, func, *args):
+        """Future of the result of `func`, resolved once it is committed"""
+        future = Future()
+        self._writes.put((func, args, future, None))
+        return future
+
+    def write_behind(self, func, *args):
+        """Futures (ran, committed) of the result of `func`: `ran` resolves as
+        soon as it ran in the open transaction, `committed` with the commit.
+        Should the commit fail, `ran` has told of a write that did not last."""
+        ran, committed = Future(), Future()
+        self._writes.put((func, args, committed, ran))
+        return ran, committed
+
+    def _writer_loop(self):
+        conn = None
+        delay = self.retry_delay
+        running = True
+        while running:
+            job = self._writes.get()
+            if job is None:
+                break
+            if conn is None:
+                try:
+                    # Transactions are managed by hand below
+                    conn = self._connect(isolation_level=None)
+                    delay = self.retry_delay
+                except sqlite3.Error as e:
+                    self._fail([job], e)
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.max_retry_delay)
+                    continue
+
+            batch, outcomes = [job], []
+            try:
+                # IMMEDIATE takes the write lock up front. Another server worker may hold
+                # it, and only then does busy_timeout wait for it; a deferred transaction
+                # that reads first fails at its first write instead.
+                conn.execute("BEGIN IMMEDIATE")
+                self._run_job(conn, job, outcomes)
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        job = self._writes.get(timeout=remaining) if remaining > 0 else self._writes.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        running = False
+                        break
+                    batch.append(job)
+                    self._run_job(conn, job, outcomes)
+                conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                # Failed to lock, open a savepoint or commit: none of the batch is saved
+                if conn.in_transaction:
+                    try:
+                        conn.execute("ROLLBACK")
+                    except sqlite3.Error:
+                        pass
+                self._fail(batch, e)
+                continue
+
+            for future, value, ok in outcomes:
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    @staticmethod
+    def _run_job(conn, job, outcomes):
+        func, args, future, ran = job
+        if not future.set_running_or_notify_cancel():
+            if ran is not None:
+                ran.cancel()
+            return
+        conn.execute("SAVEPOINT job")
+        try:
+            result = func(conn, *args)
+        except Exception as e:
+            conn.execute("ROLLBACK TO job")
+            conn.execute("RELEASE job")
+            outcomes.append((future, e, False))
+            if ran is not None:
+                ran.set_exception(e)
+        else:
+            conn.execute("RELEASE job")
+            outcomes.append((future, result, True))
+            if ran is not None:
+                ran.set_result(result)
+
+    @staticmethod
+    def _fail(batch, error):
+        for _, _, future, ran in batch:
+            if future.running() or future.set_running_or_notify_cancel():
+                future.set_exception(error)
+            if ran is not None and not ran.done():
+                ran.set_exception(error)
+
+    def flush(self):
+        """Future that resolves once everything queued so far is committed"""
+        return self.write(lambda conn: None)
+
+    def close(self):
+        """Commit queued writes, then close every connection"""
+        self._writes.put(None)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+# ==== Queries ==== #
+# Reads go through Storage.read, writes through Storage.write.
+
+def register_user(conn, username, password):
+    """Insert a new user, returns False if the username is taken"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM userdata WHERE username=?", (username,))
+    if cursor.fetchone():
+        return False
+    cursor.execute("INSERT INTO userdata (username, password) VALUES (?, ?)", (username, password))
+    return True
+
+def get_password(conn, username):
+    cursor = conn.cursor()
+    cursor.execute("SELECT password FROM userdata WHERE username=?", (username,))
+    db_password = cursor.fetchone()
+    return db_password[0] if db_password else None
+
+def history_page(conn, columns, table, branches, since_id=None, before_id=None, limit=200):
+    """One page of history rows as (id, *columns), oldest first, plus whether more rows exist.
+
+    `branches` is a list of (where, params); their matches are combined. With
+    `since_id` the page holds the rows right after that id, otherwise the rows
+    right before `before_id`, or the newest rows when neither is given. Each
+    branch is its own LIMITed index range scan, so a page costs the same no
+    matter how long the conversation is.
+    """
+    cursor_clauses, cursor_params = [], []
+    if since_id is not None:
+        cursor_clauses.append("id > ?")
+        cursor_params.append(since_id)
+    if before_id is not None:
+        cursor_clauses.append("id < ?")
+        cursor_params.append(before_id)
+    order = "ASC" if since_id is not None else "DESC"
+
+    selects, params = [], []
+    for where, branch_params in branches:
+        clauses = " AND ".join([f"({where})"] + cursor_clauses)
+        selects.append(f"SELECT * FROM (SELECT id, {columns} FROM {table} "
+                       f"WHERE {clauses} ORDER BY id {order} LIMIT ?)")
+        params += list(branch_params) + cursor_params + [limit + 1]
+
+    rows = conn.execute(f"{' UNION ALL '.join(selects)} ORDER BY id {order} LIMIT ?",
+                        params + [limit + 1]).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "DESC":
+        rows.reverse()
+    return rows, has_more
+
+def get_dm_history(conn, username, since_id=None, before_id=None, limit=200):
+    """Fetch a page of DM history for a given username (both sent and received)"""
+    return history_page(conn, "sender_username, recipient_username, message, timestamp", "dm_histories",
+                        [("sender_username=?", (username,)),
+                         ("recipient_username=? AND sender_username<>?", (username, username))],
+                        since_id, before_id, limit)
+
+def get_delivered_dm_history(conn, username, since_id=None, before_id=None, limit=200):
+    """get_dm_history without the DMs still in the user's mailbox, the mailbox pages send those"""
+    return history_page(conn, "sender_username, recipient_username, message, timestamp", "dm_histories",
+                        [("sender_username=?", (username,)),
+                         ("recipient_username=? AND sender_username<>? AND id NOT IN "
+                          "(SELECT dm_id FROM dm_mailbox WHERE recipient_username=?)", (username, username, username))],
+                        since_id, before_id, limit)
+
+def get_dm_history_between(conn, user1, user2, since_id=None, before_id=None, limit=200):
+    branches = [("sender_username=? AND recipient_username=?", (user1, user2))]
+    if user1 != user2:
+        branches.append(("sender_username=? AND recipient_username=?", (user2, user1)))
+    return history_page(conn, "sender_username, recipient_username, message, timestamp", "dm_histories",
+                        branches, since_id, before_id, limit)
+
+def store_dm(conn, sender_name, recipient_name, content):
+    """Save a DM and return its id"""
+    return conn.execute("""
+                 INSERT INTO dm_histories (sender_username, recipient_username, message)
+                 VALUES (?, ?, ?)
+                 """, (sender_name, recipient_name, content)).lastrowid
+
+def queue_dm(conn, msg_id, recipient_name):
+    """Keep a saved DM in the recipient's mailbox until their client acknowledges it"""
+    conn.execute("INSERT OR IGNORE INTO dm_mailbox (dm_id, recipient_username) VALUES (?, ?)",
+                 (msg_id, recipient_name))
+
+def store_offline_dm(conn, sender_name, recipient_name, content):
+    """Save a DM and queue it in the recipient's mailbox, returns its id"""
+    msg_id = store_dm(conn, sender_name, recipient_name, content)
+    queue_dm(conn, msg_id, recipient_name)
+    return msg_id
+
+def get_mailbox(conn, username, limit=200):
+    """The oldest queued DMs of a user, as DM history rows, plus whether more are queued"""
+    rows = conn.execute("""
+        SELECT d.id, d.sender_username, d.recipient_username, d.message, d.timestamp
+        FROM dm_mailbox m JOIN dm_histories d ON d.id = m.dm_id
+        WHERE m.recipient_username=?
+        ORDER BY m.dm_id LIMIT ?
+    """, (username, limit + 1)).fetchall()
+    return rows[:limit], len(rows) > limit
+
+def ack_mailbox(conn, username, up_to_id):
+    """Drop the queued DMs of a user up to and including `up_to_id`, they were delivered"""
+    conn.execute("DELETE FROM dm_mailbox WHERE recipient_username=? AND dm_id<=?", (username, up_to_id))
+
+def update_user_port(conn, username, port):
+    conn.execute("""
+        INSERT OR REPLACE INTO user_ports (username, port, last_seen)
+        VALUES (?, ?, datetime('now'))
+    """, (username, port))
+
+def get_user_ports(conn, username):
+    cursor = conn.cursor()
+    cursor.execute("SELECT port FROM user_ports WHERE username=?", (username,))
+    return [row[0] for row in cursor.fetchall()]
+
+def create_group(conn, group_name, group_owner, group_members_list):
+    """Create a group with its owner and members, returns the existing owner if the name is taken"""
+    cursor = conn.cursor()
+
+    verify_group_existence = """
+        SELECT username FROM user_group_owner WHERE groupname = ?
+    """
+
+    cursor.execute(verify_group_existence, (group_name, ))
+    output = cursor.fetchall()
+
+    if output:
+        return output[0][0]
+
+    insert_group_owner_data = """
+        INSERT INTO user_group_owner (groupname, username) VALUES (?, ?)
+    """
+
+    insert_group_data = """
+        INSERT INTO user_group (groupname, username) VALUES (?, ?)
+    """
+
+    cursor.execute(insert_group_owner_data, (group_name, group_owner))
+    cursor.execute(insert_group_data, (group_name, group_owner))
+
+    for member in group_members_list:
+        if member:
+            cursor.execute(insert_group_data, (group_name, member))
+    return None
+
+def store_group_message(conn, group_name, sender_name, content):
+    """Save a group message and return its id"""
+    return conn.execute(
+        "INSERT INTO group_chat_histories (groupname, sender_username, message) VALUES (?, ?, ?)",
+        (group_name, sender_name, content)
+    ).lastrowid
+
+def get_group_members(conn, group_name):
+    cursor = conn.cursor()
+    cursor.execute("SELECT username FROM user_group WHERE groupname=?", (group_name,))
+    return [row[0] for row in cursor.fetchall()]
+
+def get_group_history(conn, group_name, since_id=None, before_id=None, limit=200):
+    return history_page(conn, "sender_username, message, timestamp", "group_chat_histories",
+                        [("groupname=?", (group_name,))], since_id, before_id, limit)
+
+def load_directory(conn):
+    """Every registered username, and every group as {groupname: (owner, [members])}"""
+    users = [row[0] for row in conn.execute("SELECT username FROM userdata ORDER BY id")]
+
+    groups = {}
+    for group_name, group_owner in conn.execute("SELECT groupname, username FROM user_group_owner"):
+        groups[group_name] = (group_owner, [])
+    for group_name, member in conn.execute("SELECT groupname, username FROM user_group"):
+        if group_name in groups:
+            groups[group_name][1].append(member)
+    return users, groups
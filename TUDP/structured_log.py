@@ -0,0 +1,179 @@
+import collections
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+
+class Colors:
+    HEADER = '\033[95m'
+    BLUE = '\033[94m'
+    GREEN = '\033[92m'
+    WARNING = '\033[93m'
+    FAIL = '\033[91m'
+    END = '\033[0m'
+    BOLD = '\033[1m'
+    UNDERLINE = '\033[4m'
+    BG_DARK = '\033[48;5;234m'  # Dark background
+    TEXT_LIGHT = '\033[38;5;250m'  # Light text
+
+
+LEVEL_COLORS = {logging.WARNING: Colors.WARNING, logging.ERROR: Colors.FAIL, logging.CRITICAL: Colors.FAIL}
+# Events shown in a color of their own, at levels below WARNING
+EVENT_COLORS = {"chat": Colors.GREEN, "connect": Colors.BLUE}
+
+
+def log_event(name, **fields):
+    """The `extra` of a log call: the event's name, for sampling and
+    filtering, and fields the JSON format writes out as they are"""
+    return {"event": name, "fields": fields}
+
+
+class Sampler(logging.Filter):
+    """Lets through one in every n records of an event, for events too
+    frequent to log each time. `every` maps an event name to n, events
+    not in it are all kept. Records let through carry `sampled` = n, and
+    `dropped` counts the rest per event."""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self.seen = collections.Counter()
+        self.dropped = collections.Counter()
+
+    def filter(self, record):
+        name = getattr(record, "event", None)
+        n = self.every.get(name, 1)
+        if n <= 1:
+            return True
+        self.seen[name] += 1
+        if self.seen[name] % n != 1:
+            self.dropped[name] += 1
+            return False
+        record.sampled = n
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Drops records while the queue is full, counting them in `dropped`:
+    logging never blocks the caller or grows the queue without bound when
+    the writer falls behind"""
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    # The stock prepare() formats the message where it was logged, here that
+    # waits for the writer thread: the arguments are strings and numbers, not
+    # changed after the call
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    # stop() must not find the queue full, it waits for the writer to make room
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class TextFormatter(logging.Formatter):
+    """The message alone, in the colors of its level or event when `color` is on"""
+
+    def __init__(self, color):
+        super().__init__()
+        self.color = color
+
+    def format(self, record):
+        text = record.getMessage()
+        if getattr(record, "sampled", 1) > 1:
+            text += f" (1 in {record.sampled})"
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        if not self.color:
+            return text
+        color = LEVEL_COLORS.get(record.levelno) or EVENT_COLORS.get(getattr(record, "event", None),
+                                                                     Colors.TEXT_LIGHT)
+        return f"{color}{Colors.BG_DARK}{text}{Colors.END}"
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the time, level, process, event and fields"""
+
+    def format(self, record):
+        entry = {"time": round(record.created, 6), "level": record.levelname, "pid": record.process,
+                 "logger": record.name, "event": getattr(record, "event", None), "message": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        if getattr(record, "sampled", 1) > 1:
+            entry["sampled"] = record.sampled
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup(level="INFO", format="text", sample=None, stream=None, name="tudp", background=True,
+          queue_size=10000):
+    """Send the records of the `name` logger through a queue to a writer thread.
+
+    Logging a record then costs building it and a queue put, the formatting
+    and the write to `stream` (stdout by default), which blocks when a pipe
+    or terminal is slow, happen on the writer thread. At most `queue_size`
+    records wait for it, the ones logged past that are dropped. `format` is
+    "text" or "json". Text is colored only when `stream` is a terminal. `sample` maps
+    event names to the n of Sampler.
+
+    Each process calls this for itself, a worker does not inherit the writer
+    thread of its parent. Returns the listener, stop() it to write what is
+    still queued before exiting. Without `background` records are written
+    as they are logged, and None is returned.
+    """
+    stream = stream or sys.stdout
+    writer = logging.StreamHandler(stream)
+    if format == "json":
+        writer.setFormatter(JsonFormatter())
+    else:
+        writer.setFormatter(TextFormatter(color=_is_terminal(stream)))
+
+    listener = None
+    handler = writer
+    if background:
+        records = queue.Queue(queue_size)
+        handler = _QueueHandler(records)
+        listener = _QueueListener(records, writer)
+    handler.addFilter(Sampler(sample or {}))
+    logger = logging.getLogger(name)
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    if listener is not None:
+        listener.start()
+    return listener
+
+
+def dropped(name="tudp"):
+    """Records of the `name` logger not written since setup(), by reason:
+    "sampled" out by the Sampler, or dropped at a full queue ("queue_full")"""
+    counts = {"sampled": 0, "queue_full": 0}
+    for handler in logging.getLogger(name).handlers:
+        counts["queue_full"] += getattr(handler, "dropped", 0)
+        for log_filter in handler.filters:
+            if isinstance(log_filter, Sampler):
+                counts["sampled"] += sum(log_filter.dropped.values())
+    return counts
+
+
+def _is_terminal(stream):
+    try:
+        return stream.isatty() and os.environ.get("TERM") != "dumb"
+    except (AttributeError, ValueError):
+        return False
@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+
+class TypingAggregator:
+    """Coalesces typing indicators before they are relayed.
+
+    Clients send a typing packet on every keystroke. Only the latest text per
+    key (a sender and the conversation it types in) is kept, and whatever
+    changed is handed to `send(key, text)` once every `interval` seconds.
+    When a flush runs late, updates older than `stale_after` seconds are
+    dropped, and at most `max_per_flush` are sent, newest first. "Stopped
+    typing" (empty text) is never dropped, or an indicator would stay up.
+    """
+
+    def __init__(self, send, interval=0.25, stale_after=1.0, max_per_flush=64):
+        self.send = send
+        self.interval = interval
+        self.stale_after = stale_after
+        self.max_per_flush = max_per_flush
+        self.pending = {}  # {key: (text, received_at)}
+        self.last_sent = {}  # {key: text}, to skip updates that change nothing
+        self.stats = {"received": 0, "sent": 0, "coalesced": 0, "dropped": 0}
+
+    def update(self, key, text):
+        self.stats["received"] += 1
+        if key in self.pending:
+            self.stats["coalesced"] += 1
+        self.pending[key] = (text, time.monotonic())
+
+    def forget(self, port):
+        """Drop the state of a sender that went away, keys start with its port"""
+        for table in (self.pending, self.last_sent):
+            for key in [key for key in table if key[0] == port]:
+                del table[key]
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        now = time.monotonic()
+        sent = 0
+        # Newest first, so the cap drops the oldest updates
+        for key, (text, received_at) in sorted(pending.items(), key=lambda item: item[1][1], reverse=True):
+            if self.last_sent.get(key, "") == text:
+                self.stats["coalesced"] += 1
+                continue
+            if text and (now - received_at > self.stale_after or sent >= self.max_per_flush):
+                self.stats["dropped"] += 1
+                continue
+            if text:
+                self.last_sent[key] = text
+            else:
+                self.last_sent.pop(key, None)
+            self.send(key, text)
+            sent += 1
+        self.stats["sent"] += sent